@@ -0,0 +1,648 @@
+import asyncio
+import time
+
+from asyncua import Client
+from asyncua import ua
+from asyncua.common import ua_utils
+from asyncua.common.node import Node
+
+from pete.opc_common import (
+    DEFAULT_CHUNK_SIZE,
+    MISSING,
+    SUBSCRIPTION_PERIOD,
+    NodeCache,
+    ShadowCache,
+    Subscribers,
+    browseNextParameters,
+    browseParameters,
+    browsePaths,
+    builtinVariantType,
+    chunks,
+    collectReferences,
+    conditionPredicates,
+    indexedPaths,
+    metadataItems,
+    nodeidOf,
+    operationLimitItems,
+    parseMetadata,
+    parseOperationLimits,
+    readParameters,
+    satisfied,
+    serverUrl,
+    toPython,
+    writeParameters,
+)
+from pete.path_index import DEFAULT_CACHE_DIR, PathIndex
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class AsyncDataChangeHandler(object):
+    def __init__(self, shadow=None):
+        """Initialize handler of the shared data change subscription.
+
+        The handler keeps the latest data value of every monitored node,
+        wakes up coroutines waiting for a value to change and calls
+        listeners.
+
+        Args:
+            shadow (ShadowCache): Cache to feed notified values into.
+        """
+        self.values = {}
+        self.waiters = set()
+        self.shadow = shadow
+        self.listeners = {}  # Callbacks per node id, see `listen`
+
+    def datachange_notification(self, node, val, data):
+        """Store notified value, wake up waiting coroutines, call listeners."""
+        self.values[node.nodeid] = data.monitored_item.Value
+        for event in self.waiters:
+            event.set()
+        if self.shadow is not None:
+            self.shadow.put(node.nodeid, val)
+        for callback in self.listeners.get(node.nodeid, ()):
+            try:
+                callback(node.nodeid, val)
+            except Exception as e:
+                print("Data change callback failed: {}".format(e))
+
+    def listen(self, nodeid, callback):
+        """Call callback(nodeid, value) on each value change of a node.
+
+        Callbacks are called on the event loop, so they must not block.
+        """
+        listeners = self.listeners.get(nodeid, ())
+        if callback not in listeners:
+            self.listeners[nodeid] = listeners + (callback,)
+
+    def unlisten(self, nodeid, callback=None):
+        """Stop calling callback, or all callbacks if None, for a node."""
+        listeners = self.listeners.pop(nodeid, ())
+        if callback is not None:
+            listeners = tuple(c for c in listeners if c != callback)
+            if listeners:
+                self.listeners[nodeid] = listeners
+
+    def forget(self, nodeid):
+        """Forget value and callbacks of a node that is not monitored anymore.
+
+        Otherwise a wait after monitoring the node again would be checked
+        against the value from before, until the first new notification.
+        """
+        self.values.pop(nodeid, None)
+        self.listeners.pop(nodeid, None)
+
+    def get(self, nodeid):
+        """Return latest data value of node, or None if none received."""
+        return self.values.get(nodeid)
+
+    def clear(self):
+        """Forget all values."""
+        self.values.clear()
+
+
+class AsyncOPCClient(Client):
+    def __init__(
+        self,
+        ip,
+        port=4840,
+        timeout=4,
+        cache_size=10000,
+        path_cache_dir=DEFAULT_CACHE_DIR,
+        shadow=False,
+        deadband=0.0,
+        max_age=1.0,
+    ):
+        """Initialize asyncio OPCUA client.
+
+        This is the asyncio counterpart of `pete.opc_client.OPCClient`,
+        built on the asyncua package. All methods doing network traffic
+        are coroutines, e.g. `await client.setValue(node, 1)`, which lets
+        simulators and tests run many concurrent operations from a
+        single event loop. Request building and caching are shared with
+        `OPCClient` (see `pete.opc_common`), so the asyncua package is the
+        only OPCUA library needed.
+
+        The surface is that of `OPCClient`, except for the session pool
+        (`pete.opc_client.pool`), which only holds synchronous clients,
+        and the methods of the opcua package's `Client`, which are those
+        of asyncua's `Client` instead.
+
+        Args:
+            ip (str): PLC IP address, or the full endpoint url of the PLC,
+                e.g. 'opc.tcp://localhost:4841'.
+            port (int): TCP port of the PLC's OPCUA server, unless given
+                in the url.
+            timeout (float): Timeout in seconds for connection.
+            cache_size (int): Max number of nodes held in metadata cache.
+            path_cache_dir (str): Directory of the persistent browse path
+                index. Set to None to not persist resolved paths.
+            shadow (bool): Keep the last known value of nodes, see
+                `OPCClient`.
+            deadband (float): Max difference between numeric values for a
+                write to be skipped as unchanged, see `ShadowCache`.
+            max_age (float): Seconds a value of a node that is not
+                monitored is considered current, see `ShadowCache`.
+        """
+        url = serverUrl(ip, port)
+        super().__init__(url, timeout=timeout)
+        self.operation_limits = None
+        self.metadata = NodeCache(cache_size)
+        self.path_cache_dir = path_cache_dir
+        self.path_index = None
+        self.shadow = ShadowCache(deadband, max_age) if shadow else None
+        self.subscription = None
+        self.subscription_handler = AsyncDataChangeHandler(self.shadow)
+        self.monitored = {}  # Monitored item handle per node id
+        self.subscribers = Subscribers()
+        self._subscription_lock = asyncio.Lock()
+
+    async def disconnect(self):
+        """Disconnect from server, forgetting the shared subscription."""
+        try:
+            await super().disconnect()
+        finally:
+            self.subscription = None
+            self.monitored.clear()
+            self.subscribers.clear()
+            self.subscription_handler.clear()
+            if self.shadow is not None:
+                self.shadow.invalidate()
+
+    async def setValue(self, node, value):
+        """Set value to OPCUA node.
+
+        The variant type is taken from the metadata cache, so only the
+        first write to a node costs an extra round trip. With the shadow
+        cache enabled, the write is skipped if the node is known to hold
+        the value already.
+        """
+        if self.shadow is not None:
+            if self.shadow.unchanged(node.nodeid, value, self._monitored(node)):
+                self.shadow.suppressed += 1
+                return
+
+        variant_type = (await self.getMetadata(node)).variant_type
+        variant = ua.Variant(value, variant_type)
+        await node.write_value(ua.DataValue(variant))
+
+        if self.shadow is not None:
+            self.shadow.put(node.nodeid, value)
+
+    async def getValue(self, node):
+        """Return node value.
+
+        With the shadow cache enabled, a current known value is returned
+        without a round trip.
+        """
+        if self.shadow is None:
+            return await node.read_value()
+
+        value = self.shadow.get(node.nodeid, self._monitored(node))
+        if value is MISSING:
+            value = await node.read_value()
+            self.shadow.put(node.nodeid, value)
+
+        return value
+
+    async def getName(self, node):
+        """Returns name of node, e.g. '3:Inputs'"""
+        browse_name = (await self.getMetadata(node)).browse_name
+        return "{}:{}".format(browse_name.NamespaceIndex, browse_name.Name)
+
+    async def applyVal(self, node, val, feedback):
+        """Value setter including error handling.
+
+        See `pete.opc_client.OPCClient.applyVal`.
+        """
+        try:
+            variant_type = (await self.getMetadata(node)).variant_type
+            value = toPython(variant_type, val)
+            await self.setValue(node, value)
+            feedback.setText(str(value))
+        except Exception as e:
+            print(e)
+            print("Couldn't set value")
+
+    async def read_many(self, nodes, attribute=ua.AttributeIds.Value):
+        """Read an attribute of many nodes using batched Read requests.
+
+        See `pete.opc_client.OPCClient.read_many`.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to read.
+            attribute (ua.AttributeIds): Attribute to read from each node.
+
+        Returns:
+            list(ua.DataValue): One data value per node, in the same order
+            as `nodes`.
+        """
+        nodeids = [nodeidOf(node) for node in nodes]
+        results = await self._read([(nodeid, attribute) for nodeid in nodeids])
+        if self.shadow is not None and attribute == ua.AttributeIds.Value:
+            for nodeid, dv in zip(nodeids, results):
+                if dv.StatusCode.is_good():
+                    self.shadow.put(nodeid, dv.Value.Value)
+
+        return results
+
+    async def write_many(self, values):
+        """Write values to many nodes using batched Write requests.
+
+        See `pete.opc_client.OPCClient.write_many`.
+
+        Args:
+            values (dict(Node, object)): Value to write, per node.
+
+        Returns:
+            dict(Node, ua.StatusCode): Status of the write, per node.
+        """
+        nodes = list(values)
+        statuses = {}
+        if self.shadow is not None:
+            changed = []
+            for node in nodes:
+                nodeid = nodeidOf(node)
+                monitored = self._monitored(nodeid)
+                if self.shadow.unchanged(nodeid, values[node], monitored):
+                    self.shadow.suppressed += 1
+                    statuses[node] = ua.StatusCode(ua.StatusCodes.Good)
+                else:
+                    changed.append(node)
+            nodes = changed
+        metadata = await self.getMetadataMany(nodes)
+
+        writable = []
+        for node, meta in zip(nodes, metadata):
+            if isinstance(meta, ua.StatusCode):
+                statuses[node] = meta  # Node could not be looked up
+            elif meta.variant_type is None:
+                statuses[node] = ua.StatusCode(ua.StatusCodes.BadNotWritable)
+            else:
+                writable.append((node, meta.variant_type))
+
+        limit = await self.getOperationLimit("write")
+        for chunk in chunks(writable, limit):
+            results = await self.uaclient.write(writeParameters(ua, chunk, values))
+            for (node, _), status in zip(chunk, results):
+                statuses[node] = status
+                if self.shadow is not None and status.is_good():
+                    self.shadow.put(nodeidOf(node), values[node])
+
+        return statuses
+
+    async def browse_many(self, nodes):
+        """Return hierarchical child references of many nodes.
+
+        See `pete.opc_client.OPCClient.browse_many`.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to browse.
+
+        Returns:
+            list(list(ua.ReferenceDescription)): Child references per node,
+            in the same order as `nodes`.
+        """
+        nodeids = [nodeidOf(node) for node in nodes]
+        references = [[] for _ in nodeids]
+        limit = await self.getOperationLimit("browse")
+
+        for offset in range(0, len(nodeids), limit):
+            chunk = nodeids[offset : offset + limit]
+            results = await self.uaclient.browse(browseParameters(ua, chunk))
+            positions = [(i, None) for i in range(offset, offset + len(chunk))]
+            pending = collectReferences(references, positions, results)
+            while pending:
+                params = browseNextParameters(ua, pending)
+                results = await self.uaclient.browse_next(params)
+                pending = collectReferences(references, pending, results)
+
+        return references
+
+    async def getMetadata(self, node):
+        """Return cached metadata of node, fetching it if not yet cached.
+
+        Args:
+            node (Node): OPCUA node.
+
+        Returns:
+            NodeMetadata: Variant type, browse name, display name and value
+            rank of the node.
+        """
+        meta = (await self.getMetadataMany([node]))[0]
+        if isinstance(meta, ua.StatusCode):
+            meta.check()  # Raises the corresponding exception
+
+        return meta
+
+    async def getMetadataMany(self, nodes):
+        """Return metadata of many nodes, fetching uncached nodes in bulk.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes.
+
+        Returns:
+            list(NodeMetadata or ua.StatusCode): Metadata per node, or the
+            bad status code if the node could not be looked up.
+        """
+        nodeids = [nodeidOf(node) for node in nodes]
+        metadata = [self.metadata.get(nodeid) for nodeid in nodeids]
+        missing = [n for n, meta in zip(nodeids, metadata) if meta is None]
+        if not missing:
+            return metadata
+
+        fetched = dict(zip(missing, await self._fetchMetadata(missing)))
+        return [
+            fetched[n] if meta is None else meta for n, meta in zip(nodeids, metadata)
+        ]
+
+    async def cacheMetadata(self, nodes):
+        """Fill metadata cache with many nodes using one batched read.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes.
+        """
+        await self.getMetadataMany(nodes)
+
+    def invalidateMetadata(self, nodes=None):
+        """Drop nodes from metadata cache, or clear it if nodes is None.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to drop from cache.
+        """
+        if nodes is None:
+            self.metadata.invalidate()
+        else:
+            self.metadata.invalidate([nodeidOf(node) for node in nodes])
+
+    async def _fetchMetadata(self, nodeids):
+        """Read metadata of nodes from server and cache it."""
+        results = await self._read(metadataItems(ua, nodeids))
+
+        metadata = []
+        for nodeid, parsed in zip(nodeids, parseMetadata(results)):
+            if isinstance(parsed, ua.StatusCode):
+                metadata.append(parsed)  # Node does not exist
+                continue
+
+            dtype, meta = parsed
+            if dtype is not None:
+                variant_type = await self._toVariantType(dtype)
+                meta = meta._replace(variant_type=variant_type)
+            self.metadata.put(nodeid, meta)
+            metadata.append(meta)
+
+        return metadata
+
+    async def getPLC(self):
+        """Return PLC node, i.e. the last child of the 'Objects' node."""
+        return (await self.get_objects_node().get_children())[-1]
+
+    async def getSoftwareRevision(self):
+        """Return software revision of PLC program, or "" if unavailable."""
+        try:
+            plc = await self.getPLC()
+            return await (await plc.get_child("2:SoftwareRevision")).read_value()
+        except ua.UaStatusCodeError:
+            return ""
+
+    async def resolvePath(self, path, start=None):
+        """Return node at a browse path, like 'Node.get_child' does.
+
+        Args:
+            path (list(str)): Browse names, e.g. ["0:Objects", "3:PLC"].
+            start (Node): Node to start from. Defaults to the root node.
+
+        Raises:
+            ua.UaStatusCodeError: If the path does not resolve to a node.
+        """
+        node = (await self.resolvePaths([path], start))[0]
+        if node is None:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadNoMatch)
+
+        return node
+
+    async def resolvePaths(self, paths, start=None):
+        """Return nodes of many browse paths, in one batched request.
+
+        See `pete.opc_client.OPCClient.resolvePaths`.
+
+        Args:
+            paths (list(list(str))): Browse paths, each a list of browse
+                names.
+            start (Node): Node that all paths start from. Defaults to the
+                root node.
+
+        Returns:
+            list(Node): Node per path, or None if the path did not resolve.
+        """
+        start = self.get_root_node() if start is None else start
+        start_id = nodeidOf(start).to_string()
+        index = await self.getPathIndex()
+
+        nodeids, missing = indexedPaths(index, start_id, paths)
+        nodes = [
+            None if nodeid is None else self.get_node(ua.NodeId.from_string(nodeid))
+            for nodeid in nodeids
+        ]
+
+        limit = await self.getOperationLimit("translate")
+        for chunk in chunks(missing, limit):
+            bpaths = browsePaths(ua, start, [path for _, path in chunk])
+            results = await self.uaclient.translate_browsepaths_to_nodeids(bpaths)
+            for (i, path), result in zip(chunk, results):
+                if not result.StatusCode.is_good() or not result.Targets:
+                    continue
+
+                nodeid = result.Targets[0].TargetId
+                nodes[i] = self.get_node(nodeid)
+                if index:
+                    index.put(PathIndex.key(start_id, path), nodeid.to_string())
+
+        if index:
+            index.save()
+
+        return nodes
+
+    async def getPathIndex(self):
+        """Return persistent path index, opening it on first use.
+
+        Returns None if persisting of paths is disabled. If the PLC does
+        not expose its program revision, the index is kept in memory only,
+        as an index on disk could not be told apart from that of another
+        program, whose node ids may have moved.
+        """
+        if self.path_index is None and self.path_cache_dir is not None:
+            revision = await self.getSoftwareRevision()
+            self.path_index = PathIndex(
+                self.server_url.geturl(),
+                revision,
+                self.path_cache_dir if revision else None,
+            )
+
+        return self.path_index
+
+    async def subscribe(self, nodes, callback=None, consumer=None):
+        """Monitor value changes of nodes through the shared subscription.
+
+        See `pete.opc_client.OPCClient.subscribe`.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to monitor.
+            callback (callable): Function called with the node id and the
+                new value on each value change of the nodes, including the
+                initial value. It is called on the event loop, so it must
+                not block.
+            consumer (object): Key of the consumer, to unsubscribe with.
+                Defaults to the callback, or, without callback, to the
+                waits of this client.
+        """
+        if consumer is None:
+            consumer = callback
+        nodeids = [nodeidOf(node) for node in nodes]
+
+        if callback is not None:
+            for nodeid in nodeids:
+                self.subscription_handler.listen(nodeid, callback)
+                dv = self.subscription_handler.get(nodeid)
+                if dv is not None:
+                    callback(nodeid, dv.Value.Value)  # Initial value, if known
+
+        async with self._subscription_lock:
+            if self.subscription is None:
+                self.subscription = await self.create_subscription(
+                    SUBSCRIPTION_PERIOD, self.subscription_handler
+                )
+
+            new = []
+            for nodeid in nodeids:
+                self.subscribers.add(nodeid, consumer, callback)
+                if nodeid not in self.monitored and nodeid not in new:
+                    new.append(nodeid)
+            if not new:
+                return
+
+            try:
+                handles = await self.subscription.subscribe_data_change(
+                    [self.get_node(nodeid) for nodeid in new]
+                )
+            except Exception:
+                for nodeid in new:
+                    self.subscribers.remove(nodeid, consumer)
+                    self.subscription_handler.forget(nodeid)
+                raise
+
+            bad = None
+            for nodeid, handle in zip(new, handles):
+                if isinstance(handle, ua.StatusCode):
+                    self.subscribers.remove(nodeid, consumer)
+                    self.subscription_handler.forget(nodeid)
+                    bad = handle
+                else:
+                    self.monitored[nodeid] = handle
+            if bad is not None:
+                bad.check()  # Raises the corresponding exception
+
+    async def unsubscribe(self, nodes=None, consumer=None):
+        """Stop monitoring nodes for a consumer, or all nodes if None.
+
+        See `pete.opc_client.OPCClient.unsubscribe`.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to stop monitoring. If None,
+                all nodes stop being monitored, for all consumers.
+            consumer (object): Key of the consumer, as given to
+                `subscribe`.
+        """
+        async with self._subscription_lock:
+            if nodes is None:
+                nodeids = list(self.monitored)
+                self.subscribers.clear()
+            else:
+                nodeids = []
+                for nodeid in {nodeidOf(n): None for n in nodes}:
+                    callback, last = self.subscribers.remove(nodeid, consumer)
+                    if callback is not None:
+                        self.subscription_handler.unlisten(nodeid, callback)
+                    if last and nodeid in self.monitored:
+                        nodeids.append(nodeid)
+
+            handles = [self.monitored.pop(nodeid) for nodeid in nodeids]
+            if handles:
+                await self.subscription.unsubscribe(handles)
+            for nodeid in nodeids:
+                self.subscription_handler.forget(nodeid)
+
+    async def wait_for(self, node, predicate, timeout=4.0):
+        """Wait for the value of a node to satisfy a predicate.
+
+        See `pete.opc_client.OPCClient.wait_for`.
+
+        Returns:
+            bool: True if the predicate was satisfied, False on timeout.
+        """
+        return await self.wait_all({node: predicate}, timeout)
+
+    async def wait_all(self, conditions, timeout=4.0):
+        """Wait for the values of many nodes to satisfy their predicates.
+
+        See `pete.opc_client.OPCClient.wait_all`.
+
+        Returns:
+            bool: True if all predicates were satisfied at the same time,
+            False on timeout.
+        """
+        predicates = conditionPredicates(conditions)
+        await self.subscribe(list(predicates))
+
+        deadline = time.monotonic() + timeout
+        event = asyncio.Event()
+        self.subscription_handler.waiters.add(event)
+        try:
+            while not satisfied(self.subscription_handler, predicates):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        finally:
+            self.subscription_handler.waiters.discard(event)
+
+        return True
+
+    async def getOperationLimit(self, operation):
+        """Return max number of nodes per service request for an operation.
+
+        See `pete.opc_client.OPCClient.getOperationLimit`.
+        """
+        if self.operation_limits is None:
+            params = readParameters(ua, operationLimitItems(ua))
+            results = await self.uaclient.read(params)
+            self.operation_limits = parseOperationLimits(results)
+
+        return self.operation_limits.get(operation, DEFAULT_CHUNK_SIZE)
+
+    def _monitored(self, node):
+        """Return True if node is monitored through the shared subscription."""
+        return self.monitored.get(nodeidOf(node)) is not None
+
+    async def _read(self, items):
+        """Read (node id, attribute) pairs using batched Read requests."""
+        results = []
+        for chunk in chunks(items, await self.getOperationLimit("read")):
+            results.extend(await self.uaclient.read(readParameters(ua, chunk)))
+
+        return results
+
+    async def _toVariantType(self, dtype):
+        """Return variant type of a data type node id."""
+        variant_type = builtinVariantType(ua, dtype)
+        if variant_type is not None:
+            return variant_type
+
+        return await ua_utils.data_type_to_variant_type(Node(self.uaclient, dtype))
@@ -0,0 +1,564 @@
+import atexit
+from collections import OrderedDict
+import threading
+import time
+
+from pete.lazy import LazyModule
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# pyepics loads the CA library on import, so it is imported on first use
+epics = LazyModule("epics")
+
+# Number of reads of a PV after which it is monitored
+MONITOR_AFTER = 3
+
+
+class WaitResult(object):
+    def __init__(self, ok, elapsed, values):
+        """Initialize outcome of a wait for PV values.
+
+        A result is truthy if the wait succeeded, so it can be asserted on
+        directly.
+
+        Args:
+            ok (bool): True if the condition was met, False on timeout.
+            elapsed (float): Measured wait time in seconds.
+            values (dict(str, object)): Latest value per PV name.
+        """
+        self.ok = ok
+        self.elapsed = elapsed
+        self.values = values
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        return "WaitResult(ok={}, elapsed={:.3f}s, values={})".format(
+            self.ok, self.elapsed, self.values
+        )
+
+
+class DeviceConfig(object):
+    def __init__(self, device, values):
+        """Initialize configuration of a device, read from its PVs.
+
+        Configuration values are looked up by field, e.g.
+        `config["ScaleLOW"]` for the value of PV '<device>:ScaleLOW'.
+
+        Args:
+            device (str): Device PV prefix, e.g. 'Tgt-HeC1010:Proc-TT-001'.
+            values (dict(str, object)): Value per field, None if the PV
+                did not connect.
+        """
+        self.device = device
+        self.values = values
+
+    def __getitem__(self, field):
+        return self.values[field]
+
+    def __repr__(self):
+        return "DeviceConfig({}, {})".format(self.device, self.values)
+
+
+class PVManager(object):
+    def __init__(self, maxsize=1000, monitor_after=MONITOR_AFTER):
+        """Initialize manager of persistent Channel Access connections.
+
+        A bare `epics.caget` of a PV name that was not used before pays
+        for a name search and a channel connection, and every `caget` is
+        a network round trip. The manager instead keeps connected
+        `epics.PV` objects in a bounded, least recently used cache, and
+        monitors PVs that are read repeatedly, so that reading those is
+        answered locally from the latest monitor update.
+
+        Args:
+            maxsize (int): Max number of connected PVs. The least recently
+                used PV is disconnected when the cache is full.
+            monitor_after (int): Number of reads of a PV after which it is
+                monitored. Set to 1 to monitor every PV on first read.
+        """
+        self.maxsize = maxsize
+        self.monitor_after = monitor_after
+        self.pvs = OrderedDict()  # epics.PV per PV name
+        self.reads = {}  # Number of reads per PV name, until monitored
+        self.monitors = {}  # Number of monitor callbacks per PV name
+        self._stale = set()  # Monitored PVs written since their last read
+        self._lock = threading.RLock()
+
+    def pv(self, pvname, monitor=False, timeout=5.0):
+        """Return connected PV, connecting it if not yet cached.
+
+        A cached PV that is still connecting, e.g. one created by
+        `connect` or by another thread, is waited for as well.
+
+        Args:
+            pvname (str): EPICS PV name.
+            monitor (bool): Monitor the PV. An unmonitored PV that is
+                already cached is reconnected with a monitor.
+            timeout (float): Timeout in seconds for connection. Set to 0
+                to not wait, e.g. from a gui.
+
+        Returns:
+            epics.PV: Cached PV. Check its `connected` attribute to see
+            whether it connected within the timeout.
+        """
+        pv = self._cached(pvname, monitor)
+        if timeout and not pv.connected:
+            pv.wait_for_connection(timeout)
+
+        return pv
+
+    def _cached(self, pvname, monitor=False):
+        """Return cached PV, creating it without waiting for connection."""
+        with self._lock:
+            pv = self.pvs.get(pvname)
+            if pv is not None and (pv.auto_monitor or not monitor):
+                self.pvs.move_to_end(pvname)
+                return pv
+
+            if pv is not None:
+                pv.disconnect()  # Replaced with a monitored PV
+            pv = epics.PV(pvname, auto_monitor=monitor)
+            self.pvs[pvname] = pv
+            self.pvs.move_to_end(pvname)
+            self._evict(keep=pvname)
+
+        return pv
+
+    def _evict(self, keep=None):
+        """Disconnect least recently used PVs while the cache is full.
+
+        PVs with monitor callbacks (see `monitor`) are kept, so the cache
+        may hold more than `maxsize` PVs while they are monitored.
+
+        Args:
+            keep (str): PV name not to evict, e.g. the PV just cached.
+        """
+        excess = len(self.pvs) - self.maxsize
+        victims = []
+        for name in self.pvs:
+            if len(victims) >= excess:
+                break
+            if name != keep and not self.monitors.get(name):
+                victims.append(name)
+
+        for name in victims:
+            self.reads.pop(name, None)
+            self._stale.discard(name)
+            self.pvs.pop(name).disconnect()
+
+    def monitor(self, pvname, callback, timeout=0):
+        """Add monitor callback to PV, shared with other users of the PV.
+
+        The PV is kept connected until each callback added to it is
+        removed with `unmonitor`, rather than evicted from the cache.
+
+        Args:
+            pvname (str): EPICS PV name.
+            callback (callable): Called on each monitor update, see
+                `epics.PV.add_callback`.
+            timeout (float): Timeout in seconds for connection. Set to 0
+                to not wait, e.g. from a gui.
+
+        Returns:
+            int: Callback index, to pass to `unmonitor`.
+        """
+        with self._lock:
+            pv = self._cached(pvname, monitor=True)
+            self.monitors[pvname] = self.monitors.get(pvname, 0) + 1
+            index = pv.add_callback(callback)
+        if timeout and not pv.connected:
+            pv.wait_for_connection(timeout)
+
+        return index
+
+    def unmonitor(self, pvname, index):
+        """Remove monitor callback added with `monitor`.
+
+        The PV stays connected in the cache, for other users of it, and
+        is evicted as any other PV once it has no monitor callbacks.
+
+        Args:
+            pvname (str): EPICS PV name.
+            index (int): Callback index, returned by `monitor`.
+        """
+        with self._lock:
+            pv = self.pvs.get(pvname)
+            if pv is not None:
+                pv.remove_callback(index)
+            count = self.monitors.get(pvname, 0) - 1
+            if count > 0:
+                self.monitors[pvname] = count
+            else:
+                self.monitors.pop(pvname, None)
+            self._evict()
+
+    def release(self, pvnames):
+        """Disconnect PVs and drop them from the cache.
+
+        PVs with monitor callbacks (see `monitor`) are kept.
+
+        Args:
+            pvnames (list(str)): EPICS PV names.
+        """
+        with self._lock:
+            for pvname in pvnames:
+                if self.monitors.get(pvname):
+                    continue
+                pv = self.pvs.pop(pvname, None)
+                self.reads.pop(pvname, None)
+                self._stale.discard(pvname)
+                if pv is not None:
+                    pv.disconnect()
+
+    def connect(self, pvnames, monitor=False, timeout=5.0):
+        """Connect many PVs at once.
+
+        All channels are created before waiting for any of them, so the
+        name searches run in parallel instead of one after another.
+
+        Args:
+            pvnames (list(str)): EPICS PV names.
+            monitor (bool): Monitor the PVs.
+            timeout (float): Timeout in seconds for all connections.
+
+        Returns:
+            list(epics.PV): PV per name.
+        """
+        pvs = [self._cached(name, monitor) for name in pvnames]
+        _waitConnected(pvs, timeout)
+
+        return pvs
+
+    def get(self, pvname, as_string=False, timeout=5.0):
+        """Return value of PV, like `epics.caget`.
+
+        Monitored PVs are answered from the latest monitor update, unless
+        the PV was written since its last read, in which case the value is
+        read from the IOC to not return the value from before the write.
+
+        Like `epics.caget`, a PV that is not connected yet is waited for.
+
+        Args:
+            pvname (str): EPICS PV name.
+            as_string (bool): Return value as a string.
+            timeout (float): Timeout in seconds, for connecting and for
+                reading.
+
+        Returns:
+            object: PV value, or None if the PV did not connect.
+        """
+        with self._lock:
+            reads = self.reads.get(pvname, 0) + 1
+            monitor = reads >= self.monitor_after
+            if monitor:
+                self.reads.pop(pvname, None)
+            else:
+                self.reads[pvname] = reads
+            use_monitor = pvname not in self._stale
+            self._stale.discard(pvname)
+
+        pv = self.pv(pvname, monitor, timeout)
+        if not pv.connected:
+            return None
+
+        return pv.get(as_string=as_string, timeout=timeout, use_monitor=use_monitor)
+
+    def put(self, pvname, value, wait=False, timeout=60.0):
+        """Write value to PV, like `epics.caput`.
+
+        Like `epics.caput`, a PV that is not connected yet is waited for.
+
+        Args:
+            pvname (str): EPICS PV name.
+            value (object): Value to write.
+            wait (bool): Wait for processing of the write to complete.
+            timeout (float): Timeout in seconds, for connecting and, if
+                waiting, for processing.
+
+        Returns:
+            int: 1 on success, or None if the PV did not connect.
+        """
+        pv = self.pv(pvname, timeout=timeout)
+        if not pv.connected:
+            return None
+
+        with self._lock:
+            if pv.auto_monitor:
+                self._stale.add(pvname)
+
+        return pv.put(value, wait=wait, timeout=timeout)
+
+    def get_many(self, pvnames, timeout=5.0, keep=True, metadata=False):
+        """Return values of many PVs, read in one batched pass.
+
+        All PVs are connected in parallel (see `connect`), and all reads
+        are issued before waiting for any of them to complete, so the
+        cost is about one round trip rather than one per PV. PVs that do
+        not connect cost one timeout for the whole batch, not one each.
+
+        Args:
+            pvnames (list(str)): EPICS PV names.
+            timeout (float): Timeout in seconds, for connecting all PVs
+                and for reading each.
+            keep (bool): Keep the PVs connected in the cache. Set to False
+                for one-off reads of many PVs, e.g. dumps, which would
+                otherwise evict the PVs in use. A batch of more PVs than
+                the cache holds is never kept, as it would evict PVs of
+                the batch before they are read.
+            metadata (bool): Read each value with its timestamp and alarm
+                status, rather than the bare value.
+
+        Returns:
+            list(object): Value per PV, or None if the PV did not connect.
+            With metadata, each value is a dict holding the 'value',
+            'timestamp', 'status' and 'severity' of the PV and its field
+            'type', e.g. 'double'.
+        """
+        if keep and len(set(pvnames)) <= self.maxsize:
+            pvs = self.connect(pvnames, timeout=timeout)
+            new = []
+        else:
+            with self._lock:
+                pvs = [self.pvs.get(name) for name in pvnames]
+            new = []
+            for i, name in enumerate(pvnames):
+                if pvs[i] is None:
+                    pvs[i] = epics.PV(name, auto_monitor=False)
+                    new.append(pvs[i])
+            _waitConnected(pvs, timeout)
+
+        if metadata:
+            values = self._getWithMetadata(pvs, timeout)
+        else:
+            for pv in pvs:
+                if pv.connected:
+                    epics.ca.get(pv.chid, wait=False)  # Issue read only
+
+            values = []
+            for pv in pvs:
+                if pv.connected:
+                    values.append(epics.ca.get_complete(pv.chid, timeout=timeout))
+                else:
+                    values.append(None)
+
+        for pv in new:
+            pv.disconnect()
+
+        return values
+
+    def _getWithMetadata(self, pvs, timeout):
+        """Return value and metadata dict per PV, read in one batched pass."""
+        ftypes = {}
+        for pv in pvs:
+            if pv.connected:
+                ftypes[pv] = epics.ca.promote_type(pv.chid, use_time=True)
+                epics.ca.get_with_metadata(pv.chid, ftype=ftypes[pv], wait=False)
+
+        values = []
+        for pv in pvs:
+            value = None
+            if pv.connected:
+                value = epics.ca.get_complete_with_metadata(
+                    pv.chid, ftype=ftypes[pv], timeout=timeout
+                )
+            if value is not None:
+                value["type"] = pv.type
+            values.append(value)
+
+        return values
+
+    def get_config(self, devices, fields, timeout=5.0):
+        """Return configuration of many devices, read in one batched pass.
+
+        The PVs are read once and not kept in the cache, so a plant with
+        more configuration PVs than the cache holds does not evict PVs of
+        the batch before they are read.
+
+        Args:
+            devices (list(str)): Device PV prefixes.
+            fields (list(str)): Configuration fields, i.e. PV name
+                suffixes, e.g. ["ScaleLOW", "ScaleHIGH"].
+            timeout (float): Timeout in seconds.
+
+        Returns:
+            dict(str, DeviceConfig): Configuration per device.
+        """
+        pvnames = ["{}:{}".format(d, f) for d in devices for f in fields]
+        values = iter(self.get_many(pvnames, timeout, keep=False))
+        configs = {}
+        for device in devices:
+            configs[device] = DeviceConfig(
+                device, {field: next(values) for field in fields}
+            )
+
+        return configs
+
+    def wait(self, conditions, timeout=4.0, tolerance=0.0, mode="all"):
+        """Wait for the values of PVs to satisfy their predicates.
+
+        Rather than polling, the PVs are monitored and this function
+        returns on the first monitor update after which the condition is
+        met.
+
+        Args:
+            conditions (dict(str, callable or object)): Predicate, taking
+                the PV value and returning True when the wait is over, or
+                expected value, per PV name.
+            timeout (float): Timeout in seconds.
+            tolerance (float): Max absolute difference between a numeric
+                PV value and its expected value for them to count as equal.
+            mode (str): "all" to wait for all PVs to satisfy their
+                predicates, or "any" to wait for at least one.
+
+        Returns:
+            WaitResult: Outcome, measured wait time and latest PV values.
+        """
+        start = time.monotonic()
+        test = all if mode == "all" else any
+        predicates = {}
+        for pvname, predicate in conditions.items():
+            if not callable(predicate):
+                predicate = _matches(predicate, tolerance)
+            predicates[pvname] = predicate
+
+        values = {}
+        done = threading.Event()
+        lock = threading.Lock()
+
+        def check():
+            with lock:
+                known = [n for n in predicates if n in values]
+                if mode == "all" and len(known) < len(predicates):
+                    return
+                if test(predicates[n](values[n]) for n in known):
+                    done.set()
+
+        def update(pvname=None, value=None, **kwargs):
+            with lock:
+                values[pvname] = value
+            check()
+
+        callbacks = [(name, self.monitor(name, update)) for name in predicates]
+        pvs = self.connect(list(predicates), monitor=True, timeout=timeout)
+        try:
+            # Start from the current values, unless updated meanwhile
+            for pvname, pv in zip(predicates, pvs):
+                with self._lock:
+                    use_monitor = pvname not in self._stale
+                    self._stale.discard(pvname)
+                if pv.connected:
+                    value = pv.get(timeout=timeout, use_monitor=use_monitor)
+                    with lock:
+                        values.setdefault(pvname, value)
+            check()
+
+            remaining = timeout - (time.monotonic() - start)
+            ok = done.wait(max(remaining, 0))
+        finally:
+            for pvname, index in callbacks:
+                self.unmonitor(pvname, index)
+
+        return WaitResult(ok, time.monotonic() - start, dict(values))
+
+    def close(self):
+        """Disconnect all PVs."""
+        with self._lock:
+            for pv in self.pvs.values():
+                pv.disconnect()
+            self.pvs.clear()
+            self.reads.clear()
+            self.monitors.clear()
+            self._stale.clear()
+
+
+# Process wide PV manager. PVs are disconnected when the process exits.
+manager = PVManager()
+atexit.register(manager.close)
+
+
+def caget(pvname, as_string=False, timeout=5.0):
+    """Return value of PV through the process wide PV manager."""
+    return manager.get(pvname, as_string, timeout)
+
+
+def caput(pvname, value, wait=False, timeout=60.0):
+    """Write value to PV through the process wide PV manager."""
+    return manager.put(pvname, value, wait, timeout)
+
+
+def replace_printf_handler(handler):
+    """Replace the handler of CA library messages, e.g. to quench warnings.
+
+    This loads the CA library, so call it when CA is about to be used,
+    e.g. from a fixture, rather than at import.
+
+    Args:
+        handler (callable): Function taking each message as bytes.
+    """
+    epics.ca.replace_printf_handler(handler)
+
+
+def caget_many(pvnames, timeout=5.0):
+    """Return values of many PVs, see `PVManager.get_many`."""
+    return manager.get_many(pvnames, timeout)
+
+
+def get_config(devices, fields, timeout=5.0):
+    """Return configuration per device, see `PVManager.get_config`."""
+    return manager.get_config(devices, fields, timeout)
+
+
+def wait(pvname, value, timeout=4.0, tolerance=0.0):
+    """Wait for PV value, see `PVManager.wait`.
+
+    Args:
+        pvname (str): EPICS PV name.
+        value (object or callable): Expected PV value, or predicate.
+        timeout (float): Timeout in seconds.
+        tolerance (float): Max difference from expected numeric value.
+
+    Returns:
+        WaitResult: Outcome and measured wait time.
+    """
+    return manager.wait({pvname: value}, timeout, tolerance)
+
+
+def wait_all(conditions, timeout=4.0, tolerance=0.0):
+    """Wait for all PVs to have their expected values, see `PVManager.wait`."""
+    return manager.wait(conditions, timeout, tolerance, mode="all")
+
+
+def wait_any(conditions, timeout=4.0, tolerance=0.0):
+    """Wait for any PV to have its expected value, see `PVManager.wait`."""
+    return manager.wait(conditions, timeout, tolerance, mode="any")
+
+
+def _waitConnected(pvs, timeout):
+    """Wait for PVs to connect, all within one timeout in seconds."""
+    deadline = time.monotonic() + timeout
+    for pv in pvs:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not pv.connected:
+            pv.wait_for_connection(remaining)
+
+
+def _matches(expected, tolerance):
+    """Return predicate checking for a value, numbers within tolerance."""
+
+    def predicate(value):
+        if _isNumber(value) and _isNumber(expected):
+            return abs(value - expected) <= tolerance
+        return value == expected
+
+    return predicate
+
+
+def _isNumber(value):
+    """Return True if value is an int or float, but not a bool."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
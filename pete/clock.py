@@ -0,0 +1,200 @@
+import itertools
+import threading
+import time
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Real seconds a thread advancing a virtual clock waits, at most, for the
+# threads it woke up, or that were notified of work, to wait again
+VIRTUAL_SETTLE_TIMEOUT = 1.0
+
+
+class Clock(object):
+    """Wall clock, i.e. simulated time is real time.
+
+    The simulators take time from a clock, rather than from `time`, so
+    that simulated timing (valve travel, sensor update periods) can be
+    run faster than real time (see `ScaledClock`) or without waiting at
+    all (see `VirtualClock`). Note that the PLC and the IOC run in real
+    time, so waits for them, e.g. in test scripts, are not taken from a
+    clock.
+    """
+
+    def now(self):
+        """Return simulated time in seconds, from an arbitrary start."""
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """Sleep for seconds of simulated time."""
+        time.sleep(seconds)
+
+    def wait(self, condition, timeout=None):
+        """Wait for condition to be notified, or for timeout to pass.
+
+        Like `threading.Condition.wait`, the condition must be held by the
+        caller.
+
+        Args:
+            condition (threading.Condition): Condition to wait for.
+            timeout (float): Seconds of simulated time, or None to wait
+                until notified.
+        """
+        condition.wait(timeout)
+
+    def notify(self, condition):
+        """Notify threads waiting on condition, e.g. of new work.
+
+        Like `threading.Condition.notify_all`, the condition must be held
+        by the caller.
+
+        Args:
+            condition (threading.Condition): Condition waited for.
+        """
+        condition.notify_all()
+
+
+class ScaledClock(Clock):
+    def __init__(self, scale):
+        """Initialize clock running scale times faster than real time.
+
+        Args:
+            scale (float): Simulated seconds per real second, e.g. 10 to
+                travel a valve taking 0.7 s in 0.07 s.
+        """
+        if scale <= 0:
+            raise ValueError("Time scale must be positive")
+
+        self.scale = scale
+        self.start = time.monotonic()
+
+    def now(self):
+        return self.start + (time.monotonic() - self.start) * self.scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+    def wait(self, condition, timeout=None):
+        condition.wait(None if timeout is None else timeout / self.scale)
+
+
+class VirtualClock(Clock):
+    def __init__(self, start=0.0):
+        """Initialize clock that only moves when told to.
+
+        Time stands still until `sleep` or `advance` is called, which move
+        time forward at once, e.g. for offline runs of the simulators.
+        Threads waiting on the clock with a timeout, e.g. the simulation
+        engine, are woken up at each of their deadlines on the way, in
+        order, and time only moves on once they wait again, so simulated
+        timing is exact however fast the host is.
+
+        Work handed over from other threads, e.g. data change
+        notifications, is only run at the time it was handed over if the
+        waiting thread is woken with `notify`: time does not move while a
+        notified thread is yet to wait again.
+
+        Args:
+            start (float): Initial time in seconds.
+        """
+        self._now = start
+        self._lock = threading.Condition()
+        self._waiting = {}  # (deadline, registration) per waiting condition
+        self._notified = set()  # Conditions notified, until waited for again
+        self._registrations = itertools.count()
+
+    def now(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, condition, timeout=None):
+        deadline = None if timeout is None else self._now + timeout
+        with self._lock:
+            self._waiting[condition] = (deadline, next(self._registrations))
+            self._notified.discard(condition)
+            self._lock.notify_all()
+        try:
+            condition.wait()
+        finally:
+            with self._lock:
+                self._waiting.pop(condition, None)
+                self._lock.notify_all()
+
+    def notify(self, condition):
+        with self._lock:
+            if condition in self._waiting:
+                self._notified.add(condition)
+        condition.notify_all()
+
+    def advance(self, seconds):
+        """Move time forward, waking waiting threads at their deadlines.
+
+        Threads notified of work (see `notify`) run it before time moves.
+        """
+        target = self._now + seconds
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: not self._notified, VIRTUAL_SETTLE_TIMEOUT)
+                self._notified.clear()  # Given up on, if still notified
+                deadlines = [
+                    deadline
+                    for deadline, _ in self._waiting.values()
+                    if deadline is not None and deadline <= target
+                ]
+                if not deadlines:
+                    self._now = max(self._now, target)
+                    return
+
+                self._now = max(self._now, min(deadlines))
+                due = [
+                    (condition, registration)
+                    for condition, (deadline, registration) in self._waiting.items()
+                    if deadline is not None and deadline <= self._now
+                ]
+
+            for condition, _ in due:
+                with condition:
+                    condition.notify_all()
+
+            # Let the woken threads run until they wait again
+            with self._lock:
+                self._lock.wait_for(
+                    lambda: all(
+                        self._waiting.get(condition, (None, registration))[1]
+                        != registration
+                        and condition in self._waiting
+                        for condition, registration in due
+                    ),
+                    VIRTUAL_SETTLE_TIMEOUT,
+                )
+
+
+_clock = Clock()
+
+
+def get():
+    """Return the clock in use."""
+    return _clock
+
+
+def use(clock):
+    """Use clock from now on, in the simulators.
+
+    Args:
+        clock (Clock): Clock, e.g. `ScaledClock(10)`.
+    """
+    global _clock
+    _clock = clock
+
+
+def now():
+    """Return simulated time in seconds of the clock in use."""
+    return _clock.now()
+
+
+def sleep(seconds):
+    """Sleep for seconds of simulated time of the clock in use."""
+    _clock.sleep(seconds)
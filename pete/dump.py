@@ -0,0 +1,314 @@
+import argparse
+import csv
+import datetime
+import json
+import sys
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Number of nodes browsed, or PVs read, per batch
+BATCH_SIZE = 1000
+
+# Fields of a record, in csv column order
+FIELDS = [
+    "source",
+    "name",
+    "nodeid",
+    "node_class",
+    "type",
+    "value",
+    "status",
+    "timestamp",
+    "server_timestamp",
+]
+
+# EPICS alarm severity names, by severity
+SEVERITIES = ["NO_ALARM", "MINOR", "MAJOR", "INVALID"]
+
+
+def plcRecords(client, start=None, batch_size=BATCH_SIZE):
+    """Yield a record per node of a PLC's address space.
+
+    The address space is walked depth first, a batch of nodes at a time.
+    Each batch is browsed with batched Browse requests, and the values of
+    all variables among the children are read with one batched read, so
+    the cost is a few round trips per batch rather than per node. Records
+    of a batch are the children of its nodes, node by node, in browse
+    order.
+
+    Values are not kept once yielded. The ids of all nodes seen are, so
+    that a node reachable by several paths is dumped once, thus memory use
+    grows with the number of nodes, though not with their values.
+
+    Args:
+        client (OPCClient): Connected OPCUA client.
+        start (Node): Node to walk from. Defaults to 'Objects'.
+        batch_size (int): Number of nodes browsed per batch.
+
+    Yields:
+        dict: Record with the `FIELDS` of the node.
+    """
+    from opcua import ua
+
+    if start is None:
+        start = client.get_objects_node()
+
+    stack = [(start.nodeid, client.getName(start))]
+    visited = {start.nodeid}
+    while stack:
+        batch = stack[-batch_size:][::-1]  # Top of the stack first
+        del stack[-batch_size:]
+
+        children = []
+        refs = client.browse_many([nodeid for nodeid, _ in batch])
+        for (_, path), node_refs in zip(batch, refs):
+            for ref in node_refs:
+                if ref.NodeId in visited or getattr(ref.NodeId, "ServerIndex", 0):
+                    continue
+                visited.add(ref.NodeId)
+                children.append((ref, path + "/" + ref.BrowseName.to_string()))
+
+        variables = [
+            ref.NodeId for ref, _ in children if ref.NodeClass == ua.NodeClass.Variable
+        ]
+        values = dict(zip(variables, client.read_many(variables)))
+
+        for ref, path in children:
+            record = {
+                "source": "plc",
+                "name": path,
+                "nodeid": ref.NodeId.to_string(),
+                "node_class": ua.NodeClass(ref.NodeClass).name,
+            }
+            dv = values.get(ref.NodeId)
+            if dv is not None:
+                record["type"] = dv.Value.VariantType.name
+                record["value"] = dv.Value.Value
+                record["status"] = dv.StatusCode.name
+                record["timestamp"] = _isoformat(dv.SourceTimestamp)
+                record["server_timestamp"] = _isoformat(dv.ServerTimestamp)
+            yield record
+
+        # Reversed, so that children are walked in browse order
+        for ref, path in reversed(children):
+            if ref.NodeClass in (ua.NodeClass.Object, ua.NodeClass.Variable):
+                stack.append((ref.NodeId, path))
+
+
+def pvRecords(lines, batch_size=BATCH_SIZE, timeout=5.0):
+    """Yield a record per PV in a list of PV names.
+
+    Lines are consumed a batch at a time, and the PVs of a batch are read
+    with one batched read (see `PVManager.get_many`) and released before
+    the next batch, so a PV list file is streamed rather than read into
+    memory. PVs that do not connect cost one timeout per batch, however
+    many of them there are.
+
+    Args:
+        lines (iterable(str)): PV names, one per line, e.g. a file object.
+        batch_size (int): Number of PVs read per batch.
+        timeout (float): Timeout in seconds for connecting the PVs of a
+            batch, and for reading each of them.
+
+    Yields:
+        dict: Record with the `FIELDS` of the PV.
+    """
+    from pete.ca_client import manager
+
+    batch = []
+    for line in lines:
+        pvname = line.strip()
+        if pvname:
+            batch.append(pvname)
+        if len(batch) >= batch_size:
+            yield from _pvBatch(manager, batch, timeout)
+            batch = []
+    yield from _pvBatch(manager, batch, timeout)
+
+
+def _pvBatch(manager, pvnames, timeout):
+    """Yield records of a batch of PVs."""
+    if not pvnames:
+        return
+
+    values = manager.get_many(pvnames, timeout, keep=False, metadata=True)
+    for pvname, value in zip(pvnames, values):
+        record = {"source": "ioc", "name": pvname}
+        if value is None:
+            record["status"] = "Disconnected"
+        else:
+            severity = value.get("severity")
+            record["type"] = value["type"]
+            record["value"] = value["value"]
+            if severity is not None and 0 <= severity < len(SEVERITIES):
+                record["status"] = SEVERITIES[severity]
+            record["timestamp"] = _isoformat(value.get("timestamp"))
+        yield record
+
+
+class JSONLWriter(object):
+    def __init__(self, f):
+        """Initialize writer of records as JSON Lines, one object per line.
+
+        Args:
+            f (file): Text file to write.
+        """
+        self.f = f
+
+    def write(self, record):
+        self.f.write(json.dumps(record, default=_jsonable) + "\n")
+
+
+class CSVWriter(object):
+    def __init__(self, f):
+        """Initialize writer of records as csv, with a header of `FIELDS`.
+
+        Array and structure values are written as JSON, so that they are
+        written in full in one cell.
+
+        Args:
+            f (file): Text file to write.
+        """
+        self.writer = csv.DictWriter(f, FIELDS)
+        self.writer.writeheader()
+
+    def write(self, record):
+        value = record.get("value")
+        if value is not None and not isinstance(value, (str, int, float, bool)):
+            record["value"] = json.dumps(value, default=_jsonable)
+        self.writer.writerow(record)
+
+
+WRITERS = {"jsonl": JSONLWriter, "csv": CSVWriter}
+
+
+def dump(records, f, fmt="jsonl", flush_every=BATCH_SIZE):
+    """Write records to a file, returning the number of records written.
+
+    Args:
+        records (iterable(dict)): Records, e.g. from `plcRecords`.
+        f (file): Text file to write.
+        fmt (str): 'jsonl' or 'csv'.
+        flush_every (int): Number of records between flushes of the file,
+            so that a partial dump is readable if it is interrupted.
+    """
+    writer = WRITERS[fmt](f)
+    n = 0
+    for n, record in enumerate(records, 1):
+        writer.write(record)
+        if n % flush_every == 0:
+            f.flush()
+    f.flush()
+
+    return n
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="dump the PLC tree and/or PV values of pete"
+    )
+    parser.add_argument(
+        "-i",
+        "--ip",
+        type=str,
+        help="plc ip address, or url e.g. opc.tcp://localhost:4841",
+    )
+    parser.add_argument("-p", "--pvlist", type=str, help="file of PV names")
+    parser.add_argument(
+        "-s",
+        "--start",
+        type=str,
+        help="browse path to dump the PLC from, e.g. '0:Objects/3:PLC'",
+    )
+    parser.add_argument(
+        "-f", "--format", choices=sorted(WRITERS), default="jsonl", help="format"
+    )
+    parser.add_argument("-o", "--output", type=str, help="file to write (stdout)")
+    parser.add_argument(
+        "-b", "--batch", type=int, default=BATCH_SIZE, help="nodes or PVs per batch"
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=5.0,
+        help="PV timeout in seconds per batch",
+    )
+    args = parser.parse_args()
+    if not args.ip and not args.pvlist:
+        parser.error("give a PLC ip address (--ip) and/or a PV list (--pvlist)")
+
+    f = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        records = []
+        if args.ip:
+            records.append(_plc(args.ip, args.start, args.batch))
+        if args.pvlist:
+            records.append(_pvs(args.pvlist, args.batch, args.timeout))
+        n = dump(_chain(records), f, args.format, args.batch)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    print("Dumped {} records".format(n), file=sys.stderr)
+
+
+def _plc(ip, start, batch_size):
+    """Yield records of a PLC, connected for as long as it is walked."""
+    from pete.opc_client import OPCClient
+
+    client = OPCClient(ip)
+    client.connect()
+    try:
+        node = client.resolvePath(start.split("/")) if start else None
+        yield from plcRecords(client, node, batch_size)
+    finally:
+        client.disconnect()
+
+
+def _pvs(path, batch_size, timeout):
+    """Yield records of the PVs listed in a file."""
+    with open(path) as lines:
+        yield from pvRecords(lines, batch_size, timeout)
+
+
+def _chain(iterables):
+    for iterable in iterables:
+        yield from iterable
+
+
+def _isoformat(timestamp):
+    """Return ISO 8601 string in UTC of a timestamp.
+
+    Args:
+        timestamp (datetime or float): Naive datetime in UTC, as in OPCUA
+            data values, or posix time, as of Channel Access reads.
+    """
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.replace(tzinfo=datetime.timezone.utc).isoformat()
+
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+def _jsonable(value):
+    """Return JSON serializable form of a value json cannot serialize."""
+    if hasattr(value, "tolist"):
+        return value.tolist()  # numpy arrays and scalars
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if hasattr(value, "to_string"):
+        return value.to_string()  # opcua node ids, qualified names
+    if hasattr(value, "__dict__"):
+        return {k: v for k, v in vars(value).items() if not k.startswith("_")}
+
+    return str(value)
+
+
+if __name__ == "__main__":
+    run()
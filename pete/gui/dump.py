@@ -0,0 +1,119 @@
+from PyQt5 import QtCore
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Number of values read per batch while dumping
+BATCH_SIZE = 1000
+
+
+class DumpThread(QtCore.QThread):
+    """Thread dumping a tree and its values to a text file.
+
+    Rows are consumed in batches. The values of a batch are read with one
+    batched read, and the batch is written to the file before the next
+    one is read, so memory use does not grow with the size of the tree.
+    """
+
+    progress = QtCore.pyqtSignal(int, int)  # Values read, values in total
+    done = QtCore.pyqtSignal(object)  # Exception, or None on success
+
+    def __init__(self, path, rows, read_many, total, batch_size=BATCH_SIZE):
+        """Initialize dump.
+
+        Args:
+            path (str): File to write.
+            rows (iterable(tuple(str, object))): Text and value key of each
+                line, top to bottom. The key is None if the row has no
+                value. A generator is consumed on the thread.
+            read_many (callable): Function taking a list of keys and
+                returning the text to append to the line of each key.
+            total (int): Number of keys, for the progress.
+            batch_size (int): Number of keys per batched read.
+        """
+        super().__init__()
+        self.path = path
+        self.rows = rows
+        self.read_many = read_many
+        self.total = total
+        self.batch_size = batch_size
+        self.n_read = 0
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop dumping after the current batch."""
+        self.cancelled = True
+
+    def run(self):
+        try:
+            with open(self.path, "w") as f:
+                batch = []
+                n_keys = 0
+                for text, key in self.rows:
+                    if self.cancelled:
+                        break
+                    batch.append((text, key))
+                    n_keys += key is not None
+                    if n_keys >= self.batch_size:
+                        self.writeBatch(f, batch)
+                        batch = []
+                        n_keys = 0
+                self.writeBatch(f, batch)
+        except Exception as e:
+            self.done.emit(e)
+        else:
+            self.done.emit(None)
+
+    def writeBatch(self, f, batch):
+        """Read the values of a batch of rows and write the rows."""
+        keys = [key for _, key in batch if key is not None]
+        values = dict(zip(keys, self.read_many(keys))) if keys else {}
+        f.writelines(text + values.get(key, "") + "\n" for text, key in batch)
+        f.flush()
+
+        self.n_read += len(keys)
+        self.progress.emit(self.n_read, self.total)
+
+
+def start(thread, button, bar):
+    """Start dump thread, showing its progress in a progress bar.
+
+    The dump button cancels the dump until it is done, see `cancel`.
+
+    Args:
+        thread (DumpThread): Dump to start.
+        button (QPushButton): Button starting dumps.
+        bar (QProgressBar): Progress bar, hidden when no dump is running.
+    """
+    text = button.text()
+    button.setText("Cancel Dump")
+    bar.setMaximum(max(thread.total, 1))
+    bar.setValue(0)
+    bar.show()
+
+    def finish(error):
+        button.setText(text)
+        bar.hide()
+        if error is not None:
+            print(error)
+
+    thread.progress.connect(lambda n, total: bar.setValue(n))
+    thread.done.connect(finish)
+    thread.start()
+
+
+def cancel(thread):
+    """Cancel dump thread, if running, after its current batch.
+
+    Args:
+        thread (DumpThread): Dump, or None if none was started.
+
+    Returns:
+        bool: True if the dump was running.
+    """
+    if thread is None or not thread.isRunning():
+        return False
+
+    thread.cancel()
+    return True
@@ -1,11 +1,19 @@
 import os
 
 # import subprocess
-import re
 
-import epics
-from epics import caget, caput
-from PyQt5 import QtWidgets, QtGui
+from PyQt5 import QtCore, QtWidgets, QtGui
+
+from pete.ca_client import caget, caput, manager, replace_printf_handler
+from pete.gui import dump
+from pete.gui.dump import DumpThread
+from pete.gui.live import (
+    LiveUpdater,
+    VALUE_COLUMN,
+    formatTimestamp,
+    formatValue,
+)
+from pete.pv_list import GLOB_CHARS, PVTrie
 
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
@@ -17,86 +25,194 @@ def my_printf_handler(output_str):
     # TODO write output_str to some logfile
 
 
-epics.ca.replace_printf_handler(my_printf_handler)
+class IOCModel(QtCore.QAbstractItemModel):
+    def __init__(self, trie):
+        """Initialize model of the PVs in a PV trie.
 
+        The model shows the trie as a tree, or, while filtering, the
+        matching PV names as a flat list (see `setMatches`). Rows are
+        looked up in the trie when the view asks for them, so no objects
+        are created per PV, and the view only asks for visible rows.
 
-class IOCTree(QtWidgets.QTreeWidget):
-    def __init__(self, pvlist, parent=None):
+        Filtering is done by the model rather than by a
+        QSortFilterProxyModel. A proxy asks `filterAcceptsRow`, a Python
+        call, of every row of the source model on each change of the
+        pattern, and filtering a tree recursively would build every level
+        of the trie, whereas `PVTrie.search` checks a flat list of
+        lowercased names, narrowing down the previous matches while a
+        pattern is typed. Rows need no sorting, as the trie lists names
+        sorted.
+
+        Args:
+            trie (PVTrie): PV names.
+        """
         super().__init__()
-        self.pvlist = pvlist
-        self.setup()
+        self.trie = trie
+        self.matches = None  # Positions in `trie.names()` shown while filtering
+        self.error = None  # Message shown if the PV list could not be read
+        self.values = {}  # (value, timestamp) strings shown per PV name
+
+    def setTrie(self, trie):
+        """Show PV names of another PV trie, e.g. once the list is known."""
+        self.beginResetModel()
+        self.trie = trie
+        self.matches = None
+        self.endResetModel()
+
+    def setMatches(self, matches):
+        """Show PV names, by position in `trie.names()`, or the full tree.
+
+        Args:
+            matches (list(int)): Positions of the PV names to show, e.g.
+                from `PVTrie.search`, or None to show the full tree.
+        """
+        self.beginResetModel()
+        self.matches = matches
+        self.endResetModel()
+
+    def node(self, index):
+        """Return trie node of model index, in tree mode."""
+        if index.isValid():
+            return index.internalPointer()
+
+        return self.trie.root
+
+    def pvName(self, index):
+        """Return PV name of model index, or None if no PV."""
+        if not index.isValid():
+            return None
+        if self.matches is not None:
+            return self.trie.names()[self.matches[index.row()]]
 
-    def setup(self):
-        self.setExpandsOnDoubleClick(True)
-        self.setAnimated(True)
-        self.setColumnCount(1)
-        self.setHeaderLabel("IOC")
-        root = None
-        devices = {}
-        topLevelItems = []
-        try:
-            lines = []
-            if type(self.pvlist) is str:
-                with open(self.pvlist) as f:
-                    lines = f.readlines()
-            else:
-                lines = self.pvlist
+        node = index.internalPointer()
+        return node.path() if node.is_pv else None
 
-            for line in lines:
-                if line.endswith("\n") or line.endswith("\r"):
-                    line = line[:-1]
+    def key(self, index):
+        """Return PV name of model index, or None, see `LiveUpdater`."""
+        return self.pvName(index)
 
-                split_line = re.split(":", line)
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if self.matches is not None:
+            if parent.isValid() or not 0 <= row < len(self.matches):
+                return QtCore.QModelIndex()
+            return self.createIndex(row, column)
 
-                root = QtWidgets.QTreeWidgetItem([split_line[0]])
+        rows = self.node(parent).sortedChildren()
+        if 0 <= row < len(rows):
+            return self.createIndex(row, column, rows[row])
 
-                if root.text(0) not in topLevelItems:
-                    self.addTopLevelItem(root)
-                    topLevelItems.append(root.text(0))
+        return QtCore.QModelIndex()
 
-                root = self.topLevelItem(topLevelItems.index(root.text(0)))
+    def parent(self, index):
+        if not index.isValid() or self.matches is not None:
+            return QtCore.QModelIndex()
 
-                # Check if this is autosave stuff
-                if split_line[0][-3:] == "-as":
-                    field = split_line[1]
-                    leaf = QtWidgets.QTreeWidgetItem([field])
-                    root.addChild(leaf)
-                    continue
+        parent = index.internalPointer().parent
+        if parent is self.trie.root:
+            return QtCore.QModelIndex()
 
-                if len(split_line) > 2:
-                    dev = split_line[1]
-                    field = split_line[2]
-                else:
-                    dev = split_line[0]
-                    field = split_line[1]
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        if self.matches is not None:
+            return 0 if parent.isValid() else len(self.matches)
 
-                if dev not in devices:
-                    devices[dev] = QtWidgets.QTreeWidgetItem([dev])
-                    root.addChild(devices[dev])
+        return len(self.node(parent).sortedChildren())
 
-                leaf = QtWidgets.QTreeWidgetItem([field])
-                devices[dev].addChild(leaf)
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 3
 
-            self.sortItems(0, 0)
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        if self.matches is not None:
+            return not parent.isValid()
 
+        return self.node(parent).hasChildren()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        if index.column() > 0:
+            value = self.values.get(self.pvName(index))
+            return None if value is None else value[index.column() - VALUE_COLUMN]
+        if self.matches is not None:
+            return self.trie.names()[self.matches[index.row()]]
+
+        return index.internalPointer().name
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation != QtCore.Qt.Horizontal or role != QtCore.Qt.DisplayRole:
+            return None
+        if section > 0:
+            return ["Value", "Timestamp"][section - VALUE_COLUMN]
+        if self.error is not None:
+            return self.error
+        if self.matches is not None:
+            return "IOC ({} of {} PVs)".format(len(self.matches), len(self.trie))
+
+        return "IOC"
+
+
+class IOCTree(QtWidgets.QTreeView):
+    def __init__(self, pvlist, parent=None):
+        super().__init__()
+        self.pvlist = pvlist
+        self.trie = PVTrie()
+        self.setup()
+
+    def setup(self):
+        """Parse PV list into a prefix trie and show it.
+
+        The PV list is streamed if it is a file (see `PVTrie`). Rows have
+        uniform heights, so the view only lays out the visible rows.
+        """
+        self.setExpandsOnDoubleClick(True)
+        self.setAnimated(True)
+        self.setUniformRowHeights(True)
+        error = None
+        try:
+            if type(self.pvlist) is str:
+                self.trie = PVTrie.fromFile(self.pvlist)
+            else:
+                self.trie = PVTrie.fromLines(self.pvlist)
         except Exception as e:
-            root = QtWidgets.QTreeWidgetItem([str(e)])
-            self.addTopLevelItem(root)
+            error = str(e)
+
+        self.setModel(IOCModel(self.trie))
+        self.model().error = error
+
+    def setPVs(self, pvlist):
+        """Show another PV list, keeping the model."""
+        self.pvlist = pvlist
+        self.trie = PVTrie.fromLines(pvlist)
+        self.model().setTrie(self.trie)
 
 
 class IOC(QtWidgets.QWidget):
-    def __init__(self, pvlist, parent=None):
+    def __init__(self, pvlist, rate=10, parent=None):
         super().__init__()
+        replace_printf_handler(my_printf_handler)
         self.tree = IOCTree(pvlist)
         self.layout = QtWidgets.QVBoxLayout(self)
+        self.search = QtWidgets.QLineEdit()
+        self.last_pattern = ""
         self.sp = QtWidgets.QLineEdit()
         self.subject = QtWidgets.QLineEdit()
         self.feedback = QtWidgets.QLabel()
         self.dump_path = QtWidgets.QLineEdit()
         self.dump = QtWidgets.QPushButton("Dump Tree")
+        self.progress = QtWidgets.QProgressBar()
+        self.dump_thread = None
+
+        self.monitors = {}  # Callback index per monitored PV name
+        self.latest = {}  # Latest (value, timestamp) per monitored PV name
 
         self.setup()
         self.assignEvents()
+        self.live = LiveUpdater(
+            self.tree, self.monitorValues, self.unmonitorValues, self.latest.get, rate
+        )
 
     def setup(self):
         self.layout.setContentsMargins(0, 0, 0, 0)
@@ -129,15 +245,53 @@ class IOC(QtWidgets.QWidget):
         # Add to layout
         self.layout.addWidget(self.subject)
         self.layout.addWidget(spfb)
+        self.progress.hide()
         self.layout.addWidget(dt)
+        self.layout.addWidget(self.progress)
+        self.layout.addWidget(self.search)
         self.layout.addWidget(self.tree)
 
     def assignEvents(self):
         self.sp.returnPressed.connect(self.applyVal)
         self.dump.clicked.connect(self.dumpData)
-        self.tree.itemSelectionChanged.connect(self.setFeedback)
+        self.search.textChanged.connect(self.filterTree)
+        self.tree.selectionModel().currentChanged.connect(self.setFeedback)
+
+    def filterTree(self, pattern):
+        """Show the PVs matching a substring or glob pattern.
+
+        While a substring is typed, each search only goes through the
+        matches of the previous one.
+        """
+        model = self.tree.model()
+        within = None
+        if (
+            self.last_pattern
+            and pattern.startswith(self.last_pattern)
+            and not any(c in pattern for c in GLOB_CHARS)
+        ):
+            within = model.matches
+        self.last_pattern = pattern
+
+        if pattern:
+            model.setMatches(self.tree.trie.search(pattern, within))
+        else:
+            model.setMatches(None)
+
+    def setPVs(self, pvlist):
+        """Show another list of PV names, keeping the search pattern."""
+        self.tree.setPVs(pvlist)
+        self.last_pattern = ""
+        self.filterTree(self.search.text())
+
+    def dumpData(self):
+        """Dump the tree to file on a thread, showing its progress.
+
+        While a dump is running, the dump button cancels it instead.
+        """
+        if dump.cancel(self.dump_thread):
+            return
 
-    def dumpData(self, root=None, indent=0, f=None):
         path = self.dump_path.text()
         if not os.path.isdir(os.path.dirname(path)):
             msg_box = QtWidgets.QMessageBox()
@@ -155,41 +309,54 @@ class IOC(QtWidgets.QWidget):
             msg_box.exec()
             return
 
-        if f is None:  # If no file is open, open it
-            with open(path, "w") as f:
-                n_roots = self.tree.topLevelItemCount()
-                for i in range(n_roots):
-                    self.dumpData(self.tree.topLevelItem(i), 0, f)
-        else:  # If file is open, get to work
-            n_children = root.childCount()
-            pv = self.getPV(root)
-            val = self.getVal(pv)
+        def rows():
+            roots = self.tree.trie.root.sortedChildren()
+            stack = [(node, 0) for node in reversed(roots)]
+            while stack:
+                node, indent = stack.pop()
+                yield " " * indent + node.name, node.path() if node.is_pv else None
+                stack.extend((c, indent + 4) for c in reversed(node.sortedChildren()))
+
+        def read_many(pvnames):
+            vals = []
+            for val in manager.get_many(pvnames, keep=False):
+                if val is None:
+                    vals.append("")
+                else:
+                    vals.append(", " + str(val).replace("\n", ""))
+            return vals
 
-            if val is None:
-                val = ""
-            else:
-                val = str(val).replace("\n", "")
-                val = ", " + val
+        # Dump on a thread, reading the values in batches
+        self.dump_thread = DumpThread(path, rows(), read_many, len(self.tree.trie))
+        dump.start(self.dump_thread, self.dump, self.progress)
 
-            f.write(" " * indent + root.text(0) + val + "\n")
+    def monitorValues(self, pvnames):
+        """Start monitoring PVs, without waiting for them to connect."""
+        for pvname in pvnames:
+            if pvname not in self.monitors:
+                self.monitors[pvname] = manager.monitor(pvname, self.storeValue)
 
-            for i in range(n_children):
-                self.dumpData(root.child(i), indent + 4, f)
+    def unmonitorValues(self, pvnames):
+        """Stop monitoring PVs.
 
-    def getPV(self, tree_item=None):
-        if tree_item is None:
-            tree_item = self.tree.currentItem()
+        Only the callbacks added by the view are removed, as the PVs are
+        shared with other users of the PV manager, e.g. tests and waits.
+        """
+        for pvname in pvnames:
+            index = self.monitors.pop(pvname, None)
+            if index is not None:
+                manager.unmonitor(pvname, index)
+            self.latest.pop(pvname, None)
 
-        if tree_item is None or tree_item.childCount() != 0:  # Item is not a leaf
-            return None
+    def storeValue(self, pvname=None, value=None, timestamp=None, **kwargs):
+        """CA monitor callback, keeping the latest value until shown."""
+        self.latest[pvname] = formatValue(value), formatTimestamp(timestamp)
 
-        family = []
-        child = tree_item
-        while child is not None:
-            family.insert(0, child.text(0))
-            child = child.parent()
+    def getPV(self, index=None):
+        if index is None:
+            index = self.tree.currentIndex()
 
-        return ":".join(family)
+        return self.tree.model().pvName(index)
 
     def getVal(self, pv):
         if pv is None:
@@ -202,7 +369,7 @@ class IOC(QtWidgets.QWidget):
         except Exception:
             return ""
 
-    def setFeedback(self):
+    def setFeedback(self, *args):
         pv = self.getPV()
 
         if pv is None:
@@ -221,6 +388,11 @@ class IOC(QtWidgets.QWidget):
             except Exception as e:
                 print(e)
 
+    def disconnect(self):
+        if dump.cancel(self.dump_thread):
+            self.dump_thread.wait()
+        self.live.stop()
+
     def setTheme(self, colors):
         self.tree.setStyleSheet(
             """
@@ -299,6 +471,21 @@ class IOC(QtWidgets.QWidget):
             + """;
             """
         )
+        self.search.setPlaceholderText("search, e.g. TT-001 or *:Proc-TT-00?:HIHI")
+        self.search.setFont(QtGui.QFont("Monospace", 10))
+        self.search.setStyleSheet(
+            """
+            color: """
+            + colors["font"]
+            + """;
+            border: 2px solid """
+            + colors["border"]
+            + """;
+            background-color: """
+            + colors["edit"]
+            + """;
+            """
+        )
         self.sp.setPlaceholderText("set value")
         self.sp.setFont(QtGui.QFont("Monospace", 10))
         self.sp.setStyleSheet(
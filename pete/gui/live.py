@@ -0,0 +1,145 @@
+import datetime
+
+from PyQt5 import QtCore
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Column of the value and of the timestamp in the tree models
+VALUE_COLUMN = 1
+TIMESTAMP_COLUMN = 2
+
+
+class LiveUpdater(QtCore.QObject):
+    def __init__(self, view, monitor, unmonitor, read, rate=10):
+        """Initialize updater of the value columns of the visible rows.
+
+        Only the rows in view are monitored. Monitoring is started and
+        stopped as rows scroll in and out of view, so the number of
+        monitored values is bounded by the height of the view. Monitor
+        updates are not shown as they arrive, but coalesced on a timer,
+        so that a fast changing value costs at most one repaint per tick.
+
+        The model of the view shall have a `values` dict, holding the
+        (value, timestamp) strings shown per key, and a `key` method
+        returning the key of a model index, or None if the row has no
+        value.
+
+        Args:
+            view (QTreeView): Tree view.
+            monitor (callable): Function taking a list of keys to start
+                monitoring. It must not block.
+            unmonitor (callable): Function taking a list of keys to stop
+                monitoring. It must not block.
+            read (callable): Function returning the latest (value,
+                timestamp) strings of a monitored key, or None if none
+                received yet. It must not block.
+            rate (float): Updates per second. Rates above 1000 are
+                clamped to one update per millisecond.
+
+        Raises:
+            ValueError: If rate is not a positive number.
+        """
+        if not 0 < rate < float("inf"):
+            raise ValueError("Update rate must be positive, not {}".format(rate))
+
+        super().__init__()
+        self.view = view
+        self.monitor = monitor
+        self.unmonitor = unmonitor
+        self.read = read
+        self.rows = {}  # Persistent model index per monitored key
+        self.dirty = True  # Visible rows changed since last tick
+
+        model = view.model()
+        view.verticalScrollBar().valueChanged.connect(self.markDirty)
+        view.expanded.connect(self.markDirty)
+        view.collapsed.connect(self.markDirty)
+        model.modelReset.connect(self.markDirty)
+        model.rowsInserted.connect(self.markDirty)
+        model.layoutChanged.connect(self.markDirty)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.tick)
+        self.timer.start(max(1, int(1000 / rate)))
+
+    def markDirty(self, *args):
+        self.dirty = True
+
+    def visibleIndexes(self):
+        """Yield model indexes of the rows in view, top to bottom."""
+        height = self.view.viewport().height()
+        index = self.view.indexAt(QtCore.QPoint(0, 0))
+        while index.isValid() and self.view.visualRect(index).top() < height:
+            yield index
+            index = self.view.indexBelow(index)
+
+    def updateMonitors(self):
+        """Monitor the rows in view, and stop monitoring other rows."""
+        model = self.view.model()
+        visible = {}
+        for index in self.visibleIndexes():
+            key = model.key(index)
+            if key is not None:
+                visible[key] = QtCore.QPersistentModelIndex(
+                    index.sibling(index.row(), 0)
+                )
+
+        gone = [key for key in self.rows if key not in visible]
+        new = [key for key in visible if key not in self.rows]
+        if gone:
+            self.unmonitor(gone)
+            for key in gone:
+                model.values.pop(key, None)
+        if new:
+            self.monitor(new)
+        self.rows = visible
+
+    def tick(self):
+        """Show the values that changed since the last tick."""
+        if self.dirty:
+            self.dirty = False
+            self.updateMonitors()
+
+        model = self.view.model()
+        for key, index in self.rows.items():
+            current = self.read(key)
+            if current is None or current == model.values.get(key):
+                continue
+
+            model.values[key] = current
+            if index.isValid():
+                row = index.row()
+                first = index.sibling(row, VALUE_COLUMN)
+                last = index.sibling(row, TIMESTAMP_COLUMN)
+                model.dataChanged.emit(first, last)
+
+    def stop(self):
+        """Stop updating and monitoring."""
+        self.timer.stop()
+        if self.rows:
+            self.unmonitor(list(self.rows))
+        self.rows = {}
+
+
+def formatValue(value):
+    """Return value as a single line string."""
+    return str(value).replace("\n", "")
+
+
+def formatTimestamp(timestamp):
+    """Return local time string, with milliseconds, of a timestamp.
+
+    Args:
+        timestamp (datetime or float): Naive datetime in UTC, as in OPCUA
+            data values, or posix time, as of Channel Access monitors.
+    """
+    if timestamp is None:
+        return ""
+    if isinstance(timestamp, datetime.datetime):
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[
+        :-3
+    ]
@@ -1,42 +1,20 @@
 import argparse
-import os
 import sys
 
-from PyQt5 import QtWidgets, QtGui
-
-from .plc import PLC
-from .ioc import IOC
-
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 
-class View(QtWidgets.QMainWindow):
-    def __init__(self):
-        super().__init__()
-        self.layout = QtWidgets.QHBoxLayout()
-
-        self.initUI()
-
-    def initUI(self):
-        self.resize(1024, 768)
-        self.setMinimumSize(800, 450)
-        widget = QtWidgets.QWidget(self)
-        widget.setLayout(self.layout)
-        self.setCentralWidget(widget)
-        self.setWindowTitle("petenv")
-        app_dir = os.path.dirname(os.path.realpath(__file__))
-        self.setWindowIcon(QtGui.QIcon(app_dir + os.path.sep + "icon.png"))
-
-    def addWidget(self, widget):
-        self.layout.addWidget(widget)
-
-    def setTheme(self, colors):
-        self.setStyleSheet("background-color: " + colors["window"] + ";")
+def main(ip, pvlist, rate=10):
+    # PyQt5, opcua and pyepics are imported here rather than at the top of
+    # the module, so that e.g. '--help' and argument errors are immediate.
+    from PyQt5 import QtWidgets
 
+    from pete.gui.ioc import IOC
+    from pete.gui.plc import PLC
+    from pete.gui.window import View
 
-def main(ip, pvlist):
     # Preamble
     colors = {
         "window": "rgb(40, 40, 40)",
@@ -55,17 +33,19 @@ def main(ip, pvlist):
     w.setTheme(colors)
 
     # PLC
-    plc = PLC(ip)
+    plc = PLC(ip, rate)
     plc.setTheme(colors)
     app.aboutToQuit.connect(plc.disconnect)
     w.addWidget(plc)
-    if not pvlist:
-        pvlist = plc.getPVs()
 
-    # IOC
-    ioc = IOC(pvlist)
+    # IOC, showing the PVs of the PLC once its snapshot is loaded if no PV
+    # list is given
+    ioc = IOC(pvlist or [], rate)
     ioc.setTheme(colors)
+    app.aboutToQuit.connect(ioc.disconnect)
     w.addWidget(ioc)
+    if not pvlist:
+        plc.loaded.connect(lambda: ioc.setPVs(plc.getPVs()))
 
     # Postamble
     w.show()
@@ -73,13 +53,30 @@ def main(ip, pvlist):
     sys.exit(app.exec_())
 
 
+def positiveRate(text):
+    """Parse an update rate, which must be a positive number per second."""
+    try:
+        rate = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid rate: {!r}".format(text))
+    if not 0 < rate < float("inf"):
+        raise argparse.ArgumentTypeError("rate must be positive: {!r}".format(text))
+
+    return rate
+
+
 def run():
     parser = argparse.ArgumentParser(description="plc/epics gui")
-    parser.add_argument("ip", type=str, help="plc ip address")
+    parser.add_argument(
+        "ip", type=str, help="plc ip address, or url e.g. opc.tcp://localhost:4841"
+    )
     parser.add_argument("-p", "--pvs", type=str, help="pv list")
+    parser.add_argument(
+        "-r", "--rate", type=positiveRate, default=10, help="value updates per second"
+    )
     # parser.add_argument("pvs", type=str, help="path to pv list")
     args = parser.parse_args()
-    main(args.ip, args.pvs)
+    main(args.ip, args.pvs, args.rate)
 
 
 if __name__ == "__main__":
@@ -1,47 +1,256 @@
 import os
+import queue
 
-from PyQt5 import QtWidgets, QtGui
-
-from petenv.opc_client import OPCClient
 from opcua import ua
+from PyQt5 import QtCore, QtWidgets, QtGui
+
+from pete.gui import dump
+from pete.gui.dump import DumpThread
+from pete.gui.live import (
+    LiveUpdater,
+    VALUE_COLUMN,
+    formatTimestamp,
+    formatValue,
+)
+from pete.opc_client import OPCClient
+from pete.snapshot import Snapshot
 
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 
-class PLCTree(QtWidgets.QTreeWidget):
-    def __init__(self, client, parent=None):
+class Worker(QtCore.QThread):
+    """Thread running network calls off the GUI thread.
+
+    Tasks are run one at a time, in order. The callback of each task is
+    called on the GUI thread with the task's result and the exception it
+    raised, if any.
+    """
+
+    done = QtCore.pyqtSignal(object, object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.tasks = queue.Queue()
+        self.done.connect(self.finish)
+
+    def submit(self, fn, callback):
+        """Queue function to run, and callback(result, error) to call."""
+        self.tasks.put((fn, callback))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+
+            fn, callback = task
+            try:
+                result, error = fn(), None
+            except Exception as e:
+                result, error = None, e
+            self.done.emit(callback, result, error)
+
+    def finish(self, callback, result, error):
+        callback(result, error)
+
+    def stop(self):
+        """Stop thread after the queued tasks."""
+        self.tasks.put(None)
+        self.wait()
+
+
+class PLCItem(object):
+    """Node of the PLC tree model."""
+
+    def __init__(self, nodeid, name, node_class, parent, row=0):
+        self.nodeid = nodeid
+        self.name = name
+        self.node_class = node_class
+        self.parent = parent
+        self.row = row  # Row below parent
+        self.children = []
+        self.fetched = False  # True once the children are known
+        self.fetching = False  # True while the children are being browsed
+
+    def path(self):
+        """Return browse path from the root node, e.g. ['0:Objects']."""
+        path = []
+        item = self
+        while item.parent is not None and item.parent.parent is not None:
+            path.insert(0, item.name)
+            item = item.parent
+
+        return path
+
+
+class PLCModel(QtCore.QAbstractItemModel):
+    def __init__(self, client, snapshot=None, worker=None):
+        """Initialize lazily populated model of the PLC address space.
+
+        Children of a node are only looked up when the node is expanded
+        (see `canFetchMore` and `fetchMore`). They are taken from the
+        snapshot if it holds the node, and otherwise browsed by the
+        worker thread and streamed into the model, so that the GUI never
+        waits for the network.
+
+        Args:
+            client (OPCClient): Connected OPCUA client, or None.
+            snapshot (Snapshot): Snapshot of the PLC address space.
+            worker (Worker): Thread to browse on.
+        """
         super().__init__()
         self.client = client
-        self.setup()
-
-    def setup(self):
-        if self.client is None:
-            root = QtWidgets.QTreeWidgetItem(["Could not connect to plc"])
+        self.snapshot = snapshot
+        self.worker = worker
+        self.root = PLCItem(None, "", None, None)  # Invisible root item
+        self.root.fetched = True
+        self.items = {}  # Item per node id
+        self.values = {}  # (value, timestamp) strings shown per node id
+
+        if client is None:
+            item = PLCItem(None, "Could not connect to plc", None, self.root)
+            item.fetched = True
         else:
-            parent = self.client.get_root_node()
-            root = QtWidgets.QTreeWidgetItem([self.client.getName(parent)])
-            self.buildTree(root, parent)
+            node = client.get_root_node()
+            item = PLCItem(node.nodeid, "0:Root", ua.NodeClass.Object, self.root)
+            self.items[node.nodeid] = item
+        self.root.children.append(item)
 
-        self.setExpandsOnDoubleClick(True)
-        self.setAnimated(True)
-        self.setColumnCount(1)
-        self.setHeaderLabel("PLC")
-        # self.header().hide()
+    def item(self, index):
+        """Return item of model index."""
+        if index.isValid():
+            return index.internalPointer()
+
+        return self.root
+
+    def indexOf(self, item):
+        """Return model index of item."""
+        if item is self.root:
+            return QtCore.QModelIndex()
+
+        return self.createIndex(item.row, 0, item)
+
+    def key(self, index):
+        """Return node id of a variable's model index, or None."""
+        item = index.internalPointer() if index.isValid() else None
+        if item is None or item.node_class != ua.NodeClass.Variable:
+            return None
+
+        return item.nodeid
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        item = self.item(parent)
+        if 0 <= row < len(item.children):
+            return self.createIndex(row, column, item.children[row])
+
+        return QtCore.QModelIndex()
+
+    def parent(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+
+        return self.indexOf(index.internalPointer().parent)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
 
-        self.addTopLevelItem(root)
+        return len(self.item(parent).children)
 
-    def buildTree(self, branch, parent, level=0):
-        children = parent.get_children()
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 3
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        if index.column() == 0:
+            return index.internalPointer().name
+
+        value = self.values.get(self.key(index))
+        if value is None:
+            return None
+
+        return value[index.column() - VALUE_COLUMN]
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return ["PLC", "Value", "Timestamp"][section]
+
+        return None
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        item = self.item(parent)
+        return bool(item.children) or not item.fetched
+
+    def canFetchMore(self, parent):
+        item = self.item(parent)
+        return not item.fetched and not item.fetching
+
+    def fetchMore(self, parent):
+        """Look up children of item, from the snapshot or by browsing."""
+        item = self.item(parent)
+        item.fetching = True
+
+        index = None
+        if self.snapshot is not None:
+            index = self.snapshot.index(item.nodeid.to_string())
+        if index is not None:
+            children = []
+            for c in self.snapshot.children(index):
+                nodeid = ua.NodeId.from_string(self.snapshot.nodeid(c))
+                children.append(
+                    (nodeid, self.snapshot.name(c), self.snapshot.node_class(c))
+                )
+            self.addChildren(item, children)
+            return
+
+        def browse():
+            refs = self.client.browse_many([item.nodeid])[0]
+            return [(r.NodeId, r.BrowseName.to_string(), r.NodeClass) for r in refs]
+
+        def browsed(children, error):
+            if error is not None:
+                print(error)
+                item.fetching = False  # Retried on next expansion
+                return
+            self.addChildren(item, children)
+
+        self.worker.submit(browse, browsed)
+
+    def addChildren(self, item, children):
+        """Add children, as (node id, browse name, node class), to item."""
+        item.fetching = False
+        item.fetched = True
+        index = self.indexOf(item)
         if not children:
+            self.dataChanged.emit(index, index)  # No expand indicator anymore
             return
 
-        for c in children:
-            leaf = QtWidgets.QTreeWidgetItem([self.client.getName(c)])
-            branch.addChild(leaf)
+        self.beginInsertRows(index, 0, len(children) - 1)
+        for row, (nodeid, name, node_class) in enumerate(children):
+            child = PLCItem(nodeid, name, node_class, item, row)
+            item.children.append(child)
+            self.items[nodeid] = child
+        self.endInsertRows()
 
-    def dumpData(self, path, root=None, indent=0, f=None, node=None):
+
+class PLCTree(QtWidgets.QTreeView):
+    def __init__(self, client, snapshot=None, worker=None, parent=None):
+        super().__init__()
+        self.client = client
+        self.setModel(PLCModel(client, snapshot, worker))
+        self.setup()
+
+    def setup(self):
+        self.setExpandsOnDoubleClick(True)
+        self.setAnimated(True)
+        self.setUniformRowHeights(True)
+        # self.header().hide()
+
+    def dumpData(self, path):
+        """Return thread dumping the tree, or None if the path is bad."""
         if not os.path.isdir(os.path.dirname(path)):
             msg_box = QtWidgets.QMessageBox()
             msg_box.setStyleSheet(
@@ -56,61 +265,84 @@ class PLCTree(QtWidgets.QTreeWidget):
             msg_box.setInformativeText(os.path.dirname(path))
             msg_box.setWindowTitle("Bad path")
             msg_box.exec()
-            return
-
-        if f is None:  # If no file is open, open it
-            with open(path, "w") as f:
-                self.dumpData(path, root, 0, f)
-        else:  # If file is open, get to work
-            # First time dumpData is called, the node should be the root
-            if root is None:
-                root = self.topLevelItem(0)
-                node = self.client.get_root_node()
-
-            n_children = root.childCount()
-            val = ""
-
-            node_children = node.get_children()
-            if not node_children:
-                try:
-                    val = ", " + str(node.get_value())
+            return None
+
+        # Dump the items in the tree, reading the values of all variables
+        # without children in batches, on a thread.
+        rows = []
+        stack = [(item, 0) for item in reversed(self.model().root.children)]
+        while stack:
+            item, indent = stack.pop()
+            key = None
+            if item.node_class == ua.NodeClass.Variable and not item.children:
+                key = item.nodeid
+            rows.append((" " * indent + item.name, key))
+            stack.extend((c, indent + 2) for c in reversed(item.children))
+
+        def read_many(nodeids):
+            vals = []
+            for dv in self.client.read_many(nodeids):
+                val = ""
+                if dv.StatusCode.is_good():
+                    val = ", " + str(dv.Value.Value)
                     if len(val) > 30:
                         val = val[0:27] + "..."
-                except Exception:
-                    pass  # TODO: Do something here?
-
-            f.write(" " * indent + root.text(0) + val + "\n")
+                vals.append(val)
+            return vals
 
-            for i in range(n_children):
-                self.dumpData(path, root.child(i), indent + 2, f, node_children[i])
+        n_variables = sum(key is not None for _, key in rows)
+        return DumpThread(path, rows, read_many, n_variables)
 
 
 class PLC(QtWidgets.QWidget):
-    def __init__(self, ip, parent=None):
+    loaded = QtCore.pyqtSignal()  # Emitted once the snapshot is loaded
+
+    def __init__(self, ip, rate=10, parent=None):
         super().__init__()
         self.client = OPCClient(ip)
+        self.snapshot = None
+        self.worker = Worker()
+        self.worker.start()
+        self.live = None
 
         try:
             self.client.connect()
-            self.tree = PLCTree(self.client)
-            self.selected_node = self.client.get_root_node()
-        except Exception:
+        except Exception as e:
+            print("Could not connect to {}: {}".format(ip, e))
+            _disconnect(self.client)
             self.client = None
+
+        if self.client is None:
             self.tree = PLCTree(self.client)
             self.selected_node = None
+        else:
+            # Children are browsed until the snapshot is loaded
+            self.tree = PLCTree(self.client, None, self.worker)
+            self.selected_node = self.client.get_root_node()
+            self.worker.submit(
+                lambda: Snapshot.fromClient(self.client), self.setSnapshot
+            )
 
-        self.selected = self.tree.currentItem()
         self.sp = QtWidgets.QLineEdit()
         self.subject = QtWidgets.QLineEdit()
         self.feedback = QtWidgets.QLabel()
         self.dump_path = QtWidgets.QLineEdit()
         self.dump = QtWidgets.QPushButton("Dump Tree")
+        self.progress = QtWidgets.QProgressBar()
+        self.dump_thread = None
         self.layout = QtWidgets.QVBoxLayout(self)
 
         self.setup()
 
         if self.client is not None:
             self.assignEvents()
+            self.live = LiveUpdater(
+                self.tree,
+                self.monitorValues,
+                self.unmonitorValues,
+                self.readValue,
+                rate,
+            )
 
     def setup(self):
         self.layout.setContentsMargins(0, 0, 0, 0)
@@ -139,9 +371,12 @@ class PLC(QtWidgets.QWidget):
         dt_hb.addWidget(self.dump)
         dt_hb.setContentsMargins(0, 0, 0, 0)
 
+        self.progress.hide()
+
         self.layout.addWidget(self.subject)
         self.layout.addWidget(spfb)
         self.layout.addWidget(dt)
+        self.layout.addWidget(self.progress)
         self.layout.addWidget(self.tree)
 
     def assignEvents(self):
@@ -151,50 +386,92 @@ class PLC(QtWidgets.QWidget):
             )
         )
 
-        self.dump.clicked.connect(lambda: self.tree.dumpData(self.dump_path.text()))
-        self.tree.itemSelectionChanged.connect(self.evolveTree)
+        self.dump.clicked.connect(self.dumpData)
+        self.tree.selectionModel().currentChanged.connect(self.evolveTree)
 
-    def evolveTree(self):
-        current = self.tree.currentItem()
+    def setSnapshot(self, snapshot, error):
+        """Worker callback, looking up children in the loaded snapshot.
 
-        parents = []
-        while current.text(0) != "0:Root":
-            parents.insert(0, current.text(0))
-            current = current.parent()
+        Without a snapshot, children are still browsed, so the tree keeps
+        working if the snapshot could not be taken or stored.
+        """
+        if error is not None:
+            print("Could not load snapshot: {}".format(error))
+            return
 
-        command_str = "client.get_root_node()"
-        node = self.client.get_root_node()
+        self.snapshot = snapshot
+        self.tree.model().snapshot = snapshot
+        self.loaded.emit()
+
+    def dumpData(self):
+        """Dump the tree to file on a thread, showing its progress.
+
+        While a dump is running, the dump button cancels it instead.
+        """
+        if dump.cancel(self.dump_thread):
+            return
+
+        thread = self.tree.dumpData(self.dump_path.text())
+        if thread is not None:
+            self.dump_thread = thread
+            dump.start(thread, self.dump, self.progress)
+
+    def evolveTree(self, current, previous=None):
+        """Show path and value of the selected node.
 
+        The value is read by the worker thread. Children are looked up by
+        the model when the node is expanded.
+        """
+        item = current.internalPointer()
+        if item is None or item.nodeid is None:
+            return
+
+        parents = item.path()
+        command_str = "client.get_root_node()"
         if len(parents) > 0:
             command_str = command_str + ".get_child(" + str(parents) + ")"
 
-        for p in parents:
-            node = node.get_child(p)
-
+        node = self.client.get_node(item.nodeid)
         self.selected_node = node
-        try:
-            self.feedback.setText(str(node.get_value()))
-        except Exception:
-            pass  # No value
-
+        self.feedback.setText("")
         self.subject.setText(command_str)
         self.subject.resize(self.tree.width(), self.subject.height())
 
-        if parents in self.client.expand_list:
-            return
-        else:
-            self.client.expand_list.append(parents)
+        def show(value, error):
+            if error is None and self.selected_node is node:
+                self.feedback.setText(str(value))
 
-        if not parents:
-            return
+        self.worker.submit(node.get_value, show)
 
-        children = self.client.get_root_node().get_child(parents).get_children()
-        branch = self.tree.currentItem()
-        for c in children:
-            leaf = QtWidgets.QTreeWidgetItem([self.client.getName(c)])
-            branch.addChild(leaf)
+    def monitorValues(self, nodeids):
+        """Start monitoring the values of nodes, on the worker thread."""
+        self.worker.submit(
+            lambda: self.client.subscribe(nodeids, consumer=self), _printError
+        )
+
+    def unmonitorValues(self, nodeids):
+        """Stop monitoring the values of nodes, on the worker thread."""
+        self.worker.submit(
+            lambda: self.client.unsubscribe(nodeids, consumer=self), _printError
+        )
+
+    def readValue(self, nodeid):
+        """Return latest (value, timestamp) strings of a monitored node."""
+        dv = self.client.subscription_handler.get(nodeid)
+        if dv is None:
+            return None
+
+        timestamp = dv.SourceTimestamp or dv.ServerTimestamp
+        return formatValue(dv.Value.Value), formatTimestamp(timestamp)
 
     def disconnect(self):
+        if dump.cancel(self.dump_thread):
+            self.dump_thread.wait()
+        if self.live is not None:
+            self.live.stop()
+        self.worker.stop()
+        if self.snapshot is not None:
+            self.snapshot.close()
         if self.client is not None:
             self.client.disconnect()
 
@@ -311,26 +588,45 @@ class PLC(QtWidgets.QWidget):
         )
 
     def getPVs(self):
-        objects = self.client.get_root_node().get_child("0:Objects").get_children()
-        plc = objects[-1]  # Node for PLC
-        instances = plc.get_child("3:DataBlocksInstance").get_children()
+        """Return PV names of the devices in the PLC snapshot.
+
+        Returns:
+            list(str): PV names, empty until the snapshot is loaded (see
+            `loaded`) or if it could not be.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return []
+
+        instances = snapshot.child(snapshot.plc(), "3:DataBlocksInstance")
+        if instances is None:
+            return []
 
         pvs = []
-        for node in instances:
-            device = node.get_display_name().Text
+        for node in snapshot.children(instances):
+            device = snapshot.display_name(node)
             if "DEV_" in device and "_iDB" in device:
                 dev_name = device.split("_")[1]
-                inputs = []
-                outputs = []
-                try:
-                    inputs = node.get_child("3:Inputs").get_children()
-                    outputs = node.get_child("3:Outputs").get_children()
-                except ua.uaerrors._auto.BadNoMatch:
-                    pass
-
-                for i in inputs:
-                    pvs.append("{}:{}".format(dev_name, i.get_display_name().Text))
-                for o in outputs:
-                    pvs.append("{}:{}".format(dev_name, o.get_display_name().Text))
+                for signals in ["3:Inputs", "3:Outputs"]:
+                    parent = snapshot.child(node, signals)
+                    if parent is None:
+                        continue
+
+                    for s in snapshot.children(parent):
+                        pvs.append("{}:{}".format(dev_name, snapshot.display_name(s)))
 
         return pvs
+
+
+def _printError(result, error):
+    """Worker callback printing the error of a task, if any."""
+    if error is not None:
+        print(error)
+
+
+def _disconnect(client):
+    """Disconnect client after a failed connect, ignoring errors."""
+    try:
+        client.disconnect()
+    except Exception as e:
+        print(e)
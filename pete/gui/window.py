@@ -0,0 +1,31 @@
+import os
+
+from PyQt5 import QtWidgets, QtGui
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class View(QtWidgets.QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.layout = QtWidgets.QHBoxLayout()
+
+        self.initUI()
+
+    def initUI(self):
+        self.resize(1024, 768)
+        self.setMinimumSize(800, 450)
+        widget = QtWidgets.QWidget(self)
+        widget.setLayout(self.layout)
+        self.setCentralWidget(widget)
+        self.setWindowTitle("petenv")
+        app_dir = os.path.dirname(os.path.realpath(__file__))
+        self.setWindowIcon(QtGui.QIcon(app_dir + os.path.sep + "icon.png"))
+
+    def addWidget(self, widget):
+        self.layout.addWidget(widget)
+
+    def setTheme(self, colors):
+        self.setStyleSheet("background-color: " + colors["window"] + ";")
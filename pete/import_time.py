@@ -0,0 +1,137 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Entry point name and the code it runs, as in setup.py, plus the modules
+# pytest imports to collect the test scripts
+ENTRY_POINTS = {
+    "pete-gui": "pete.gui.petenv_gui:run",
+    "pete-plc": "pete.virtual_plc:run",
+    "pete-dump": "pete.dump:run",
+    "pytest-collect": "pete.test.conftest",
+}
+
+# Dependencies that are slow to import, and shall only be loaded on use
+HEAVY_MODULES = ["opcua", "asyncua", "epics", "PyQt5"]
+
+# Run in a fresh interpreter to start an entry point, with the arguments
+# following the code. Exits on '--help', after printing the heavy modules
+# loaded by then.
+_CHILD = """
+import atexit, sys
+heavy = {heavy!r}
+atexit.register(
+    lambda: sys.stderr.write(
+        "\\nloaded: " + ",".join(m for m in heavy if m in sys.modules) + "\\n"
+    )
+)
+module, _, function = sys.argv[1].partition(":")
+sys.argv = sys.argv[1:]
+__import__(module)
+if function:
+    getattr(sys.modules[module], function)()
+"""
+
+
+def measure(target, args=("--help",), repeat=5):
+    """Return cold start times of an entry point.
+
+    Each run starts a new interpreter, imports the entry point's module and
+    calls its function, e.g. with '--help', which returns as soon as the
+    arguments are parsed. The start up time of the bare interpreter is not
+    subtracted; compare with `measure("", ())` for that.
+
+    Args:
+        target (str): Entry point, 'module:function', or a module to import.
+        args (tuple(str)): Command line arguments.
+        repeat (int): Number of runs.
+
+    Returns:
+        tuple(list(float), list(str)): Seconds per run, and heavy modules
+        loaded by the entry point.
+    """
+    code = _CHILD.format(heavy=HEAVY_MODULES) if target else "pass"
+    command = [sys.executable, "-c", code, target] + list(args)
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        times.append(time.perf_counter() - start)
+
+        lines = result.stderr.decode(errors="replace").splitlines()
+        if result.returncode:
+            raise RuntimeError("'{}' failed:\n{}".format(target, "\n".join(lines)))
+        if target:
+            loaded = [m for m in lines[-1][len("loaded:") :].strip().split(",") if m]
+
+    return times, loaded
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="measure cold start time of the pete entry points"
+    )
+    parser.add_argument(
+        "entry_points",
+        nargs="*",
+        default=sorted(ENTRY_POINTS),
+        help="entry points to measure (all)",
+    )
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="runs each")
+    parser.add_argument("-o", "--output", type=str, help="write results as json")
+    parser.add_argument(
+        "-b",
+        "--budget",
+        type=float,
+        help="fail if the median start time of an entry point exceeds it (s)",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    base, _ = measure("", (), args.repeat)
+    results["python"] = {"median_s": statistics.median(base), "min_s": min(base)}
+    for name in args.entry_points:
+        times, loaded = measure(ENTRY_POINTS[name], repeat=args.repeat)
+        results[name] = {
+            "median_s": statistics.median(times),
+            "min_s": min(times),
+            "loaded": loaded,
+        }
+
+    print("{:<16}{:>10}{:>10}  {}".format("entry point", "median", "min", "loaded"))
+    for name, result in results.items():
+        print(
+            "{:<16}{:>9.3f}s{:>9.3f}s  {}".format(
+                name,
+                result["median_s"],
+                result["min_s"],
+                ", ".join(result.get("loaded", [])),
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.budget is not None:
+        slow = [
+            name
+            for name in args.entry_points
+            if results[name]["median_s"] > args.budget
+        ]
+        if slow:
+            sys.exit("Over budget: {}".format(", ".join(slow)))
+
+
+if __name__ == "__main__":
+    run()
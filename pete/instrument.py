@@ -0,0 +1,253 @@
+import functools
+import json
+import threading
+import time
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Latencies are bucketed in microseconds with 2**SUB_BUCKET_BITS buckets per
+# power of two, i.e. a relative resolution of about 3%, like HdrHistogram.
+SUB_BUCKET_BITS = 5
+_HALF = 1 << (SUB_BUCKET_BITS - 1)
+
+# OPCClient methods to instrument, with a function returning the call's
+# target node from the call's arguments (the first being 'self'), or None
+# for batched calls.
+CLIENT_METHODS = {
+    "setValue": lambda args: args[1],
+    "getValue": lambda args: args[1],
+    "read_many": None,
+    "write_many": None,
+    "browse_many": None,
+    "resolvePaths": None,
+    "wait_all": None,
+}
+
+# opcua Node methods to instrument, the target being the node itself
+NODE_METHODS = ["get_value", "set_value", "get_children", "get_child"]
+
+# pyepics functions to instrument, the target being the PV name
+EPICS_FUNCTIONS = ["caget", "caput"]
+
+# PVManager methods to instrument, with a function returning the call's
+# target PV name from the call's arguments, or None for calls on many PVs.
+PV_MANAGER_METHODS = {
+    "get": lambda args: args[1],
+    "put": lambda args: args[1],
+    "get_many": None,
+    "wait": None,
+}
+
+
+class Histogram(object):
+    def __init__(self):
+        """Initialize log-linear latency histogram."""
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        """Record one latency in seconds."""
+        us = int(seconds * 1e6)
+        if us < 2 * _HALF:
+            index = us
+        else:
+            shift = us.bit_length() - SUB_BUCKET_BITS
+            index = shift * _HALF + (us >> shift)
+
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return latency in seconds below which p percent of calls were."""
+        threshold = self.count * p / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(_lowerBound(index) / 1e6, self.max)
+
+        return self.max
+
+    def summary(self):
+        """Return dict of count and latency statistics in ms."""
+        if not self.count:
+            return {"count": 0}
+
+        return {
+            "count": self.count,
+            "total_s": round(self.total, 6),
+            "mean_ms": round(1e3 * self.total / self.count, 3),
+            "min_ms": round(1e3 * self.min, 3),
+            "p50_ms": round(1e3 * self.percentile(50), 3),
+            "p90_ms": round(1e3 * self.percentile(90), 3),
+            "p99_ms": round(1e3 * self.percentile(99), 3),
+            "max_ms": round(1e3 * self.max, 3),
+        }
+
+
+class Recorder(object):
+    def __init__(self):
+        """Initialize recorder of call latencies per operation and target."""
+        self.operations = {}
+        self.targets = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, target, seconds):
+        """Record latency of one call.
+
+        Args:
+            operation (str): Operation name, e.g. 'opc.setValue'.
+            target (str): Node id or PV name, or None for batched calls.
+            seconds (float): Latency of the call.
+        """
+        with self._lock:
+            self.operations.setdefault(operation, Histogram()).record(seconds)
+            if target is not None:
+                key = (operation, target)
+                self.targets.setdefault(key, Histogram()).record(seconds)
+
+    def clear(self):
+        """Forget all recorded calls."""
+        with self._lock:
+            self.operations.clear()
+            self.targets.clear()
+
+    def summary(self):
+        """Return dict of statistics per operation, and per target."""
+        with self._lock:
+            summary = {}
+            for operation, hist in sorted(self.operations.items()):
+                summary[operation] = hist.summary()
+                summary[operation]["targets"] = {}
+            for (operation, target), hist in sorted(self.targets.items()):
+                summary[operation]["targets"][target] = hist.summary()
+
+        return summary
+
+    def dump(self, path):
+        """Write statistics as json."""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+recorder = Recorder()
+_originals = []  # (owner, attribute name, original) of patched callables
+
+
+def enable():
+    """Start recording latencies of OPCUA, Channel Access and sleep calls.
+
+    Instrumentation is opt-in: it patches the `OPCClient` methods, the
+    opcua `Node` methods, the pyepics functions and the `PVManager`
+    methods listed at the top of this module, and `time.sleep` (only calls
+    made from the main thread are recorded, to leave out background
+    threads of the libraries).
+
+    Note that `from epics import caget` binds the unpatched function if it
+    runs before `enable`, so enable instrumentation early, e.g. from
+    `pytest_configure` in `conftest.py`.
+    """
+    if _originals:
+        return  # Already enabled
+
+    from opcua.common.node import Node
+    from pete.opc_client import OPCClient
+
+    for name, target in CLIENT_METHODS.items():
+        _patch(OPCClient, name, "opc." + name, target)
+
+    for name in NODE_METHODS:
+        _patch(Node, name, "opc.node." + name, lambda args: args[0])
+
+    try:
+        import epics
+    except ImportError:
+        pass
+    else:
+        from pete.ca_client import PVManager
+
+        for name in EPICS_FUNCTIONS:
+            _patch(epics, name, "ca." + name, lambda args: args[0])
+        for name, target in PV_MANAGER_METHODS.items():
+            _patch(PVManager, name, "ca.manager." + name, target)
+
+    main_thread = threading.main_thread()
+    sleep = time.sleep
+
+    @functools.wraps(sleep)
+    def timed_sleep(seconds):
+        if threading.current_thread() is not main_thread:
+            return sleep(seconds)
+        start = time.perf_counter()
+        try:
+            return sleep(seconds)
+        finally:
+            recorder.record("sleep", None, time.perf_counter() - start)
+
+    _originals.append((time, "sleep", sleep))
+    time.sleep = timed_sleep
+
+
+def disable():
+    """Stop recording and restore all patched callables."""
+    while _originals:
+        owner, name, original = _originals.pop()
+        setattr(owner, name, original)
+
+
+def _patch(owner, name, operation, target):
+    """Replace owner.name with a wrapper recording the call's latency.
+
+    Args:
+        owner (object): Class or module owning the callable.
+        name (str): Name of the callable.
+        operation (str): Operation name to record calls as.
+        target (callable): Function returning the call's target from the
+            call's arguments, or None if calls have no single target.
+    """
+    original = getattr(owner, name)
+
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            try:
+                key = _targetName(target(args)) if target else None
+            except IndexError:
+                key = None  # Target passed as keyword argument
+            recorder.record(operation, key, elapsed)
+
+    _originals.append((owner, name, original))
+    setattr(owner, name, wrapper)
+
+
+def _lowerBound(index):
+    """Return lowest latency in microseconds of a histogram bucket."""
+    if index < 2 * _HALF:
+        return index
+
+    shift = index // _HALF - 1
+    return (index - shift * _HALF) << shift
+
+
+def _targetName(target):
+    """Return printable name of a node, node id or PV name."""
+    if target is None or isinstance(target, str):
+        return target
+
+    nodeid = getattr(target, "nodeid", target)
+    try:
+        return nodeid.to_string()
+    except AttributeError:
+        return str(nodeid)
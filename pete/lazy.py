@@ -0,0 +1,33 @@
+import importlib
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        """Initialize stand-in for a module, imported on first use.
+
+        opcua, pyepics and PyQt5 take long to import, and pyepics loads
+        the CA library, so modules that only need them for some of their
+        functions bind them with e.g. `epics = LazyModule("epics")`. The
+        module is imported on the first attribute access, and attributes
+        are then looked up on it, so patches of the module (see
+        `pete.instrument`) are seen.
+
+        Args:
+            name (str): Full module name, e.g. 'opcua.ua'.
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module '{}' ({})>".format(self._name, state)
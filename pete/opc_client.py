@@ -1,45 +1,219 @@
+import atexit
+from contextlib import contextmanager
+import threading
+import time
+
 from opcua import Client
 from opcua import ua
+from opcua.common import ua_utils
+from opcua.common.node import Node
+
+from pete.opc_common import (
+    DEFAULT_CHUNK_SIZE,
+    MISSING,
+    SUBSCRIPTION_PERIOD,
+    NodeCache,
+    ShadowCache,
+    Subscribers,
+    browseNextParameters,
+    browseParameters,
+    browsePaths,
+    builtinVariantType,
+    chunks,
+    collectReferences,
+    conditionPredicates,
+    indexedPaths,
+    metadataItems,
+    nodeidOf,
+    operationLimitItems,
+    parseMetadata,
+    parseOperationLimits,
+    readParameters,
+    satisfied,
+    serverUrl,
+    toPython,
+    writeParameters,
+)
+from pete.path_index import DEFAULT_CACHE_DIR, PathIndex
 
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 
+class DataChangeHandler(object):
+    def __init__(self, shadow=None):
+        """Initialize handler of the shared data change subscription.
+
+        The handler keeps the latest data value of every monitored node,
+        and wakes up threads waiting for a value to change.
+
+        Args:
+            shadow (ShadowCache): Cache to feed notified values into.
+        """
+        self.values = {}
+        self.condition = threading.Condition()
+        self.shadow = shadow
+        self.listeners = {}  # Callbacks per node id, see `listen`
+
+    def datachange_notification(self, node, val, data):
+        """Store notified value, wake up waiting threads and call listeners."""
+        with self.condition:
+            self.values[node.nodeid] = data.monitored_item.Value
+            self.condition.notify_all()
+            listeners = self.listeners.get(node.nodeid, ())
+        if self.shadow is not None:
+            self.shadow.put(node.nodeid, val)
+        for callback in listeners:
+            try:
+                callback(node.nodeid, val)
+            except Exception as e:
+                print("Data change callback failed: {}".format(e))
+
+    def listen(self, nodeid, callback):
+        """Call callback(nodeid, value) on each value change of a node.
+
+        Callbacks are called on the thread of the subscription, so they
+        must not block.
+        """
+        with self.condition:
+            listeners = self.listeners.get(nodeid, ())
+            if callback not in listeners:
+                self.listeners[nodeid] = listeners + (callback,)
+
+    def unlisten(self, nodeid, callback=None):
+        """Stop calling callback, or all callbacks if None, for a node."""
+        with self.condition:
+            listeners = self.listeners.pop(nodeid, ())
+            if callback is not None:
+                listeners = tuple(c for c in listeners if c != callback)
+                if listeners:
+                    self.listeners[nodeid] = listeners
+
+    def forget(self, nodeid):
+        """Forget value and callbacks of a node that is not monitored anymore.
+
+        Otherwise a wait after monitoring the node again would be checked
+        against the value from before, until the first new notification.
+        """
+        with self.condition:
+            self.values.pop(nodeid, None)
+            self.listeners.pop(nodeid, None)
+
+    def get(self, nodeid):
+        """Return latest data value of node, or None if none received."""
+        return self.values.get(nodeid)
+
+    def clear(self):
+        """Forget all values."""
+        with self.condition:
+            self.values.clear()
+
+
 class OPCClient(Client):
-    def __init__(self, ip, timeout=4):
+    def __init__(
+        self,
+        ip,
+        port=4840,
+        timeout=4,
+        cache_size=10000,
+        path_cache_dir=DEFAULT_CACHE_DIR,
+        shadow=False,
+        deadband=0.0,
+        max_age=1.0,
+    ):
         """Initialize OPCUA client.
 
         Args:
-            ip (str): PLC IP address.
+            ip (str): PLC IP address, or the full endpoint url of the PLC,
+                e.g. 'opc.tcp://localhost:4841'.
+            port (int): TCP port of the PLC's OPCUA server, unless given
+                in the url.
             timeout (float): Timeout in seconds for connection.
+            cache_size (int): Max number of nodes held in metadata cache.
+            path_cache_dir (str): Directory of the persistent browse path
+                index. Set to None to not persist resolved paths.
+            shadow (bool): Keep the last known value of nodes, learnt from
+                subscriptions, reads and writes. Writes of a value equal
+                to the known value are then skipped, and 'getValue' is
+                answered from the cache when the known value is current.
+            deadband (float): Max difference between numeric values for a
+                write to be skipped as unchanged, see `ShadowCache`.
+            max_age (float): Seconds a value of a node that is not
+                monitored is considered current, see `ShadowCache`.
         """
-        url = "opc.tcp://{}:4840".format(ip)
+        url = serverUrl(ip, port)
         super().__init__(url, timeout=4)
         self.expand_list = []
         self.selected = self.get_root_node()
+        self.operation_limits = None
+        self.metadata = NodeCache(cache_size)
+        self.path_cache_dir = path_cache_dir
+        self.path_index = None
+        self.shadow = ShadowCache(deadband, max_age) if shadow else None
+        self.subscription = None
+        self.subscription_handler = DataChangeHandler(self.shadow)
+        self.monitored = {}  # Monitored item handle per node id
+        self.subscribers = Subscribers()
+        self._subscription_lock = threading.Lock()
+
+    def disconnect(self):
+        """Disconnect from server, forgetting the shared subscription."""
+        try:
+            super().disconnect()
+        finally:
+            self.subscription = None
+            self.monitored.clear()
+            self.subscribers.clear()
+            self.subscription_handler.clear()
+            if self.shadow is not None:
+                self.shadow.invalidate()
 
     def setValue(self, node, value):
-        """Set value to OPCUA node."""
-        variant_type = node.get_data_type_as_variant_type()
+        """Set value to OPCUA node.
+
+        The variant type is taken from the metadata cache, so only the
+        first write to a node costs an extra round trip. With the shadow
+        cache enabled, the write is skipped if the node is known to hold
+        the value already.
+        """
+        if self.shadow is not None:
+            if self.shadow.unchanged(node.nodeid, value, self._monitored(node)):
+                self.shadow.suppressed += 1
+                return
+
+        variant_type = self.getMetadata(node).variant_type
         variant = ua.uatypes.Variant(value, variant_type)
         data_value = ua.DataValue()
         data_value.Value = variant
         node.set_data_value(data_value, variant_type)
 
+        if self.shadow is not None:
+            self.shadow.put(node.nodeid, value)
+
     def getValue(self, node):
         """Return node value.
 
         This function merely translates opcua package's 'get_value' to a
         syntax following this class. This is needed as the 'setValue'
         method differs from the opcua package's node function
-        'set_value'.
+        'set_value'. With the shadow cache enabled, a current known value
+        is returned without a round trip.
         """
-        return node.get_value()
+        if self.shadow is None:
+            return node.get_value()
+
+        value = self.shadow.get(node.nodeid, self._monitored(node))
+        if value is MISSING:
+            value = node.get_value()
+            self.shadow.put(node.nodeid, value)
+
+        return value
 
     def getName(self, node):
-        """Returns name of node"""
-        return str(node.get_browse_name()).split("(")[1].split(")")[0]
+        """Returns name of node, e.g. '3:Inputs'"""
+        browse_name = self.getMetadata(node).browse_name
+        return "{}:{}".format(browse_name.NamespaceIndex, browse_name.Name)
 
     def applyVal(self, node, val, feedback):
         """Value setter including error handling.
@@ -47,8 +221,678 @@ class OPCClient(Client):
         This function is mainly used by the petenv gui.
         """
         try:
-            self.setValue(node, type(node.get_value())(val))
-            feedback.setText(str(node.get_value()))
+            variant_type = self.getMetadata(node).variant_type
+            value = toPython(variant_type, val)
+            self.setValue(node, value)
+            feedback.setText(str(value))
         except Exception as e:
             print(e)
             print("Couldn't set value")
+
+    def read_many(self, nodes, attribute=ua.AttributeIds.Value):
+        """Read an attribute of many nodes using batched Read requests.
+
+        All nodes are packed into as few Read service requests as the
+        server's operation limits allow, instead of one round trip per
+        node.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to read.
+            attribute (ua.AttributeIds): Attribute to read from each node.
+
+        Returns:
+            list(ua.DataValue): One data value per node, in the same order
+            as `nodes`. Check each value's `StatusCode` to see whether the
+            read of that node succeeded.
+        """
+        nodeids = [nodeidOf(node) for node in nodes]
+        results = self._read([(nodeid, attribute) for nodeid in nodeids])
+        if self.shadow is not None and attribute == ua.AttributeIds.Value:
+            for nodeid, dv in zip(nodeids, results):
+                if dv.StatusCode.is_good():
+                    self.shadow.put(nodeid, dv.Value.Value)
+
+        return results
+
+    def write_many(self, values):
+        """Write values to many nodes using batched Write requests.
+
+        The data types of all nodes are fetched in one batched read, and
+        the values are then written in as few Write service requests as
+        the server's operation limits allow. With the shadow cache
+        enabled, nodes known to hold their value already are not written,
+        and get a good status.
+
+        Args:
+            values (dict(Node, object)): Value to write, per node.
+
+        Returns:
+            dict(Node, ua.StatusCode): Status of the write, per node.
+        """
+        nodes = list(values)
+        statuses = {}
+        if self.shadow is not None:
+            changed = []
+            for node in nodes:
+                nodeid = nodeidOf(node)
+                monitored = self._monitored(nodeid)
+                if self.shadow.unchanged(nodeid, values[node], monitored):
+                    self.shadow.suppressed += 1
+                    statuses[node] = ua.StatusCode(ua.StatusCodes.Good)
+                else:
+                    changed.append(node)
+            nodes = changed
+        metadata = self.getMetadataMany(nodes)
+
+        writable = []
+        for node, meta in zip(nodes, metadata):
+            if isinstance(meta, ua.StatusCode):
+                statuses[node] = meta  # Node could not be looked up
+            elif meta.variant_type is None:
+                statuses[node] = ua.StatusCode(ua.StatusCodes.BadNotWritable)
+            else:
+                writable.append((node, meta.variant_type))
+
+        for chunk in chunks(writable, self.getOperationLimit("write")):
+            params = writeParameters(ua, chunk, values)
+            for (node, _), status in zip(chunk, self.uaclient.write(params)):
+                statuses[node] = status
+                if self.shadow is not None and status.is_good():
+                    self.shadow.put(nodeidOf(node), values[node])
+
+        return statuses
+
+    def browse_many(self, nodes):
+        """Return hierarchical child references of many nodes.
+
+        All nodes are browsed with as few Browse requests as the server's
+        operation limits allow, and results that do not fit in one
+        response are followed up with BrowseNext requests using the
+        returned continuation points.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to browse.
+
+        Returns:
+            list(list(ua.ReferenceDescription)): Child references per node,
+            in the same order as `nodes`. Nodes that could not be browsed
+            have no references.
+        """
+        nodeids = [nodeidOf(node) for node in nodes]
+        references = [[] for _ in nodeids]
+        limit = self.getOperationLimit("browse")
+
+        for offset in range(0, len(nodeids), limit):
+            chunk = nodeids[offset : offset + limit]
+            results = self.uaclient.browse(browseParameters(ua, chunk))
+            positions = [(i, None) for i in range(offset, offset + len(chunk))]
+            pending = collectReferences(references, positions, results)
+            while pending:
+                results = self.uaclient.browse_next(browseNextParameters(ua, pending))
+                pending = collectReferences(references, pending, results)
+
+        return references
+
+    def getMetadata(self, node):
+        """Return cached metadata of node, fetching it if not yet cached.
+
+        Args:
+            node (Node): OPCUA node.
+
+        Returns:
+            NodeMetadata: Variant type, browse name, display name and value
+            rank of the node. Variant type and value rank are None for
+            nodes that are not variables.
+        """
+        meta = self.getMetadataMany([node])[0]
+        if isinstance(meta, ua.StatusCode):
+            meta.check()  # Raises the corresponding exception
+
+        return meta
+
+    def getMetadataMany(self, nodes):
+        """Return metadata of many nodes, fetching uncached nodes in bulk.
+
+        The metadata attributes of all uncached nodes are read in one
+        batched read.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes.
+
+        Returns:
+            list(NodeMetadata or ua.StatusCode): Metadata per node, or the
+            bad status code if the node could not be looked up.
+        """
+        nodeids = [nodeidOf(node) for node in nodes]
+        metadata = [self.metadata.get(nodeid) for nodeid in nodeids]
+        missing = [n for n, meta in zip(nodeids, metadata) if meta is None]
+        if not missing:
+            return metadata
+
+        fetched = dict(zip(missing, self._fetchMetadata(missing)))
+        return [
+            fetched[n] if meta is None else meta for n, meta in zip(nodeids, metadata)
+        ]
+
+    def cacheMetadata(self, nodes):
+        """Fill metadata cache with many nodes using one batched read.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes.
+        """
+        self.getMetadataMany(nodes)
+
+    def invalidateMetadata(self, nodes=None):
+        """Drop nodes from metadata cache, or clear it if nodes is None.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to drop from cache.
+        """
+        if nodes is None:
+            self.metadata.invalidate()
+        else:
+            self.metadata.invalidate([nodeidOf(node) for node in nodes])
+
+    def _fetchMetadata(self, nodeids):
+        """Read metadata of nodes from server and cache it."""
+        results = self._read(metadataItems(ua, nodeids))
+
+        metadata = []
+        for nodeid, parsed in zip(nodeids, parseMetadata(results)):
+            if isinstance(parsed, ua.StatusCode):
+                metadata.append(parsed)  # Node does not exist
+                continue
+
+            dtype, meta = parsed
+            if dtype is not None:
+                meta = meta._replace(variant_type=self._toVariantType(dtype))
+            self.metadata.put(nodeid, meta)
+            metadata.append(meta)
+
+        return metadata
+
+    def getPLC(self):
+        """Return PLC node, i.e. the last child of the 'Objects' node."""
+        return self.get_objects_node().get_children()[-1]
+
+    def getSoftwareRevision(self):
+        """Return software revision of PLC program, or "" if unavailable."""
+        try:
+            return self.getPLC().get_child("2:SoftwareRevision").get_value()
+        except ua.UaStatusCodeError:
+            return ""
+
+    def resolvePath(self, path, start=None):
+        """Return node at a browse path, like 'Node.get_child' does.
+
+        Args:
+            path (list(str)): Browse names, e.g. ["0:Objects", "3:PLC"].
+            start (Node): Node to start from. Defaults to the root node.
+
+        Raises:
+            ua.UaStatusCodeError: If the path does not resolve to a node.
+        """
+        node = self.resolvePaths([path], start)[0]
+        if node is None:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadNoMatch)
+
+        return node
+
+    def resolvePaths(self, paths, start=None):
+        """Return nodes of many browse paths, in one batched request.
+
+        All paths that are not already in the path index are resolved
+        with as few TranslateBrowsePathsToNodeIds requests as the server's
+        operation limits allow, instead of one request per path segment.
+        Resolved paths are persisted to disk (see `PathIndex`), keyed by
+        server and PLC program revision, so that a warm start needs no
+        resolving at all.
+
+        Args:
+            paths (list(list(str))): Browse paths, each a list of browse
+                names, e.g. ["3:Inputs", "3:hwi_TT-001"].
+            start (Node): Node that all paths start from. Defaults to the
+                root node.
+
+        Returns:
+            list(Node): Node per path, or None if the path did not resolve.
+        """
+        start = self.get_root_node() if start is None else start
+        start_id = nodeidOf(start).to_string()
+        index = self.getPathIndex()
+
+        nodeids, missing = indexedPaths(index, start_id, paths)
+        nodes = [
+            None if nodeid is None else self.get_node(ua.NodeId.from_string(nodeid))
+            for nodeid in nodeids
+        ]
+
+        for chunk in chunks(missing, self.getOperationLimit("translate")):
+            bpaths = browsePaths(ua, start, [path for _, path in chunk])
+            results = self.uaclient.translate_browsepaths_to_nodeids(bpaths)
+            for (i, path), result in zip(chunk, results):
+                if not result.StatusCode.is_good() or not result.Targets:
+                    continue
+
+                nodeid = result.Targets[0].TargetId
+                nodes[i] = self.get_node(nodeid)
+                if index:
+                    index.put(PathIndex.key(start_id, path), nodeid.to_string())
+
+        if index:
+            index.save()
+
+        return nodes
+
+    def getPathIndex(self):
+        """Return persistent path index, opening it on first use.
+
+        Returns None if persisting of paths is disabled. If the PLC does
+        not expose its program revision, the index is kept in memory only,
+        as an index on disk could not be told apart from that of another
+        program, whose node ids may have moved.
+        """
+        if self.path_index is None and self.path_cache_dir is not None:
+            revision = self.getSoftwareRevision()
+            self.path_index = PathIndex(
+                self.server_url.geturl(),
+                revision,
+                self.path_cache_dir if revision else None,
+            )
+
+        return self.path_index
+
+    def subscribe(self, nodes, callback=None, consumer=None):
+        """Monitor value changes of nodes through the shared subscription.
+
+        The subscription is created on first use and shared by all waits
+        of this client. Nodes that are already monitored are skipped, and
+        all new nodes are added with one CreateMonitoredItems request.
+
+        Subscriptions are counted per consumer: a node is monitored until
+        each consumer that subscribed to it unsubscribed (see
+        `unsubscribe`).
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to monitor.
+            callback (callable): Function called with the node id and the
+                new value on each value change of the nodes, including the
+                initial value. It is called on the subscription's thread,
+                so it must not block.
+            consumer (object): Key of the consumer, to unsubscribe with.
+                Defaults to the callback, or, without callback, to the
+                waits of this client (see `wait_all`).
+        """
+        if consumer is None:
+            consumer = callback
+        nodeids = [nodeidOf(node) for node in nodes]
+
+        if callback is not None:
+            for nodeid in nodeids:
+                self.subscription_handler.listen(nodeid, callback)
+                dv = self.subscription_handler.get(nodeid)
+                if dv is not None:
+                    callback(nodeid, dv.Value.Value)  # Initial value, if known
+
+        with self._subscription_lock:
+            if self.subscription is None:
+                self.subscription = self.create_subscription(
+                    SUBSCRIPTION_PERIOD, self.subscription_handler
+                )
+
+            new = []
+            for nodeid in nodeids:
+                self.subscribers.add(nodeid, consumer, callback)
+                if nodeid not in self.monitored:
+                    self.monitored[nodeid] = None  # Reserved until subscribed
+                    new.append(nodeid)
+            if not new:
+                return
+
+            try:
+                handles = self.subscription.subscribe_data_change(
+                    [self.get_node(nodeid) for nodeid in new]
+                )
+            except Exception:
+                for nodeid in new:
+                    del self.monitored[nodeid]
+                    self.subscribers.remove(nodeid, consumer)
+                    self.subscription_handler.forget(nodeid)
+                raise
+
+            bad = None
+            for nodeid, handle in zip(new, handles):
+                if isinstance(handle, ua.StatusCode):
+                    del self.monitored[nodeid]
+                    self.subscribers.remove(nodeid, consumer)
+                    self.subscription_handler.forget(nodeid)
+                    bad = handle
+                else:
+                    self.monitored[nodeid] = handle
+            if bad is not None:
+                bad.check()  # Raises the corresponding exception
+
+    def unsubscribe(self, nodes=None, consumer=None):
+        """Stop monitoring nodes for a consumer, or all nodes if None.
+
+        Only the callback of the consumer is removed. A node is monitored
+        until its last consumer unsubscribed, after which its latest value
+        is forgotten.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to stop monitoring. If None,
+                all nodes stop being monitored, for all consumers.
+            consumer (object): Key of the consumer, as given to
+                `subscribe`.
+        """
+        with self._subscription_lock:
+            if nodes is None:
+                nodeids = list(self.monitored)
+                self.subscribers.clear()
+            else:
+                nodeids = []
+                for nodeid in {nodeidOf(n): None for n in nodes}:
+                    callback, last = self.subscribers.remove(nodeid, consumer)
+                    if callback is not None:
+                        self.subscription_handler.unlisten(nodeid, callback)
+                    if last and nodeid in self.monitored:
+                        nodeids.append(nodeid)
+
+            for nodeid in nodeids:
+                self.subscription.unsubscribe(self.monitored.pop(nodeid))
+                self.subscription_handler.forget(nodeid)
+
+    def wait_for(self, node, predicate, timeout=4.0):
+        """Wait for the value of a node to satisfy a predicate.
+
+        Rather than polling, the node is monitored through the shared
+        subscription and this function returns as soon as a data change
+        notification satisfies the predicate.
+
+        Args:
+            node (Node): OPCUA node.
+            predicate (callable or object): Function taking the node value
+                and returning True when the wait is over, or a value that
+                the node value shall equal.
+            timeout (float): Timeout in seconds.
+
+        Returns:
+            bool: True if the predicate was satisfied, False on timeout.
+        """
+        return self.wait_all({node: predicate}, timeout)
+
+    def wait_all(self, conditions, timeout=4.0):
+        """Wait for the values of many nodes to satisfy their predicates.
+
+        Args:
+            conditions (dict(Node, callable or object)): Predicate, or
+                expected value, per node. See `wait_for`.
+            timeout (float): Timeout in seconds.
+
+        Returns:
+            bool: True if all predicates were satisfied at the same time,
+            False on timeout.
+        """
+        predicates = conditionPredicates(conditions)
+        self.subscribe(list(predicates))
+
+        deadline = time.monotonic() + timeout
+        with self.subscription_handler.condition:
+            while not satisfied(self.subscription_handler, predicates):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.subscription_handler.condition.wait(remaining)
+
+        return True
+
+    def getOperationLimit(self, operation):
+        """Return max number of nodes per service request for an operation.
+
+        The server's operation limits are read once, on first use. A limit
+        of 0 (or a limit the server does not expose) means that the server
+        does not impose one, in which case `DEFAULT_CHUNK_SIZE` is used.
+
+        Args:
+            operation (str): Key of `OPERATION_LIMITS`, e.g. "read".
+        """
+        if self.operation_limits is None:
+            params = readParameters(ua, operationLimitItems(ua))
+            self.operation_limits = parseOperationLimits(self.uaclient.read(params))
+
+        return self.operation_limits.get(operation, DEFAULT_CHUNK_SIZE)
+
+    def _monitored(self, node):
+        """Return True if node is monitored through the shared subscription."""
+        return self.monitored.get(nodeidOf(node)) is not None
+
+    def _read(self, items):
+        """Read (node id, attribute) pairs using batched Read requests."""
+        results = []
+        for chunk in chunks(items, self.getOperationLimit("read")):
+            results.extend(self.uaclient.read(readParameters(ua, chunk)))
+
+        return results
+
+    def _toVariantType(self, dtype):
+        """Return variant type of a data type node id.
+
+        Built-in data types map directly onto a variant type, which saves
+        browsing the type hierarchy on the server.
+        """
+        variant_type = builtinVariantType(ua, dtype)
+        if variant_type is not None:
+            return variant_type
+
+        return ua_utils.data_type_to_variant_type(Node(self.uaclient, dtype))
+
+
+class SessionPool(object):
+    def __init__(
+        self,
+        factory=OPCClient,
+        check_interval=10.0,
+        max_backoff=30.0,
+        idle_timeout=60.0,
+    ):
+        """Initialize pool of shared, kept alive OPCUA sessions.
+
+        Creating a session and its secure channel is slow on a PLC, and
+        PLCs cap the number of concurrent sessions. The pool therefore
+        keeps one connected client per PLC, which is checked out by all
+        users instead of being connected and disconnected by every user.
+        Sessions that dropped are reconnected, with exponential backoff,
+        on checkout. Reconnecting only holds up the users of that PLC:
+        checkouts of other PLCs go on meanwhile.
+
+        Checkouts are counted per session. A session that is not checked
+        out is kept alive for `idle_timeout` seconds, so consecutive users,
+        e.g. test modules, share it, and is then disconnected.
+
+        Args:
+            factory (callable): Function creating a client from an ip.
+            check_interval (float): Min seconds between health checks of
+                a session on checkout.
+            max_backoff (float): Max seconds between reconnect attempts.
+            idle_timeout (float): Seconds a session is kept alive after its
+                last checkout is returned. Set to 0 to disconnect it as
+                soon as it is not checked out, or None to keep it until
+                `close`.
+        """
+        self.factory = factory
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self.sessions = {}  # _Session per ip
+        self._lock = threading.Lock()  # Guards `sessions`
+
+    def acquire(self, ip, timeout=60.0):
+        """Check out connected client of PLC, connecting if needed.
+
+        Args:
+            ip (str): PLC IP address.
+            timeout (float): Seconds to keep trying to (re)connect.
+
+        Returns:
+            OPCClient: Connected client, to be returned with `release`.
+        """
+        with self._lock:
+            session = self.sessions.get(ip)
+            if session is None:
+                session = _Session(ip, self.factory(ip))
+                self.sessions[ip] = session
+            session.checkouts += 1
+            if session.idle is not None:
+                session.idle.cancel()
+                session.idle = None
+
+        try:
+            with session.lock:
+                now = time.monotonic()
+                if (
+                    session.checked is None
+                    or now - session.checked > self.check_interval
+                ):
+                    if session.checked is None or not self._alive(session.client):
+                        session.checked = None  # Not connected until reconnected
+                        self._connect(session.client, timeout)
+                    session.checked = time.monotonic()
+        except Exception:
+            self.release(session.client)
+            raise
+
+        return session.client
+
+    def release(self, client):
+        """Return checked out client.
+
+        Once a session is not checked out anymore, it is disconnected
+        after `idle_timeout` seconds, unless checked out again meanwhile.
+
+        Args:
+            client (OPCClient): Client returned by `acquire`.
+        """
+        with self._lock:
+            session = None
+            for s in self.sessions.values():
+                if s.client is client:
+                    session = s
+            if session is None or session.checkouts == 0:
+                return  # Closed meanwhile, or not checked out
+
+            session.checkouts -= 1
+            if session.checkouts > 0 or self.idle_timeout is None:
+                return
+            if self.idle_timeout > 0:
+                session.idle = threading.Timer(
+                    self.idle_timeout, self._expire, (session,)
+                )
+                session.idle.daemon = True
+                session.idle.start()
+                return
+
+        self._expire(session)
+
+    @contextmanager
+    def session(self, ip, timeout=60.0):
+        """Context manager checking out a client, see `acquire`."""
+        client = self.acquire(ip, timeout)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def close(self):
+        """Disconnect all sessions."""
+        with self._lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            for session in sessions:
+                if session.idle is not None:
+                    session.idle.cancel()
+
+        for session in sessions:
+            with session.lock:
+                if session.checked is not None:
+                    _disconnect(session.client)
+
+    def _expire(self, session):
+        """Disconnect session if it is still not checked out."""
+        with self._lock:
+            if session.checkouts > 0 or self.sessions.get(session.ip) is not session:
+                return
+            del self.sessions[session.ip]
+
+        with session.lock:
+            if session.checked is not None:
+                _disconnect(session.client)
+                session.checked = None
+
+    def _alive(self, client):
+        """Return True if the client's session still answers requests."""
+        try:
+            state = client.get_node(ua.ObjectIds.Server_ServerStatus_State)
+            state.get_value()
+            return True
+        except Exception:
+            return False
+
+    def _connect(self, client, timeout):
+        """(Re)connect client, retrying with exponential backoff."""
+        _disconnect(client)  # Drop remains of a broken session
+        deadline = time.monotonic() + timeout
+        delay = 0.5
+        while True:
+            try:
+                client.connect()
+                return
+            except Exception:
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+
+
+class _Session(object):
+    """Pooled session of one PLC, see `SessionPool`."""
+
+    def __init__(self, ip, client):
+        self.ip = ip
+        self.client = client
+        self.checked = None  # Time of the last health check, None if down
+        self.checkouts = 0  # Number of users holding the client
+        self.idle = None  # Timer disconnecting the session once idle
+        self.lock = threading.Lock()  # Held while checking or reconnecting
+
+
+# Process wide session pool. Sessions are closed when the process exits.
+pool = SessionPool()
+atexit.register(pool.close)
+
+
+def create_client(ip, asynchronous=False, **kwargs):
+    """Return an OPCUA client, either synchronous or asyncio based.
+
+    Both clients share the same surface; the asyncio client's methods are
+    coroutines.
+
+    Args:
+        ip (str): PLC IP address.
+        asynchronous (bool): Return an `AsyncOPCClient` rather than an
+            `OPCClient`.
+        **kwargs: Passed on to the client constructor.
+    """
+    if asynchronous:
+        from pete.async_opc_client import AsyncOPCClient
+
+        return AsyncOPCClient(ip, **kwargs)
+
+    return OPCClient(ip, **kwargs)
+
+
+def _disconnect(client):
+    """Disconnect client, ignoring errors of an already broken session."""
+    try:
+        client.disconnect()
+    except Exception:
+        pass
@@ -0,0 +1,469 @@
+from collections import OrderedDict, namedtuple
+import threading
+import time
+
+from pete.path_index import PathIndex
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Helpers shared by the synchronous (opcua) and the asyncio (asyncua)
+# OPCUA clients. This module imports no OPCUA library: functions needing
+# OPCUA types take the `ua` module of the client's library, as both
+# libraries provide the same types.
+
+# Nodes per service request if the server does not advertise a limit
+DEFAULT_CHUNK_SIZE = 1000
+
+# Server operation limits, used to chunk batched service requests, as
+# names of `ua.ObjectIds`
+OPERATION_LIMITS = {
+    "read": "Server_ServerCapabilities_OperationLimits_MaxNodesPerRead",
+    "write": "Server_ServerCapabilities_OperationLimits_MaxNodesPerWrite",
+    "browse": "Server_ServerCapabilities_OperationLimits_MaxNodesPerBrowse",
+    "translate": (
+        "Server_ServerCapabilities_OperationLimits_MaxNodesPerTranslateBrowsePathsToNodeIds"
+    ),
+}
+
+# Publishing interval in ms of the shared data change subscription
+SUBSCRIPTION_PERIOD = 50
+
+# Attributes held by the node metadata cache, as names of `ua.AttributeIds`
+METADATA_ATTRIBUTES = ["DataType", "BrowseName", "DisplayName", "ValueRank"]
+
+# Python type used to cast user input (e.g. from the gui) per variant type
+# name
+PYTHON_TYPES = {
+    "Boolean": lambda v: str(v).lower() in ["1", "true"],
+    "SByte": int,
+    "Byte": int,
+    "Int16": int,
+    "UInt16": int,
+    "Int32": int,
+    "UInt32": int,
+    "Int64": int,
+    "UInt64": int,
+    "Float": float,
+    "Double": float,
+    "String": str,
+}
+
+# Marker of an unknown value in the shadow cache, as None is a valid value
+MISSING = object()
+
+NodeMetadata = namedtuple(
+    "NodeMetadata", ["variant_type", "browse_name", "display_name", "value_rank"]
+)
+
+
+class NodeCache(object):
+    def __init__(self, maxsize=10000):
+        """Initialize a bounded, thread safe, least recently used cache.
+
+        Args:
+            maxsize (int): Max number of entries before the least recently
+                used entry is evicted.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value of key, or None if not cached."""
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Cache value of key, evicting the least recently used entry."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, keys=None):
+        """Remove keys from cache, or clear the cache if keys is None."""
+        with self._lock:
+            if keys is None:
+                self._data.clear()
+            else:
+                for key in keys:
+                    self._data.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ShadowCache(object):
+    def __init__(self, deadband=0.0, max_age=1.0):
+        """Initialize cache of the last known value of nodes.
+
+        Values are stored with the (monotonic) time they were learnt, from
+        a data change notification, a read or a write.
+
+        Args:
+            deadband (float): Max absolute difference between two numeric
+                values for them to count as equal.
+            max_age (float): Seconds a value of a node that is not
+                monitored is considered current.
+        """
+        self.deadband = deadband
+        self.max_age = max_age
+        self.suppressed = 0  # Number of writes skipped as unchanged
+        self._values = {}  # (value, time learnt) per node id
+        self._lock = threading.Lock()
+
+    def put(self, nodeid, value):
+        """Store current value of node."""
+        with self._lock:
+            self._values[nodeid] = (value, time.monotonic())
+
+    def get(self, nodeid, monitored=False):
+        """Return known value of node, or `MISSING` if unknown or too old.
+
+        Args:
+            nodeid (ua.NodeId): Node id.
+            monitored (bool): Whether the node is monitored, in which case
+                a value never ages, as changes would have been notified.
+        """
+        with self._lock:
+            entry = self._values.get(nodeid)
+        if entry is None:
+            return MISSING
+        if not monitored and time.monotonic() - entry[1] > self.max_age:
+            return MISSING
+
+        return entry[0]
+
+    def unchanged(self, nodeid, value, monitored=False):
+        """Return True if value equals the known value, within deadband."""
+        known = self.get(nodeid, monitored)
+        if known is MISSING:
+            return False
+        if isNumber(value) and isNumber(known):
+            return abs(value - known) <= self.deadband
+
+        return type(value) is type(known) and value == known
+
+    def invalidate(self, nodeids=None):
+        """Forget values of node ids, or all values if nodeids is None."""
+        with self._lock:
+            if nodeids is None:
+                self._values.clear()
+            else:
+                for nodeid in nodeids:
+                    self._values.pop(nodeid, None)
+
+
+class Subscribers(object):
+    def __init__(self):
+        """Initialize register of the consumers of each monitored node.
+
+        A node is monitored for as long as any of its consumers, e.g. the
+        waits of a client, the simulation engine or a gui, subscribed to
+        it, so that one consumer unsubscribing does not drop the callbacks
+        or the latest value that the others rely on.
+
+        The register is not thread safe, it is guarded by the subscription
+        lock of the client.
+        """
+        self._consumers = {}  # Callback, or None, per consumer, per node id
+
+    def add(self, nodeid, consumer, callback=None):
+        """Register consumer, and its data change callback, of a node."""
+        self._consumers.setdefault(nodeid, {})[consumer] = callback
+
+    def remove(self, nodeid, consumer):
+        """Unregister consumer of a node.
+
+        Returns:
+            tuple: Callback of the consumer, or None, and True if the node
+            has no consumers left.
+        """
+        consumers = self._consumers.get(nodeid, {})
+        callback = consumers.pop(consumer, None)
+        if consumers:
+            return callback, False
+
+        self._consumers.pop(nodeid, None)
+        return callback, True
+
+    def clear(self):
+        """Unregister all consumers of all nodes."""
+        self._consumers.clear()
+
+    def __contains__(self, nodeid):
+        return nodeid in self._consumers
+
+
+def serverUrl(ip, port=4840):
+    """Return endpoint url of a PLC.
+
+    Args:
+        ip (str): PLC IP address or host name, or the full endpoint url,
+            e.g. 'opc.tcp://localhost:4841', which is returned as is.
+        port (int): TCP port of the PLC's OPCUA server.
+    """
+    if "://" in ip:
+        return ip
+
+    return "opc.tcp://{}:{}".format(ip, port)
+
+
+def chunks(items, size):
+    """Yield successive chunks of `items` holding at most `size` items."""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def nodeidOf(node):
+    """Return node id of a node, accepting both nodes and node ids."""
+    return getattr(node, "nodeid", node)
+
+
+def equals(expected):
+    """Return predicate checking for equality with an expected value."""
+    return lambda value: value == expected
+
+
+def isNumber(value):
+    """Return True if value is an int or float, but not a bool."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def toPython(variant_type, value):
+    """Cast user input, e.g. text from the gui, to the type of a variant."""
+    name = getattr(variant_type, "name", None)
+    return PYTHON_TYPES.get(name, str)(value)
+
+
+def readParameters(ua, items):
+    """Return read request of (node id, attribute) pairs."""
+    params = ua.ReadParameters()
+    for nodeid, attribute in items:
+        rv = ua.ReadValueId()
+        rv.NodeId = nodeid
+        rv.AttributeId = attribute
+        params.NodesToRead.append(rv)
+
+    return params
+
+
+def writeParameters(ua, items, values):
+    """Return write request of (node, variant type) pairs.
+
+    Args:
+        ua (module): `ua` module of the client's OPCUA library.
+        items (list(tuple)): Node and variant type of the nodes to write.
+        values (dict(Node, object)): Value to write, per node.
+    """
+    params = ua.WriteParameters()
+    for node, variant_type in items:
+        wv = ua.WriteValue()
+        wv.NodeId = nodeidOf(node)
+        wv.AttributeId = ua.AttributeIds.Value
+        # Siemens PLCs reject writes carrying timestamps, so only the
+        # variant is set.
+        wv.Value = ua.DataValue(ua.Variant(values[node], variant_type))
+        params.NodesToWrite.append(wv)
+
+    return params
+
+
+def browseParameters(ua, nodeids):
+    """Return browse request of the hierarchical child references of nodes."""
+    params = ua.BrowseParameters()
+    for nodeid in nodeids:
+        desc = ua.BrowseDescription()
+        desc.NodeId = nodeid
+        desc.BrowseDirection = ua.BrowseDirection.Forward
+        desc.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+        desc.IncludeSubtypes = True
+        desc.NodeClassMask = 0  # All node classes
+        desc.ResultMask = ua.BrowseResultMask.All
+        params.NodesToBrowse.append(desc)
+
+    return params
+
+
+def browseNextParameters(ua, pending):
+    """Return BrowseNext request of (position, continuation point) pairs."""
+    params = ua.BrowseNextParameters()
+    params.ReleaseContinuationPoints = False
+    params.ContinuationPoints = [cp for _, cp in pending]
+    return params
+
+
+def collectReferences(references, pending, results):
+    """Add browse results to references, returning pending continuations.
+
+    Args:
+        references (list(list)): Child references per position.
+        pending (list(tuple)): Position and any value, per result.
+        results (list(ua.BrowseResult)): Browse or BrowseNext results.
+
+    Returns:
+        list(tuple): (position, continuation point) of the results that
+        did not fit in the response.
+    """
+    next_pending = []
+    for (i, _), result in zip(pending, results):
+        if result.StatusCode.is_good():
+            references[i].extend(result.References)
+            if result.ContinuationPoint:
+                next_pending.append((i, result.ContinuationPoint))
+
+    return next_pending
+
+
+def operationLimitItems(ua):
+    """Return (node id, attribute) pairs to read the operation limits."""
+    return [
+        (ua.NodeId(getattr(ua.ObjectIds, name)), ua.AttributeIds.Value)
+        for name in OPERATION_LIMITS.values()
+    ]
+
+
+def parseOperationLimits(results):
+    """Return max nodes per request per operation, from a limits read.
+
+    A limit of 0, or a limit the server does not expose, means that the
+    server does not impose one, in which case `DEFAULT_CHUNK_SIZE` is used.
+    """
+    limits = {}
+    for key, dv in zip(OPERATION_LIMITS, results):
+        limit = dv.Value.Value if dv.StatusCode.is_good() else 0
+        limits[key] = limit or DEFAULT_CHUNK_SIZE
+
+    return limits
+
+
+def metadataItems(ua, nodeids):
+    """Return (node id, attribute) pairs to read the metadata of nodes."""
+    attributes = [getattr(ua.AttributeIds, name) for name in METADATA_ATTRIBUTES]
+    return [(nodeid, attribute) for nodeid in nodeids for attribute in attributes]
+
+
+def parseMetadata(results):
+    """Return metadata per node, from a read of `metadataItems`.
+
+    Returns:
+        list(tuple or ua.StatusCode): Data type node id, or None if it
+        could not be read, and `NodeMetadata` without variant type, per
+        node, or the bad status code if the node does not exist.
+    """
+    parsed = []
+    n_attrs = len(METADATA_ATTRIBUTES)
+    for i in range(0, len(results), n_attrs):
+        dtype, browse_name, display_name, rank = results[i : i + n_attrs]
+        if not browse_name.StatusCode.is_good():
+            parsed.append(browse_name.StatusCode)  # Node does not exist
+            continue
+
+        meta = NodeMetadata(
+            None,
+            browse_name.Value.Value,
+            display_name.Value.Value,
+            rank.Value.Value if rank.StatusCode.is_good() else None,
+        )
+        parsed.append((dtype.Value.Value if dtype.StatusCode.is_good() else None, meta))
+
+    return parsed
+
+
+def builtinVariantType(ua, dtype):
+    """Return variant type of a built-in data type node id, else None.
+
+    Built-in data types map directly onto a variant type, which saves
+    browsing the type hierarchy on the server.
+    """
+    if (
+        dtype.NamespaceIndex == 0
+        and dtype.Identifier in ua.VariantType._value2member_map_
+    ):
+        return ua.VariantType(dtype.Identifier)
+
+    return None
+
+
+def relativePath(ua, path):
+    """Return relative path of browse names, following hierarchical refs."""
+    rpath = ua.RelativePath()
+    for name in path:
+        el = ua.RelativePathElement()
+        el.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+        el.IsInverse = False
+        el.IncludeSubtypes = True
+        if isinstance(name, ua.QualifiedName):
+            el.TargetName = name
+        else:
+            el.TargetName = ua.QualifiedName.from_string(name)
+        rpath.Elements.append(el)
+
+    return rpath
+
+
+def browsePaths(ua, start, paths):
+    """Return TranslateBrowsePathsToNodeIds request paths from a start node."""
+    bpaths = []
+    for path in paths:
+        bpath = ua.BrowsePath()
+        bpath.StartingNode = nodeidOf(start)
+        bpath.RelativePath = relativePath(ua, path)
+        bpaths.append(bpath)
+
+    return bpaths
+
+
+def indexedPaths(index, start_id, paths):
+    """Look up browse paths in a path index.
+
+    Args:
+        index (PathIndex): Path index, or None if paths are not persisted.
+        start_id (str): Node id string of the node paths start from.
+        paths (list(list(str))): Browse paths, or single browse names.
+
+    Returns:
+        tuple: Node id string, or None if not indexed, per path, and the
+        (position, path) of each path that is not indexed.
+    """
+    nodeids = []
+    missing = []
+    for path in paths:
+        path = [path] if isinstance(path, str) else list(path)
+        nodeid = index.get(PathIndex.key(start_id, path)) if index else None
+        if nodeid is None:
+            missing.append((len(nodeids), path))
+        nodeids.append(nodeid)
+
+    return nodeids, missing
+
+
+def conditionPredicates(conditions):
+    """Return predicate per node id, of predicates or expected values per node."""
+    predicates = {}
+    for node, predicate in conditions.items():
+        if not callable(predicate):
+            predicate = equals(predicate)
+        predicates[nodeidOf(node)] = predicate
+
+    return predicates
+
+
+def satisfied(handler, predicates):
+    """Return True if the latest values of a handler satisfy all predicates."""
+    for nodeid, predicate in predicates.items():
+        dv = handler.get(nodeid)
+        if dv is None or not predicate(dv.Value.Value):
+            return False
+
+    return True
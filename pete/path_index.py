@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "pete")
+
+
+class PathIndex(object):
+    def __init__(self, server_uri, revision, cache_dir=DEFAULT_CACHE_DIR):
+        """Initialize a persistent index of browse paths to node ids.
+
+        The index is stored as one json file per server and PLC program
+        revision. A new PLC program revision thus starts with an empty
+        index, as node ids may have moved.
+
+        Args:
+            server_uri (str): OPCUA server uri, e.g. 'opc.tcp://1.2.3.4:4840'.
+            revision (str): PLC program revision (SoftwareRevision).
+            cache_dir (str): Directory to store index files in, or None to
+                keep the index in memory only.
+        """
+        self.server_uri = server_uri
+        self.revision = str(revision)
+        self.path = None
+        if cache_dir is not None:
+            key = "{}|{}".format(server_uri, self.revision).encode("utf-8")
+            name = "paths-{}.json".format(hashlib.sha1(key).hexdigest()[:16])
+            self.path = os.path.join(os.path.expanduser(cache_dir), name)
+        self.paths = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """Load index from disk, if it exists and matches server/revision."""
+        if self.path is None:
+            return
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("server") == self.server_uri and data.get("revision") == (
+            self.revision
+        ):
+            self.paths = data.get("paths", {})
+
+    def save(self):
+        """Write index to disk, if anything was added since last save."""
+        if not self.dirty or self.path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {"server": self.server_uri, "revision": self.revision}
+        data["paths"] = self.paths
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)  # Atomic, for parallel pytest workers
+        self.dirty = False
+
+    def get(self, key):
+        """Return node id string of a path key, or None if not indexed."""
+        return self.paths.get(key)
+
+    def put(self, key, nodeid):
+        """Index node id string of a path key."""
+        if self.paths.get(key) != nodeid:
+            self.paths[key] = nodeid
+            self.dirty = True
+
+    def clear(self):
+        """Empty index, on disk as well as in memory."""
+        self.paths = {}
+        self.dirty = False
+        if self.path is None:
+            return
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def key(start, path):
+        """Return index key of a browse path from a start node id string.
+
+        Path elements may be browse name strings, e.g. "3:Inputs", or
+        qualified names, as accepted by `Node.get_child`.
+        """
+        names = [n if isinstance(n, str) else n.to_string() for n in path]
+        return "/".join([start] + names)
@@ -0,0 +1,205 @@
+import fnmatch
+import re
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Separator of the parts of a PV name, e.g. 'system:device:field'
+SEPARATOR = ":"
+
+# Characters making a search pattern a glob pattern rather than a substring
+GLOB_CHARS = "*?["
+
+
+class PVNode(object):
+    """Node of a PV trie, i.e. one part of one or more PV names."""
+
+    __slots__ = ("name", "parent", "children", "is_pv", "rows", "row")
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = None  # Child per name, None while a leaf
+        self.is_pv = False  # True if the path to this node is a PV name
+        self.rows = None  # Children sorted by name, built on first use
+        self.row = 0  # Position among the sorted children of the parent
+
+    def child(self, name):
+        """Return child with name, or None."""
+        if self.children is None:
+            return None
+
+        return self.children.get(name)
+
+    def sortedChildren(self):
+        """Return children sorted by name.
+
+        The sorted list is kept, and the row of each child set, so that
+        only nodes that have been listed (e.g. shown in the gui) pay for
+        it.
+        """
+        if self.children is None:
+            return []
+
+        if self.rows is None:
+            self.rows = [self.children[name] for name in sorted(self.children)]
+            for row, child in enumerate(self.rows):
+                child.row = row
+
+        return self.rows
+
+    def hasChildren(self):
+        return bool(self.children)
+
+    def path(self):
+        """Return full name of node, e.g. 'Tgt-HeC1010:Proc-TT-001'."""
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+
+        return SEPARATOR.join(reversed(parts))
+
+
+class PVTrie(object):
+    def __init__(self):
+        """Initialize prefix trie of PV names.
+
+        PV names are split on ':' into e.g. system, device and field, and
+        PVs sharing a prefix share the nodes of that prefix. Children are
+        looked up by name in a dict, so adding a PV is linear in its
+        number of parts, regardless of the number of PVs.
+        """
+        self.root = PVNode("", None)
+        self.n_pvs = 0
+        self._names = None  # Sorted PV names, built on first search
+        self._lower = None  # Lowercased `_names`, to search ignoring case
+
+    def __len__(self):
+        return self.n_pvs
+
+    def __iter__(self):
+        """Yield all PV names, sorted."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.is_pv:
+                yield node.path()
+            stack.extend(reversed(node.sortedChildren()))
+
+    def add(self, pvname):
+        """Add PV name, returning its node."""
+        node = self.root
+        for name in pvname.split(SEPARATOR):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(name)
+            if child is None:
+                child = PVNode(name, node)
+                node.children[name] = child
+                node.rows = None
+            node = child
+
+        if not node.is_pv:
+            node.is_pv = True
+            self.n_pvs += 1
+            self._names = None
+            self._lower = None
+
+        return node
+
+    def find(self, pvname):
+        """Return node of PV name or prefix, or None if not found."""
+        node = self.root
+        for name in pvname.split(SEPARATOR):
+            node = node.child(name)
+            if node is None:
+                return None
+
+        return node
+
+    def names(self):
+        """Return sorted list of all PV names."""
+        if self._names is None:
+            self._names = list(self)
+            self._lower = [name.lower() for name in self._names]
+
+        return self._names
+
+    def search(self, pattern, within=None):
+        """Return positions in `names` of the PV names matching a pattern.
+
+        Case is ignored. The names are lowercased once, when the list of
+        names is built, rather than on every search, so a search is one
+        pass of substring checks over the names searched.
+
+        Args:
+            pattern (str): Substring of the PV names, or a glob pattern
+                matching the full PV names if it holds any of '*?[', e.g.
+                '*:Proc-TT-00?:HIHI'.
+            within (list(int)): Positions of the PV names to search, e.g.
+                the result of a search for a shorter substring, while a
+                pattern is typed. Defaults to all PV names.
+
+        Returns:
+            list(int): Sorted positions in `names` of the matching names.
+        """
+        self.names()
+        lower = self._lower
+        positions = range(len(lower)) if within is None else within
+        if not pattern:
+            return list(positions)
+
+        if not any(c in pattern for c in GLOB_CHARS):
+            return _containing(lower, positions, pattern.lower())
+
+        if re.fullmatch(r"\*?[^*?[]*\*?", pattern):
+            # Substring, prefix or suffix pattern, e.g. 'Tgt-HeC1010:*'
+            literal = pattern.strip("*").lower()
+            if pattern[0] != "*" and pattern[-1] != "*":
+                return [i for i in positions if lower[i] == literal]
+            if pattern[0] != "*":
+                return [i for i in positions if lower[i].startswith(literal)]
+            if pattern[-1] != "*":
+                return [i for i in positions if lower[i].endswith(literal)]
+            return _containing(lower, positions, literal)
+
+        # Names must hold every literal part of the glob pattern, which is
+        # much faster to check than the pattern itself.
+        literals = re.split(r"[*?]|\[[^\]]*\]", pattern.lower())
+        for literal in sorted(set(literals) - {""}, key=len, reverse=True):
+            positions = _containing(lower, positions, literal)
+
+        match = re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+        return [i for i in positions if match(lower[i])]
+
+    @classmethod
+    def fromLines(cls, lines):
+        """Return trie of PV names, one per line, e.g. the output of 'dbl'.
+
+        Lines are consumed one at a time, so a file object is streamed
+        rather than read into memory. Blank lines are skipped.
+
+        Args:
+            lines (iterable(str)): PV names.
+        """
+        trie = cls()
+        for line in lines:
+            pvname = line.strip()
+            if pvname:
+                trie.add(pvname)
+
+        return trie
+
+    @classmethod
+    def fromFile(cls, path):
+        """Return trie of PV names in a file, one per line."""
+        with open(path) as f:
+            return cls.fromLines(f)
+
+
+def _containing(lower, positions, substring):
+    """Return positions of the lowercased names holding a lowercase substring."""
+    return [i for i in positions if substring in lower[i]]
@@ -1,26 +1,100 @@
+import math
+
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 
 class CV(object):
-    def __init__(self, client, cmd_openness, fb_openness):
+    def __init__(
+        self,
+        client,
+        cmd_openness,
+        fb_openness,
+        slew_rate=10.0,
+        rate=10.0,
+        deadband=0.0,
+        stiction=0.0,
+        name=None,
+        openness=None,
+    ):
         """Initialize the device object.
 
+        The simulator reacts to changes of the command, notified through
+        the client's subscription, rather than polling it. While the
+        feedback differs from the command, it is moved toward it at the
+        slew rate, with `rate` writes per second. At rest, the simulator
+        costs nothing.
+
         Args:
             client (OPCClient): OPCUA client connected to PLC.
             cmd_openness (Node): OPCUA node of valve's openness command in %.
             fb_openness (Node): OPCUA node of valve's openness feedback in %.
+            slew_rate (float): Max speed of the valve in % per second.
+            rate (float): Feedback updates per second while moving.
+            deadband (float): Max difference in % between feedback and
+                command at which the valve stops.
+            stiction (float): Min difference in % between feedback and
+                command for a valve at rest to start moving. The valve
+                then moves all the way to the command.
+            name (str): Display name of the feedback node, e.g. from a
+                snapshot. Read from the PLC when first needed if None.
+            openness (float): Feedback shown by the PLC, which the valve
+                starts from, e.g. from one read of all valves. Read from
+                the PLC on start if None.
         """
         self.client = client
         self.cmd_openness = cmd_openness
         self.fb_openness = fb_openness
+        self.slew_rate = slew_rate
+        self.rate = rate
+        self.deadband = deadband
+        self.stiction = stiction
+        self.engine = None
+        self.cmd = None  # Latest command, None until notified
+        self.fb = openness  # Current feedback, None until started
+        self.name = name  # Feedback node name, e.g. 'hwi_CV-001'
+        self.moving = None  # Timer moving the valve
+
+    def start(self, engine):
+        """Start reacting to command changes.
+
+        Args:
+            engine (Engine): Simulation engine running the device.
+        """
+        self.engine = engine
+        if self.fb is None:
+            self.fb = self.client.getValue(self.fb_openness)
+        if self.fb is None:
+            self.fb = 0.0
+        engine.subscribe([self.cmd_openness], self.command)
+
+    def command(self, nodeid, value):
+        """Start moving toward a new command, if outside stiction band."""
+        self.cmd = value
+        error = abs(value - self.fb)
+        if self.moving is None and error > max(self.deadband, self.stiction):
+            self.moving = self.engine.call_every(1.0 / self.rate, self.move)
+
+    def move(self):
+        """Move feedback one update toward the command, stopping there."""
+        error = self.cmd - self.fb
+        step = self.slew_rate / self.rate
+        if abs(error) <= step:
+            self.fb = self.cmd
+        else:
+            self.fb += math.copysign(step, error)
+
+        # Integer commands get integer feedback, like they were copied
+        fb = round(self.fb) if isinstance(self.cmd, int) else self.fb
+        self.engine.write(self.fb_openness, fb)
 
-    def run(self):
-        """ Run infinite loop, updating values of device."""
-        while True:
-            self.client.setValue(self.fb_openness, self.cmd_openness.get_value())
+        if abs(self.cmd - self.fb) <= self.deadband:
+            self.moving.cancel()
+            self.moving = None
 
     def get_name(self):
         """Returns name of device"""
-        return self.fb_openness.get_display_name().Text.split("_")[1]
+        if self.name is None:
+            self.name = self.fb_openness.get_display_name().Text
+        return self.name.split("_")[1]
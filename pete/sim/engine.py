@@ -0,0 +1,281 @@
+import heapq
+import itertools
+import math
+import threading
+
+from pete import clock as pete_clock
+from pete.opc_common import nodeidOf
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Time resolution of the scheduler in seconds. Timers due in the same slot
+# fire in the same tick, so their writes go out in one batch.
+RESOLUTION = 0.01
+
+
+class Timer(object):
+    """Scheduled call of an engine, see `Engine.call_later`."""
+
+    __slots__ = ("slot", "period", "callback", "args", "cancelled")
+
+    def __init__(self, slot, period, callback, args):
+        self.slot = slot  # Slot the call is due in
+        self.period = period  # Slots between calls, None if called once
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Do not call the callback again."""
+        self.cancelled = True
+
+
+class Engine(object):
+    def __init__(self, client, resolution=RESOLUTION, clock=None):
+        """Initialize simulation engine driving many device models.
+
+        All devices are stepped from one thread, by one scheduler: timers
+        are kept in a heap by the slot (multiple of `resolution`) they are
+        due in, and each tick calls the timers due, then sends all values
+        written during the tick with one batched write (see
+        `OPCClient.write_many`). The number of devices is thus not bounded
+        by threads, and the number of Write requests per second is bounded
+        by the tick rate rather than by the number of devices.
+
+        Devices are objects with a `step(engine)` method, called every
+        period, and/or a `start(engine)` method, e.g. subscribing to data
+        changes the device reacts to (see `add` and `subscribe`). Device
+        models may also schedule calls of their own (see `call_later`),
+        e.g. to end the travel of a valve.
+
+        Time is taken from a pete clock, so the simulation can be run
+        faster than real time, or on virtual time (see `pete.clock`).
+
+        Args:
+            client (OPCClient): OPCUA client connected to PLC.
+            resolution (float): Time resolution in seconds.
+            clock (Clock): Clock of the simulation. Defaults to the clock
+                in use (see `pete.clock.use`).
+        """
+        self.client = client
+        self.resolution = resolution
+        self.clock = clock if clock is not None else pete_clock.get()
+        self.devices = []
+        self.writes = {}  # Value per node, written at the end of the tick
+        self.listeners = {}  # Tuple of device callbacks per subscribed node id
+        self.notified = {}  # Latest notified value per subscribed node id
+        self.now = self.clock.now()  # Time of the current tick
+        self.n_ticks = 0
+        self.n_writes = 0
+        self._timers = []  # Heap of (slot, sequence number, timer)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def add(self, device, period=None):
+        """Add device, started now and stepped every period seconds.
+
+        If the device has a `start(engine)` method, it is called, e.g. to
+        subscribe to the signals the device reacts to (see `subscribe`).
+        Devices added with the same period are stepped in the same ticks,
+        so their writes are batched together.
+
+        Args:
+            device (object): Device model with a `step(engine)` method, if
+                it is stepped, and/or a `start(engine)` method.
+            period (float): Seconds between steps, or None to not step the
+                device.
+
+        Returns:
+            Timer: Timer stepping the device, to cancel it, or None.
+        """
+        self.devices.append(device)
+        if hasattr(device, "start"):
+            device.start(self)
+        if period is None:
+            return None
+
+        return self.call_every(period, device.step, self)
+
+    def subscribe(self, nodes, callback):
+        """Call callback(nodeid, value) on the engine thread on changes.
+
+        The nodes are monitored through the client's shared subscription,
+        and each data change notification is handed over to the engine
+        thread, so device models need no locking and react within a tick
+        without polling. The engine subscribes once per node, as one
+        consumer for all its devices, and unsubscribes when stopped.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes to monitor.
+            callback (callable): Function taking the node id and the new
+                value of a node.
+        """
+        new = []
+        for node in nodes:
+            nodeid = nodeidOf(node)
+            if nodeid not in self.listeners:
+                new.append(node)
+            elif nodeid in self.notified:
+                self.call_later(0, callback, nodeid, self.notified[nodeid])
+            self.listeners[nodeid] = self.listeners.get(nodeid, ()) + (callback,)
+
+        if new:
+            self.client.subscribe(new, self._notify, consumer=self)
+
+    def unsubscribe(self):
+        """Stop monitoring the nodes subscribed to by the devices."""
+        nodeids = list(self.listeners)
+        self.listeners.clear()
+        self.notified.clear()
+        if not nodeids:
+            return
+
+        try:
+            self.client.unsubscribe(nodeids, consumer=self)
+        except Exception as e:
+            print("Unsubscribe of {} nodes failed: {}".format(len(nodeids), e))
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) on the engine thread after delay seconds.
+
+        This may be called from any thread, e.g. from data change
+        notifications, to hand events over to the engine thread. On a
+        virtual clock, time does not move on before the engine has run
+        the calls due (see `VirtualClock.notify`).
+
+        Returns:
+            Timer: Timer, to cancel the call.
+        """
+        return self._schedule(delay, None, callback, args)
+
+    def call_every(self, period, callback, *args):
+        """Call callback(*args) on the engine thread every period seconds.
+
+        The first call is due after one period. Calls are not made up for
+        if the engine falls behind.
+
+        Returns:
+            Timer: Timer, to cancel the calls.
+        """
+        return self._schedule(period, period, callback, args)
+
+    def write(self, node, value):
+        """Write value to node at the end of the current tick.
+
+        Only the last value written to a node during a tick is sent.
+        """
+        self.writes[node] = value
+
+    def write_many(self, values):
+        """Write value per node at the end of the current tick."""
+        self.writes.update(values)
+
+    def flush(self):
+        """Send the values written since the last flush, in one batch."""
+        if not self.writes:
+            return
+
+        writes, self.writes = self.writes, {}
+        try:
+            self.client.write_many(writes)
+        except Exception as e:
+            print("Write of {} values failed: {}".format(len(writes), e))
+        else:
+            self.n_writes += len(writes)
+
+    def run(self):
+        """Run the scheduler on this thread, until `stop` is called."""
+        self._running = True
+        while True:
+            due = self._wait()
+            if due is None:
+                break
+
+            self.n_ticks += 1
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    name = getattr(timer.callback, "__qualname__", timer.callback)
+                    print("{} failed: {}".format(name, e))
+            self.flush()
+
+        self.flush()
+
+    def start(self):
+        """Run the scheduler on a background thread."""
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name="pete-sim", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler after the current tick, and wait for it.
+
+        The nodes the devices subscribed to are unsubscribed.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+        self.unsubscribe()
+
+    def _schedule(self, delay, period, callback, args):
+        """Add timer due after delay seconds, then every period seconds."""
+        slot = self._slot(self.clock.now() + delay)
+        slots = None if period is None else max(1, round(period / self.resolution))
+        timer = Timer(slot, slots, callback, args)
+        with self._cond:
+            heapq.heappush(self._timers, (slot, next(self._seq), timer))
+            self.clock.notify(self._cond)
+
+        return timer
+
+    def _wait(self):
+        """Wait for the next slot with timers due, returning the timers.
+
+        Periodic timers are rescheduled. Returns None once stopped.
+        """
+        with self._cond:
+            while self._running:
+                now = self.clock.now()
+                if self._timers and self._timers[0][0] * self.resolution <= now:
+                    break
+                timeout = None
+                if self._timers:
+                    timeout = self._timers[0][0] * self.resolution - now
+                self.clock.wait(self._cond, timeout)
+            if not self._running:
+                return None
+
+            self.now = now
+            current = self._slot(now)
+            due = []
+            while self._timers and self._timers[0][0] <= current:
+                _, _, timer = heapq.heappop(self._timers)
+                if timer.cancelled:
+                    continue
+                due.append(timer)
+                if timer.period is not None:
+                    # Next call a period after this one, or in the next
+                    # slot if the engine fell behind
+                    timer.slot = max(timer.slot + timer.period, current + 1)
+                    heapq.heappush(self._timers, (timer.slot, next(self._seq), timer))
+
+        return due
+
+    def _slot(self, t):
+        """Return first slot at or after time t."""
+        return math.ceil(round(t / self.resolution, 6))
+
+    def _notify(self, nodeid, value):
+        """Hand a data change over to the callbacks of a node."""
+        self.notified[nodeid] = value
+        for callback in self.listeners.get(nodeid, ()):
+            self.call_later(0, callback, nodeid, value)
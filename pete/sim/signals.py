@@ -0,0 +1,122 @@
+import numpy as np
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Raw count range of Siemens analog inputs, 0-100 % of the signal range
+MAX_COUNTS = 27648
+
+
+class SignalBank(object):
+    def __init__(
+        self,
+        nodes,
+        setpoint=13500.0,
+        noise=150.0,
+        tau=0.0,
+        ramp=0.0,
+        step=0.0,
+        step_rate=0.0,
+        sine=0.0,
+        frequency=0.1,
+        seed=None,
+    ):
+        """Initialize signal generator of many analog transmitters.
+
+        The signals of all transmitters are held in arrays, and the next
+        sample of every transmitter is computed with a few vectorized
+        operations per step, rather than one Python call per transmitter.
+        All samples of a step are written together, so with the engine
+        they go out in one batched write (see `Engine.flush`).
+
+        Each signal is the output of a first-order lag toward a setpoint,
+        plus a sine and gaussian noise, in raw counts clipped to 0-27648.
+        The setpoint ramps, bouncing off the ends of the range, and jumps
+        by random steps. Parameters are scalars, for all transmitters, or
+        sequences with one value per transmitter.
+
+        Args:
+            nodes (list(Node)): OPCUA nodes of the transmitters' raw values.
+            setpoint (float): Initial setpoint in counts.
+            noise (float): Standard deviation of the noise in counts.
+            tau (float): Time constant in seconds of the lag toward the
+                setpoint. 0 follows the setpoint at once.
+            ramp (float): Speed of the setpoint in counts per second.
+            step (float): Size in counts of setpoint steps.
+            step_rate (float): Mean number of steps per second.
+            sine (float): Amplitude of the sine in counts.
+            frequency (float): Frequency of the sine in Hz.
+            seed (int): Seed of the random generator, for repeatable runs.
+        """
+        self.nodes = list(nodes)
+        n = len(self.nodes)
+        self.setpoint = _array(setpoint, n)
+        self.noise = _array(noise, n)
+        self.tau = _array(tau, n)
+        self.ramp = _array(ramp, n)
+        self.step_size = _array(step, n)
+        self.step_rate = _array(step_rate, n)
+        self.sine = _array(sine, n)
+        self.frequency = _array(frequency, n)
+        self.rng = np.random.default_rng(seed)
+        self.phase = self.rng.uniform(0, 2 * np.pi, n)
+        self.output = self.setpoint.copy()  # Output of the lag
+        self.t = 0.0  # Seconds simulated
+        self.last = None  # Engine time of the last step
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def sample(self, dt):
+        """Advance all signals by dt seconds, returning raw counts.
+
+        Returns:
+            numpy.ndarray: Value in counts per transmitter, as integers.
+        """
+        n = len(self.nodes)
+        self.t += dt
+
+        # Ramp the setpoints, bouncing off the ends of the range
+        self.setpoint += self.ramp * dt
+        high = self.setpoint > MAX_COUNTS
+        low = self.setpoint < 0
+        self.setpoint[high] = 2 * MAX_COUNTS - self.setpoint[high]
+        self.setpoint[low] = -self.setpoint[low]
+        self.ramp[high | low] *= -1
+
+        # Random steps, about step_rate per second
+        steps = self.rng.random(n) < self.step_rate * dt
+        if steps.any():
+            signs = self.rng.choice((-1.0, 1.0), steps.sum())
+            self.setpoint[steps] += signs * self.step_size[steps]
+            np.clip(self.setpoint, 0, MAX_COUNTS, out=self.setpoint)
+
+        # First-order lag toward the setpoints
+        rate = np.divide(dt, self.tau, out=np.full(n, np.inf), where=self.tau > 0)
+        alpha = -np.expm1(-rate)  # 1 where tau is 0
+        self.output += alpha * (self.setpoint - self.output)
+
+        value = self.output + self.rng.normal(0.0, 1.0, n) * self.noise
+        value += self.sine * np.sin(2 * np.pi * self.frequency * self.t + self.phase)
+        return np.clip(np.rint(value), 0, MAX_COUNTS).astype(np.int64)
+
+    def step(self, engine):
+        """Write the next sample of all transmitters.
+
+        Args:
+            engine (Engine): Simulation engine stepping the bank.
+        """
+        dt = 0.0 if self.last is None else engine.now - self.last
+        self.last = engine.now
+        values = self.sample(dt)
+        engine.write_many(dict(zip(self.nodes, values.tolist())))
+
+    def get_name(self):
+        """Returns name of the bank"""
+        return "{} analog transmitters".format(len(self.nodes))
+
+
+def _array(value, n):
+    """Return float array of n values, from a scalar or a sequence."""
+    return np.array(np.broadcast_to(np.asarray(value, dtype=float), (n,)))
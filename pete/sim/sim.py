@@ -1,8 +1,11 @@
 import argparse
-import threading
+import time
 
-from petenv.opc_client import OPCClient
-from .analog import Analog
+from pete import clock
+from pete.opc_client import OPCClient
+from pete.snapshot import Snapshot
+from .engine import Engine
+from .signals import SignalBank
 from .ysv import YSV
 from .cv import CV
 
@@ -11,49 +14,119 @@ __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 
-class SimThread(threading.Thread):
-    """Simulation thread"""
-
-    def __init__(self, threadID, name, sim):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
-        self.name = name
-        self.sim = sim
-
-    def run(self):
-        print("Starting " + self.name)
-        self.sim.run()
-        print("Exiting " + self.name)
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simulator")
-    parser.add_argument("ip", type=str, help="plc ip address")
+    parser.add_argument(
+        "ip", type=str, help="plc ip address, or url e.g. opc.tcp://localhost:4841"
+    )
+    parser.add_argument(
+        "-a", "--analog-period", type=float, default=0.1, help="analog period (s)"
+    )
+    parser.add_argument(
+        "--setpoint", type=float, default=13500.0, help="analog setpoint (counts)"
+    )
+    parser.add_argument(
+        "--noise", type=float, default=150.0, help="analog noise std (counts)"
+    )
+    parser.add_argument("--tau", type=float, default=0.0, help="analog lag (s)")
+    parser.add_argument(
+        "--ramp", type=float, default=0.0, help="analog ramp (counts/s)"
+    )
+    parser.add_argument("--step", type=float, default=0.0, help="analog step (counts)")
+    parser.add_argument(
+        "--step-rate", type=float, default=0.0, help="analog steps per second"
+    )
+    parser.add_argument(
+        "--sine", type=float, default=0.0, help="analog sine amplitude (counts)"
+    )
+    parser.add_argument(
+        "--frequency", type=float, default=0.1, help="analog sine frequency (Hz)"
+    )
+    parser.add_argument(
+        "-m", "--move-time", type=float, default=0.7, help="ysv travel time (s)"
+    )
+    parser.add_argument(
+        "--fault",
+        action="append",
+        default=[],
+        metavar="TAG",
+        help="fault ysv TAG, e.g. YSV-001 (repeatable)",
+    )
+    parser.add_argument(
+        "--fault-at", type=float, default=0.0, help="time until faults (s)"
+    )
+    parser.add_argument(
+        "--fault-for", type=float, default=None, help="fault duration (s), or forever"
+    )
+    parser.add_argument(
+        "--stuck",
+        action="store_true",
+        help="faulted ysv freeze, rather than show opened and closed",
+    )
+    parser.add_argument(
+        "-s", "--slew-rate", type=float, default=10.0, help="cv speed (%%/s)"
+    )
+    parser.add_argument(
+        "-r", "--cv-rate", type=float, default=10.0, help="cv updates per second"
+    )
+    parser.add_argument("--deadband", type=float, default=0.0, help="cv deadband (%%)")
+    parser.add_argument("--stiction", type=float, default=0.0, help="cv stiction (%%)")
+    parser.add_argument(
+        "-t", "--time-scale", type=float, default=1.0, help="simulated s per real s"
+    )
+    parser.add_argument(
+        "--virtual-clock",
+        type=float,
+        metavar="SECONDS",
+        default=None,
+        help="run SECONDS of simulated time on a virtual clock, as fast as possible",
+    )
     args = parser.parse_args()
 
-    # Create and connect client
-    client = OPCClient(args.ip)
+    # Simulated timing, e.g. valve travel, runs time-scale times faster, or
+    # only as time is advanced below
+    if args.virtual_clock is not None:
+        clock.use(clock.VirtualClock())
+    elif args.time_scale != 1.0:
+        clock.use(clock.ScaledClock(args.time_scale))
+
+    # Create and connect client. The shadow cache skips rewrites of values
+    # the PLC already holds.
+    client = OPCClient(args.ip, shadow=True)
     client.connect()
 
     # Get all TT, PT and RT nodes
-    objects = client.get_root_node().get_child("0:Objects").get_children()
-    plc = objects[-1]  # Node for PLC
-    inputs = plc.get_child("3:Inputs")  # Node for plc inputs
-    outputs = plc.get_child("3:Outputs")  # Node for plc outputs
+    snapshot = Snapshot.fromClient(client)  # PLC address space
+    plc_index = snapshot.plc()
+    plc = snapshot.node(client, plc_index)  # Node for PLC
+    inputs = snapshot.child(plc_index, "3:Inputs")  # Index of plc inputs
+    outputs = snapshot.child(plc_index, "3:Outputs")  # Index of plc outputs
 
     analog_tags = ["_TT-", "_PT-", "_RT-", "_FT"]  # Analog tags to look for
-    analog_instruments = []  # List of analog nodes
-    for node in inputs.get_children():
-        node_name = node.get_display_name().Text  # Node name
-        for tag in analog_tags:
-            if tag in node_name and node_name not in analog_instruments:
-                # Create simulator objects
-                analog_instruments.append(Analog(client, node, (13000, 14000)))
-
-    valves = []
+    analog_nodes = []  # List of analog nodes
+    for i in snapshot.children(inputs):
+        node_name = snapshot.display_name(i)  # Node name
+        if any(tag in node_name for tag in analog_tags):
+            analog_nodes.append(snapshot.node(client, i))
+
+    # One signal generator for all analog instruments
+    analogs = SignalBank(
+        analog_nodes,
+        setpoint=args.setpoint,
+        noise=args.noise,
+        tau=args.tau,
+        ramp=args.ramp,
+        step=args.step,
+        step_rate=args.step_rate,
+        sine=args.sine,
+        frequency=args.frequency,
+    )
+
+    # Find all valves, and the paths of their signals relative to the plc
     valve_tags = []
-    for node in outputs.get_children():
-        node_name = node.get_display_name().Text
+    valve_paths = []
+    for i in snapshot.children(outputs):
+        node_name = snapshot.display_name(i)
 
         try:
             pid_tag = node_name.split("_")[1]  # P&ID tag
@@ -64,21 +137,107 @@ if __name__ == "__main__":
         if pid_tag in valve_tags:
             continue
 
-        if "YSV" in node_name and node_name not in valves:
-            e_node = outputs.get_child(node_name)  # 'energize'
-            o_node = inputs.get_child("hwi_" + pid_tag + "_opened")  # 'opened'
-            c_node = inputs.get_child("hwi_" + pid_tag + "_closed")  # 'closed'
-            valves.append(YSV(client, e_node, o_node, c_node))
+        if "YSV" in node_name:
+            valve_paths.append(
+                (
+                    YSV,
+                    pid_tag,
+                    node_name,
+                    [
+                        ["3:Outputs", "3:" + node_name],  # 'energize'
+                        ["3:Inputs", "3:hwi_" + pid_tag + "_opened"],  # 'opened'
+                        ["3:Inputs", "3:hwi_" + pid_tag + "_closed"],  # 'closed'
+                    ],
+                )
+            )
             valve_tags.append(pid_tag)
-        elif "CV-" in node_name and node_name not in valves:
-            o_node = outputs.get_child("hwo_" + pid_tag)  # 'open'
-            i_node = inputs.get_child("hwi_" + pid_tag)  # 'openness'
-            valves.append(CV(client, o_node, i_node))
+        elif "CV-" in node_name:
+            valve_paths.append(
+                (
+                    CV,
+                    pid_tag,
+                    "hwi_" + pid_tag,
+                    [
+                        ["3:Outputs", "3:hwo_" + pid_tag],  # 'open'
+                        ["3:Inputs", "3:hwi_" + pid_tag],  # 'openness'
+                    ],
+                )
+            )
             valve_tags.append(pid_tag)
 
-    # Create and start threads
-    for a in analog_instruments:
-        SimThread(1, a.get_name(), a).start()
+    # Resolve all signal nodes in one request
+    paths = [p for _, _, _, device_paths in valve_paths for p in device_paths]
+    resolved = client.resolvePaths(paths, plc)
+    client.subscribe([n for n in resolved if n is not None])  # Keeps shadow current
+    nodes = iter(resolved)
+    found = []
+    for device, pid_tag, name, device_paths in valve_paths:
+        device_nodes = [next(nodes) for _ in device_paths]
+        if None in device_nodes:
+            missing = [p for p, n in zip(device_paths, device_nodes) if n is None]
+            print("Skipping {}, signals not found: {}".format(device.__name__, missing))
+            continue
+        found.append((device, pid_tag, name, device_nodes))
+
+    # Read the state of all valves ('opened', or openness) in one request
+    states = client.read_many([device_nodes[1] for _, _, _, device_nodes in found])
+    valves = []
+    faulty = {}  # Valve to fault per P&ID tag, see '--fault'
+    cv_options = {
+        "slew_rate": args.slew_rate,
+        "rate": args.cv_rate,
+        "deadband": args.deadband,
+        "stiction": args.stiction,
+    }
+    ysv_options = {"move_time": args.move_time}
+    for (device, pid_tag, name, device_nodes), dv in zip(found, states):
+        state = dv.Value.Value if dv.StatusCode.is_good() else None
+        if device is CV:
+            options = dict(cv_options, name=name, openness=state)
+        else:
+            options = dict(ysv_options, name=name, opened=state)
+        valves.append(device(client, *device_nodes, **options))
+        if device is YSV and pid_tag in args.fault:
+            faulty[pid_tag] = valves[-1]
+
+    unknown = set(args.fault) - set(faulty)
+    if unknown:
+        print("No ysv to fault: {}".format(", ".join(sorted(unknown))))
+
+    # Step all devices from one scheduler, on this thread, or on a thread of
+    # its own while this thread advances the virtual clock
+    engine = Engine(client)
+    engine.add(analogs, args.analog_period)
 
     for v in valves:
-        SimThread(1, v.get_name(), v).start()
+        engine.add(v)  # Valves react to command changes, and are not stepped
+
+    for v in faulty.values():
+        v.injectFault(args.fault_at, args.fault_for, args.stuck)
+
+    print("Simulating {} analogs and {} valves".format(len(analogs), len(valves)))
+    try:
+        if args.virtual_clock is None:
+            engine.run()
+        else:
+            # Advance one tick at a time, so that data changes notified by
+            # the server are handed over about when they were written
+            engine.start()
+            virtual = clock.get()
+            end = virtual.now() + args.virtual_clock
+            start = time.monotonic()
+            while virtual.now() < end:
+                virtual.advance(engine.resolution)
+            print(
+                "Simulated {} s in {:.1f} s: {} ticks, {} writes".format(
+                    args.virtual_clock,
+                    time.monotonic() - start,
+                    engine.n_ticks,
+                    engine.n_writes,
+                )
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop()
+        client.disconnect()
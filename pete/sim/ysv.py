@@ -1,60 +1,192 @@
-import time
-
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
+# States of a valve
+CLOSED = "closed"
+OPENING = "opening"
+OPEN = "open"
+CLOSING = "closing"
+FAULT = "fault"
+
 
 class YSV(object):
-    def __init__(self, client, energized_node, opened_node, closed_node):
+    def __init__(
+        self,
+        client,
+        energized_node,
+        opened_node,
+        closed_node,
+        move_time=0.7,
+        name=None,
+        opened=None,
+    ):
         """Initialize the device object.
 
+        The valve is a state machine (closed, opening, open, closing,
+        fault) driven by data change notifications of the 'energize'
+        signal, rather than by polling. Travel is ended by an engine timer,
+        so valves do not block each other, and a command reversing the
+        valve mid-travel takes effect at once: the valve travels back from
+        where it is, taking as long as it took to get there.
+
+        This simulator handles both valves that energize to open, and
+        valves that energize to close.
+
+        Caveat: PLC tag for energize signal must end with 'open' or
+        'close', indicating the function of energizion.
+
         Args:
             client (OPCClient): OPCUA client connected to PLC.
             energized_node (Node): OPCUA node of valve's 'energize' signal.
             opened_node (Node): OPCUA node of valve's 'opened' signal.
             closed_node (Node): OPCUA node of valve's 'closed' signal.
+            move_time (float): Time in seconds to open/close valve.
+            name (str): Display name of the 'energize' node, e.g. from a
+                snapshot. Read from the PLC if None.
+            opened (bool): 'opened' signal shown by the PLC, which the
+                valve starts from, e.g. from one read of all valves. Read
+                from the PLC on start if None.
         """
         self.client = client
         self.energized_node = energized_node
         self.opened_node = opened_node
         self.closed_node = closed_node
+        self.move_time = move_time
+        self.engine = None
+        self.state = CLOSED
+        self.position = 0.0  # 0 if closed, 1 if open, at time `since`
+        self.since = 0.0  # Engine time of the last change of state
+        self.open_cmd = False  # True if commanded to open
+        self.timer = None  # Timer ending the current travel
+        self.opened = opened
 
-    def run(self):
-        """Run infinite loop, updating values of device.
+        # Determine if energize to open or energize to close
+        if name is None:
+            name = energized_node.get_display_name().Text
+        self.name = name  # 'energize' node name, e.g. 'hwo_YSV-001_open'
+        self.energize_to_open = "open" in name
 
-        This simulator handles both valves that energize to open, and
-        valves that energize to close.
+    def start(self, engine):
+        """Take the state shown by the PLC, and start reacting to commands.
 
-        Caveat: PLC tag for energize signal must end with 'open' or
-        'close', indicating the function of energizion.
+        Args:
+            engine (Engine): Simulation engine running the device.
         """
-        oc = [self.opened_node, self.closed_node]  # Open/close nodes
-        name = self.energized_node.get_display_name().Text  # 'energized' node name
-        move_time = 0.7  # Time in seconds to open/close valve
+        self.engine = engine
+        self.since = engine.now
+        if self.opened is None:
+            self.opened = self.client.getValue(self.opened_node)
+        if self.opened:
+            self.state, self.position = OPEN, 1.0
+        else:
+            self.state, self.position = CLOSED, 0.0
+        self.show()
+        engine.subscribe([self.energized_node], self.command)
 
-        # Determine if energize to open or energize to close
-        if "open" in name:
-            et = 0  # Energize type is 'open'
+    def command(self, nodeid, energized):
+        """Follow a change of the 'energize' signal."""
+        self.open_cmd = bool(energized) == self.energize_to_open
+        self.update()
+
+    def update(self):
+        """Start travel if the command does not match the state."""
+        if self.state == FAULT:
+            return
+
+        if self.open_cmd and self.state in (CLOSED, CLOSING):
+            self.travel(OPENING)
+        elif not self.open_cmd and self.state in (OPEN, OPENING):
+            self.travel(CLOSING)
+
+    def travel(self, state):
+        """Start opening or closing from the current position."""
+        self.position = self.positionAt(self.engine.now)
+        if self.timer is not None:
+            self.timer.cancel()
+
+        distance = 1.0 - self.position if state == OPENING else self.position
+        self.setState(state)
+        self.timer = self.engine.call_later(distance * self.move_time, self.arrive)
+
+    def arrive(self):
+        """End travel, setting the state reached."""
+        self.timer = None
+        if self.state == OPENING:
+            self.position = 1.0
+            self.setState(OPEN)
+        elif self.state == CLOSING:
+            self.position = 0.0
+            self.setState(CLOSED)
+
+    def injectFault(self, at, duration=None, stuck=False):
+        """Schedule a fault of the valve, e.g. to test the PLC's alarms.
+
+        Args:
+            at (float): Seconds from now at which the valve faults.
+            duration (float): Seconds after which the valve is reset, or
+                None to keep it in fault.
+            stuck (bool): Freeze the valve, see `fault`.
+        """
+        self.engine.call_later(at, self.fault, stuck)
+        if duration is not None:
+            self.engine.call_later(at + duration, self.reset)
+
+    def fault(self, stuck=False):
+        """Put valve in fault, until `reset`.
+
+        Args:
+            stuck (bool): Freeze the valve where it is, e.g. to trigger an
+                opening or closing timeout, rather than showing both
+                'opened' and 'closed' (IO error).
+        """
+        self.position = self.positionAt(self.engine.now)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.setState(FAULT)
+        if not stuck:
+            self.engine.write(self.opened_node, True)
+            self.engine.write(self.closed_node, True)
+
+    def reset(self):
+        """Leave fault, and follow the command from where the valve is."""
+        if self.state != FAULT:
+            return
+
+        if self.position >= 1.0:
+            self.setState(OPEN)
+        elif self.position <= 0.0:
+            self.setState(CLOSED)
         else:
-            et = 1  # Energize type is 'close'
+            self.travel(OPENING if self.open_cmd else CLOSING)
+        self.update()
+
+    def setState(self, state):
+        """Enter state, showing it on the PLC inputs."""
+        self.state = state
+        self.since = self.engine.now
+        self.show()
+
+    def show(self):
+        """Write the 'opened' and 'closed' signals of the state."""
+        if self.state == FAULT:
+            return  # Signals depend on the kind of fault
 
-        # Infinite loop to check if energizeation is not matching the state of
-        # the valve, remove current state, wait for simulated move time and set
-        # new state.
-        while True:
-            if self.energized_node.get_value() and not oc[et].get_value():
-                self.client.setValue(oc[1 - et], False)
-                time.sleep(move_time)
-                self.client.setValue(oc[et], True)
+        self.engine.write(self.opened_node, self.state == OPEN)
+        self.engine.write(self.closed_node, self.state == CLOSED)
 
-            if not self.energized_node.get_value() and not oc[1 - et].get_value():
-                self.client.setValue(oc[et], False)
-                time.sleep(move_time)
-                self.client.setValue(oc[1 - et], True)
+    def positionAt(self, now):
+        """Return position, 0 if closed and 1 if open, at engine time."""
+        travelled = (now - self.since) / self.move_time if self.move_time else 1.0
+        if self.state == OPENING:
+            return min(1.0, self.position + travelled)
+        if self.state == CLOSING:
+            return max(0.0, self.position - travelled)
 
-            time.sleep(0.2)
+        return self.position
 
     def get_name(self):
         """Returns name of device"""
-        return self.energized_node.get_display_name().Text.split("_")[1]
+        return self.name.split("_")[1]
@@ -0,0 +1,442 @@
+from array import array
+import hashlib
+import json
+import mmap
+import os
+
+from pete.lazy import LazyModule
+from pete.path_index import DEFAULT_CACHE_DIR
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# Snapshots are read without opcua, so it is imported on first use
+ua = LazyModule("opcua.ua")
+
+MAGIC = b"PETESNAP"
+VERSION = 1
+
+# Column name and array typecode, in file order. String columns are stored
+# as an offsets column ('<name>_off') and a utf-8 blob column ('<name>').
+COLUMNS = [
+    ("parent", "i"),
+    ("first_child", "i"),
+    ("child_count", "i"),
+    ("node_class", "B"),
+    ("data_type", "i"),
+    ("nodeid_off", "I"),
+    ("nodeid", "B"),
+    ("name_off", "I"),
+    ("name", "B"),
+    ("display_off", "I"),
+    ("display", "B"),
+]
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        """Open a snapshot file of a PLC's address space.
+
+        The file is memory-mapped, and its columns are read directly from
+        the mapping, so opening even a large snapshot is nearly free.
+        Nodes are referred to by index; index 0 is the node the snapshot
+        was taken from (by default the 'Objects' node). Nodes are stored
+        breadth first, so the children of a node are contiguous.
+
+        Args:
+            path (str): Path to snapshot file.
+        """
+        self.filename = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[: len(MAGIC)] != MAGIC:
+            raise ValueError("'{}' is not a snapshot file".format(path))
+
+        header_len = int.from_bytes(self._mm[8:12], "little")
+        self.header = json.loads(self._mm[12 : 12 + header_len].decode("utf-8"))
+        if self.header["version"] != VERSION:
+            raise ValueError("Unsupported snapshot version")
+
+        self.server = self.header["server"]
+        self.revision = self.header["revision"]
+        self.start_path = self.header["start_path"]
+        self.data_types = self.header["data_types"]
+
+        base = _align(12 + header_len)
+        view = memoryview(self._mm)
+        for name, typecode in COLUMNS:
+            offset, length = self.header["columns"][name]
+            offset += base
+            setattr(self, "_" + name, view[offset : offset + length].cast(typecode))
+
+        self._index = None  # Node index per node id, built on first lookup
+
+    def close(self):
+        """Release memory mapping."""
+        for name, _ in COLUMNS:
+            getattr(self, "_" + name).release()
+        self._mm.close()
+
+    def __len__(self):
+        return len(self._parent)
+
+    def nodeid(self, i):
+        """Return node id string of node, e.g. 'ns=3;s="DB1"'."""
+        return self._string(self._nodeid, self._nodeid_off, i)
+
+    def name(self, i):
+        """Return browse name of node, e.g. '3:Inputs'."""
+        return self._string(self._name, self._name_off, i)
+
+    def display_name(self, i):
+        """Return display name of node."""
+        display = self._string(self._display, self._display_off, i)
+        if display:
+            return display
+
+        # Display names equal to the browse name are not stored
+        return self.name(i).split(":", 1)[-1]
+
+    def node_class(self, i):
+        """Return ua.NodeClass of node."""
+        return ua.NodeClass(self._node_class[i])
+
+    def data_type(self, i):
+        """Return data type node id string of node, or None if no variable."""
+        dtype = self._data_type[i]
+        return None if dtype < 0 else self.data_types[dtype]
+
+    def parent(self, i):
+        """Return index of parent node, or -1 for the start node."""
+        return self._parent[i]
+
+    def children(self, i):
+        """Return indices of the children of node."""
+        first = self._first_child[i]
+        return range(first, first + self._child_count[i])
+
+    def child(self, i, name):
+        """Return index of child with browse name (e.g. '3:Inputs') or None."""
+        for c in self.children(i):
+            if self.name(c) == name:
+                return c
+
+        return None
+
+    def path(self, i):
+        """Return browse path of node from the root node."""
+        path = []
+        while i > 0:
+            path.insert(0, self.name(i))
+            i = self.parent(i)
+
+        return self.start_path + path
+
+    def find(self, path):
+        """Return index of node at browse path, or None if not found.
+
+        Args:
+            path (list(str)): Browse names from the root node, as given to
+                `get_root_node().get_child(path)`, e.g. ["0:Objects",
+                "3:PLC", "3:Inputs"].
+        """
+        n = len(self.start_path)
+        if list(path[:n]) != self.start_path:
+            return None
+
+        i = 0
+        for name in path[n:]:
+            i = self.child(i, name)
+            if i is None:
+                return None
+
+        return i
+
+    def index(self, nodeid):
+        """Return index of node with node id string, or None if not found."""
+        if self._index is None:
+            self._index = {self.nodeid(i): i for i in range(len(self))}
+
+        return self._index.get(nodeid)
+
+    def plc(self):
+        """Return index of the PLC node, the last child of 'Objects'."""
+        objects = self.find(["0:Objects"])
+        return self.children(objects)[-1]
+
+    def node(self, client, i):
+        """Return live OPCUA node of index, for reading and writing."""
+        return client.get_node(ua.NodeId.from_string(self.nodeid(i)))
+
+    @staticmethod
+    def _string(blob, offsets, i):
+        return bytes(blob[offsets[i] : offsets[i + 1]]).decode("utf-8")
+
+    @classmethod
+    def fromClient(cls, client, cache_dir=DEFAULT_CACHE_DIR, refresh=True):
+        """Return snapshot of client's server, taking it if needed.
+
+        The snapshot is stored in `cache_dir`, one file per server. If the
+        stored snapshot was taken of another PLC program revision, it is
+        rebuilt (see `build`). If the PLC does not expose its program
+        revision, a change cannot be told, so the snapshot is always
+        rebuilt.
+
+        Args:
+            client (OPCClient): Connected OPCUA client.
+            cache_dir (str): Directory to store snapshot files in.
+            refresh (bool): Check the PLC program revision and rebuild the
+                snapshot if it changed. If False, a stored snapshot is
+                used as is.
+        """
+        server = client.server_url.geturl()
+        key = hashlib.sha1(server.encode("utf-8")).hexdigest()[:16]
+        path = os.path.join(os.path.expanduser(cache_dir), "snapshot-" + key)
+
+        previous = None
+        if os.path.exists(path):
+            try:
+                previous = cls(path)
+            except (ValueError, KeyError):
+                previous = None  # Corrupt or outdated file, take a new one
+
+        if previous is not None:
+            if not refresh:
+                return previous
+            revision = str(client.getSoftwareRevision())
+            if revision and previous.revision == revision:
+                return previous
+
+        cls.build(client, path, standard=previous)
+        if previous is not None:
+            previous.close()
+
+        return cls(path)
+
+    @classmethod
+    def build(cls, client, path, start=None, standard=None):
+        """Walk the address space and write a snapshot file.
+
+        The address space is walked breadth first. Each level is browsed
+        with batched Browse requests (see `OPCClient.browse_many`) and the
+        data types of all its variables are read with one batched read.
+
+        This is a full rebuild of the PLC nodes. OPCUA exposes no revision
+        per subtree, and comparing the children of a node with a previous
+        snapshot takes a browse of the node all the same, so there is no
+        telling which nodes a new PLC program changed without browsing
+        them all. Only the subtrees of namespace 0 nodes (standard OPCUA
+        nodes such as the 'Server' object, which do not depend on the PLC
+        program) are copied from a previous snapshot, if given.
+
+        Args:
+            client (OPCClient): Connected OPCUA client.
+            path (str): Path of snapshot file to write.
+            start (Node): Node to walk from. Defaults to 'Objects'.
+            standard (Snapshot): Previous snapshot of the server, to copy
+                the subtrees of standard nodes from.
+        """
+        if start is None:
+            start = client.get_objects_node()
+
+        start_path = _pathOf(client, start)
+        rows = _Rows()
+        rows.add(-1, start.nodeid.to_string(), client.getName(start), "", 1, None)
+        visited = {rows.nodeids[0]}
+        level = [0]
+
+        while level:
+            browse = []
+            next_level = []
+            for i in level:
+                old = standard.index(rows.nodeids[i]) if standard else None
+                if i > 0 and old is not None and _isStandard(rows.nodeids[i]):
+                    next_level.extend(rows.copyChildren(i, standard, old, visited))
+                else:
+                    browse.append(i)
+
+            nodes = [client.get_node(rows.nodeids[i]) for i in browse]
+            variables = []
+            for i, refs in zip(browse, client.browse_many(nodes)):
+                rows.first_child[i] = len(rows)
+                for ref in refs:
+                    nodeid = ref.NodeId.to_string()
+                    if nodeid in visited or getattr(ref.NodeId, "ServerIndex", 0):
+                        continue
+                    visited.add(nodeid)
+
+                    display = ref.DisplayName.Text or ""
+                    if display == ref.BrowseName.Name:
+                        display = ""  # Not stored, see `display_name`
+                    c = rows.add(
+                        i,
+                        nodeid,
+                        ref.BrowseName.to_string(),
+                        display,
+                        ref.NodeClass,
+                        None,
+                    )
+                    if ref.NodeClass == ua.NodeClass.Variable:
+                        variables.append(c)
+                    next_level.append(c)
+                rows.child_count[i] = len(rows) - rows.first_child[i]
+
+            # Read data types of all new variables in one batched read
+            dtypes = client.read_many(
+                [ua.NodeId.from_string(rows.nodeids[c]) for c in variables],
+                ua.AttributeIds.DataType,
+            )
+            for c, dv in zip(variables, dtypes):
+                if dv.StatusCode.is_good():
+                    rows.setDataType(c, dv.Value.Value.to_string())
+
+            level = sorted(next_level)
+
+        meta = {
+            "server": client.server_url.geturl(),
+            "revision": str(client.getSoftwareRevision()),
+            "start_path": start_path,
+        }
+        rows.write(path, meta)
+
+
+class _Rows(object):
+    """Row-wise node table used while taking a snapshot."""
+
+    def __init__(self):
+        self.parents = []
+        self.first_child = []
+        self.child_count = []
+        self.nodeids = []
+        self.names = []
+        self.displays = []
+        self.node_classes = []
+        self.data_types = []
+        self.data_type_table = []
+        self._data_type_index = {}
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add(self, parent, nodeid, name, display, node_class, data_type):
+        """Add node and return its index."""
+        self.parents.append(parent)
+        self.first_child.append(0)
+        self.child_count.append(0)
+        self.nodeids.append(nodeid)
+        self.names.append(name)
+        self.displays.append(display)
+        self.node_classes.append(int(node_class))
+        self.data_types.append(-1)
+        if data_type is not None:
+            self.setDataType(len(self) - 1, data_type)
+
+        return len(self) - 1
+
+    def setDataType(self, i, data_type):
+        """Set data type node id string of node i."""
+        if data_type not in self._data_type_index:
+            self._data_type_index[data_type] = len(self.data_type_table)
+            self.data_type_table.append(data_type)
+
+        self.data_types[i] = self._data_type_index[data_type]
+
+    def copyChildren(self, i, snapshot, old, visited):
+        """Copy children of node `old` in snapshot as children of node i.
+
+        Returns indices of the copied children, which are to be expanded
+        in turn.
+        """
+        self.first_child[i] = len(self)
+        children = []
+        for c in snapshot.children(old):
+            nodeid = snapshot.nodeid(c)
+            if nodeid in visited:
+                continue
+            visited.add(nodeid)
+
+            raw_display = snapshot._string(snapshot._display, snapshot._display_off, c)
+            children.append(
+                self.add(
+                    i,
+                    nodeid,
+                    snapshot.name(c),
+                    raw_display,
+                    snapshot._node_class[c],
+                    snapshot.data_type(c),
+                )
+            )
+        self.child_count[i] = len(self) - self.first_child[i]
+
+        return children
+
+    def write(self, path, meta):
+        """Write rows as a columnar snapshot file."""
+        columns = {
+            "parent": array("i", self.parents),
+            "first_child": array("i", self.first_child),
+            "child_count": array("i", self.child_count),
+            "node_class": array("B", self.node_classes),
+            "data_type": array("i", self.data_types),
+        }
+        for name, strings in [
+            ("nodeid", self.nodeids),
+            ("name", self.names),
+            ("display", self.displays),
+        ]:
+            offsets = array("I", [0])
+            blob = bytearray()
+            for s in strings:
+                blob += s.encode("utf-8")
+                offsets.append(len(blob))
+            columns[name + "_off"] = offsets
+            columns[name] = array("B", bytes(blob))
+
+        # Column offsets are relative to the first byte after the header,
+        # which is aligned to 8 bytes, as are all columns.
+        layout = {}
+        offset = 0
+        for name, _ in COLUMNS:
+            offset += -offset % 8
+            length = len(columns[name]) * columns[name].itemsize
+            layout[name] = [offset, length]
+            offset += length
+
+        header = dict(meta, version=VERSION, data_types=self.data_type_table)
+        header["columns"] = layout
+        header_bytes = json.dumps(header).encode("utf-8")
+        base = _align(12 + len(header_bytes))
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header_bytes).to_bytes(4, "little"))
+            f.write(header_bytes)
+            for name, _ in COLUMNS:
+                f.write(b"\0" * (base + layout[name][0] - f.tell()))
+                f.write(columns[name].tobytes())
+        os.replace(tmp, path)
+
+
+def _align(offset):
+    """Return offset rounded up to a multiple of 8."""
+    return offset + (-offset % 8)
+
+
+def _isStandard(nodeid):
+    """Return True if node id string is in namespace 0 (standard nodes)."""
+    return not nodeid.startswith("ns=")
+
+
+def _pathOf(client, node):
+    """Return browse path of node from the root node."""
+    path = []
+    root = client.get_root_node()
+    while node != root:
+        path.insert(0, client.getName(node))
+        node = node.get_parent()
+
+    return path
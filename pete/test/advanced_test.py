@@ -7,10 +7,10 @@ import inspect
 import sys
 import time
 
-from petenv.opc_client import OPCClient
 import pytest
 
-from epics import ca, caget, caput
+from pete import ca_client
+from pete.ca_client import caget, caput
 
 QUIET = True
 VERBOSE = False
@@ -38,8 +38,16 @@ def quiet_mode(msg_bytes):
     pass  # Alternatively, we could write the warnings into a log file.
 
 
-if QUIET:
-    ca.replace_printf_handler(quiet_mode)  # Replace pyepics handler
+@pytest.fixture(scope="session", autouse=True)
+def quiet():
+    """Replace pyepics handler, see `quiet_mode`.
+
+    This loads the CA library, so it is done when the tests start rather
+    than when this module is imported.
+    """
+    if QUIET:
+        ca_client.replace_printf_handler(quiet_mode)
+
 
 primary = [1, 0]
 order = [("a", "b"), ("b", "a")]
@@ -53,19 +61,16 @@ def DEBUG(msg):
 
 
 @pytest.fixture(scope="module")
-def client():
+def client(plc):
     """Setup OPCUA client.
 
-    Create OPCUA client and connect to PLC upon starting test. When the
-    test is finished, disconnect the client.
+    The client is the process wide OPCUA session to the PLC given by
+    '--plc-ip', checked out by the 'plc' fixture, e.g. '--plc-ip
+    172.30.4.163'.
     """
-    c = OPCClient("172.30.4.163")
-    c.connect()
-
-    yield c  # Provide the fixture value. Eferything after this is teardown code
+    yield plc  # Provide the fixture value. Eferything after this is teardown code
     sys.stdout.write("\nteardown client")
     init()
-    c.disconnect()
 
 
 # @pytest.mark.skip(reason="already works")
@@ -104,23 +109,25 @@ def test_circulator_startup_sequence(client, prim, sec):
     )
     DEBUG("Asserting that circulator {} has not started".format(sec))
     DEBUG("Asserting that valve {} is closed".format(sec))
-    t = 0.0
-    while caget("Tgt-HeC1010:Proc-YSV-005{}:Opened".format(prim)) == 0:
-        assert caget("Tgt-HeC1010:Proc-V-001{}:OpState".format(prim)) == 0
-        assert caget("Tgt-HeC1010:Proc-V-001{}:OpState".format(sec)) == 0
-        assert caget("Tgt-HeC1010:Proc-YSV-005{}:Closed".format(sec)) == 1
-        time.sleep(0.2)
-        t += 0.5
-        if t > 30:
-            break
+    wait_while(
+        ("Tgt-HeC1010:Proc-YSV-005{}:Opened".format(prim), 1),
+        {
+            "Tgt-HeC1010:Proc-V-001{}:OpState".format(prim): 0,
+            "Tgt-HeC1010:Proc-V-001{}:OpState".format(sec): 0,
+            "Tgt-HeC1010:Proc-YSV-005{}:Closed".format(sec): 1,
+        },
+    )
 
     # Check that while primary circulator is starting, secondary circulator is
     # still off, primary valve stays open and secondary valve stays closed
-    while caget("Tgt-HeC1010:Proc-V-001{}:OpState".format(prim)) != 2:
-        assert caget("Tgt-HeC1010:Proc-V-001{}:OpState".format(sec)) == 0
-        assert caget("Tgt-HeC1010:Proc-YSV-005{}:Opened".format(prim)) == 1
-        assert caget("Tgt-HeC1010:Proc-YSV-005{}:Closed".format(sec)) == 1
-        time.sleep(0.2)
+    wait_while(
+        ("Tgt-HeC1010:Proc-V-001{}:OpState".format(prim), 2),
+        {
+            "Tgt-HeC1010:Proc-V-001{}:OpState".format(sec): 0,
+            "Tgt-HeC1010:Proc-YSV-005{}:Opened".format(prim): 1,
+            "Tgt-HeC1010:Proc-YSV-005{}:Closed".format(sec): 1,
+        },
+    )
 
     # Check that primary circulator is running, secondary circulator is
     # still off, primary valve stays open and secondary valve stays closed
@@ -324,13 +331,13 @@ def test_2to1(client, prim, sec):
 
 
 def set_beam_power(client, bp):
-    """ Sets beam power.
+    """Sets beam power.
 
     Args:
         client (OPCClient): OPCUA client
         bp (float): Beam power
     """
-    node = client.get_root_node().get_child(
+    node = client.resolvePath(
         [
             "0:Objects",
             "3:THCCS_PLC",
@@ -346,20 +353,44 @@ def set_beam_power(client, bp):
 def wait(pv, value, timeout=30.0):
     """Wait for PV value.
 
-    Run `caget` on a PV until expected value is seen, or until timeout.
+    Return on the first monitor update of the PV with the expected value,
+    see `pete.ca_client.wait`, or on timeout.
 
     Args:
         pv (str): EPICS PV name
         value (float): Expected PV value
         timeout (float): Timeout in seconds
     """
-    t = 0
-    delay = 0.2
-    while caget(pv) != value:
-        t += 1
-        time.sleep(delay)
-        if t > timeout / delay:
-            break
+    result = ca_client.wait(pv, value, timeout)
+    DEBUG("waited {:.3f} s for {} == {}".format(result.elapsed, pv, value))
+    return result
+
+
+def wait_while(condition, invariants, timeout=30.0):
+    """Wait for PV value, asserting that other PVs keep their values.
+
+    Rather than polling, the PVs are monitored, and the wait ends on the
+    first monitor update meeting the condition or breaking an invariant,
+    see `pete.ca_client.wait_any`, or on timeout.
+
+    Args:
+        condition (tuple(str, float)): EPICS PV name and expected value
+        invariants (dict(str, float)): Value per PV name, to be kept while
+            waiting
+        timeout (float): Timeout in seconds
+    """
+    pv, value = condition
+    conditions = {
+        name: (lambda v, kept=kept: v != kept) for name, kept in invariants.items()
+    }
+    conditions[pv] = value
+    result = ca_client.wait_any(conditions, timeout)
+    DEBUG("waited {:.3f} s for {} == {}".format(result.elapsed, pv, value))
+    if result.values.get(pv) != value:
+        for name, kept in invariants.items():
+            assert result.values.get(name) == kept, name
+
+    return result
 
 
 def init():
@@ -1,17 +1,32 @@
 import logging
 import time
 
-from petenv.opc_client import OPCClient
+from pete.opc_client import pool
+from pete.snapshot import Snapshot
 import pytest
 
-from epics import ca, caget, caput
+from pete.ca_client import caget, caput, get_config, replace_printf_handler, wait
 
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 QUIET = True
-IP = input("\n\nPLC IP: ")  # Hardcode your IP here to avoid question
+
+# Configuration PVs read in bulk for every device, see the 'config' fixture
+TRANSMITTER_CONFIG = [
+    "ScaleLOW",
+    "ScaleHIGH",
+    "FB_Limit_HIHI",
+    "FB_Limit_HI",
+    "FB_Limit_LO",
+    "FB_Limit_LOLO",
+]
+VALVE_CONFIG = ["ClosingTime"]
+
+IP = None  # Hardcode your IP here to avoid question
+
+SNAPSHOT = None  # Snapshot of the PLC address space, see `get_snapshot`
 
 
 def quiet_mode(msg_bytes):
@@ -36,47 +51,93 @@ def quiet_mode(msg_bytes):
     pass  # Alternatively, we could write the warnings into a log file.
 
 
-if QUIET:
-    ca.replace_printf_handler(quiet_mode)  # Replace pyepics handler
+def get_ip(config):
+    """Return PLC ip address.
+
+    The address is taken from `IP`, or else from the '--plc-ip' option, or
+    else asked for, once, when the tests are collected rather than when
+    this module is imported. It is handed on to the 'plc' fixture as the
+    '--plc-ip' option.
+    """
+    global IP
+    if IP is None:
+        IP = config.getoption("--plc-ip") or input("\n\nPLC IP: ")
+    config.option.plc_ip = IP
+
+    return IP
+
+
+def pytest_generate_tests(metafunc):
+    """Parametrize the alarm tests with the devices found on the PLC."""
+    devices = DEVICES.get(metafunc.function.__name__)
+    if devices is not None:
+        get_ip(metafunc.config)
+        metafunc.parametrize("pv", devices())
+
+
+@pytest.fixture(scope="session", autouse=True)
+def quiet():
+    """Replace pyepics handler, see `quiet_mode`.
+
+    This loads the CA library, so it is done when the tests start rather
+    than when this module is imported.
+    """
+    if QUIET:
+        replace_printf_handler(quiet_mode)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def snapshot():
+    """Close the snapshot of device discovery when the tests end."""
+    yield
+    global SNAPSHOT
+    if SNAPSHOT is not None:
+        SNAPSHOT.close()
+        SNAPSHOT = None
 
 
-@pytest.fixture(scope="module")
-def com():
+@pytest.fixture(scope="session")
+def com(plc):
     """Setup OPCUA client.
 
-    Create OPCUA client and connect to PLC upon starting test. When the
-    test is finished, disconnect the client.
+    The client is the process wide OPCUA session to the PLC, checked out
+    by the 'plc' fixture. The session is shared with device discovery, so
+    it is only set up once per process.
     """
-    # Connect to opcua server
-    client = OPCClient(IP)
-    client.connect()
+    return plc, plc.getPLC()
 
-    # Get the plc node
-    objects = client.get_root_node().get_child("0:Objects").get_children()
-    plc = objects[-1]  # Node for PLC
 
-    # Provide the fixture value. Eferything after this is teardown code
-    yield client, plc
-    client.disconnect()
+@pytest.fixture(scope="session")
+def config():
+    """Read configuration of all devices.
 
+    The configuration PVs of all discovered transmitters and valves are
+    connected and read in one batched pass upon starting the test
+    session, rather than with serial reads in every test.
 
-def wait(pv, value, timeout=4.0):
-    """Wait for PV value.
+    Returns:
+        dict(str, DeviceConfig): Configuration per device PV name.
+    """
+    configs = get_config(get_analogs(), TRANSMITTER_CONFIG)
+    configs.update(get_config(get_valves(), VALVE_CONFIG))
+    return configs
 
-    Run `caget` on a PV until expected value is seen, or until timeout.
 
-    Args:
-        pv (str): EPICS PV name
-        value (float): Expected PV value
-        timeout (float): Timeout in seconds
+def get_snapshot():
+    """Return snapshot of the PLC address space.
+
+    The snapshot is stored on disk and only taken again if the PLC
+    program revision changed, so device discovery does not have to
+    browse the PLC node by node. It is opened once, and closed when the
+    tests end (see the 'snapshot' fixture).
     """
-    t = 0
-    delay = 0.2
-    while caget(pv) != value:
-        t += 1
-        time.sleep(delay)
-        if t > timeout / delay:
-            break
+    global SNAPSHOT
+    if SNAPSHOT is None:
+        # This function cannot use the fixture, but shares its session
+        with pool.session(IP) as client:
+            SNAPSHOT = Snapshot.fromClient(client)
+
+    return SNAPSHOT
 
 
 def get_analogs():
@@ -86,19 +147,12 @@ def get_analogs():
     found, petenv assumes it's a transmitter. If this is not always the
     case, this function must be modified.
     """
-    # Connect to opcua server (this function cannot use the fixture)
-    client = OPCClient(IP)
-    client.connect()
-
-    # Get the plc node
-    objects = client.get_root_node().get_child("0:Objects").get_children()
-    plc = objects[-1]  # Node for PLC
-
     # Find all analog transmitters
     transmitters = []
-    instances = plc.get_child("3:DataBlocksInstance").get_children()
-    for node in instances:
-        node_name = node.get_display_name().Text
+    snapshot = get_snapshot()
+    instances = snapshot.child(snapshot.plc(), "3:DataBlocksInstance")
+    for node in snapshot.children(instances):
+        node_name = snapshot.display_name(node)
         if (
             "_iDB" in node_name
             and node_name not in transmitters
@@ -106,9 +160,6 @@ def get_analogs():
         ):
             transmitters.append(node_name.split("_")[1])  # P&ID tag
 
-    # Disconnect from opcua server
-    client.disconnect()
-
     return transmitters
 
 
@@ -118,37 +169,35 @@ def get_valves():
     Note that this function is programmed to only search for valves
     called 'YSV'. Consider adding more names if needed.
     """
-    # Connect to opcua server (this function cannot use the fixture)
-    client = OPCClient(IP)
-    client.connect()
-
-    # Get the plc node
-    objects = client.get_root_node().get_child("0:Objects").get_children()
-    plc = objects[-1]  # Node for PLC
-
     # Find all YSV valves
     valves = []
-    instances = plc.get_child("3:DataBlocksInstance").get_children()
-    for node in instances:
-        node_name = node.get_display_name().Text
+    snapshot = get_snapshot()
+    instances = snapshot.child(snapshot.plc(), "3:DataBlocksInstance")
+    for node in snapshot.children(instances):
+        node_name = snapshot.display_name(node)
         if "YSV" in node_name and "_iDB" in node_name and node_name not in valves:
             valves.append(node_name.split("_")[1])  # P&ID tag
 
-    # Disconnect from the opcua server
-    client.disconnect()
-
     return valves
 
 
+# Device discovery per test parametrized with the devices' PV names, see
+# `pytest_generate_tests`
+DEVICES = {
+    "test_transmitter_alarms": get_analogs,
+    "test_pv_valve_alarms": get_valves,
+}
+
+
 # @pytest.mark.skip(reason="just wanna test valves now")
-@pytest.mark.parametrize("pv", get_analogs())
-def test_transmitter_alarms(com, pv):
+def test_transmitter_alarms(com, config, pv):
     """Verify analog transmitter alarms.
 
     Verify HIHI, HI, LO, LOLO, Overrange and Underrange signals
 
     Args:
         com (tuple(OPCClient, opcua.common.node.Node)): OPCUA client, plc node
+        config (dict(str, DeviceConfig)): Configuration per device
         pv (str): PV name of transmitter to be tested
     """
     logger = logging.getLogger()
@@ -165,14 +214,14 @@ def test_transmitter_alarms(com, pv):
             ai = i
             break
 
-    scale_low = caget("{}:ScaleLOW".format(pv))
-    scale_high = caget("{}:ScaleHIGH".format(pv))
+    scale_low = config[pv]["ScaleLOW"]
+    scale_high = config[pv]["ScaleHIGH"]
     ciel = 27648
     offset = 10
-    hihi_lim = caget("{}:FB_Limit_HIHI".format(pv))
-    hi_lim = caget("{}:FB_Limit_HI".format(pv))
-    lo_lim = caget("{}:FB_Limit_LO".format(pv))
-    lolo_lim = caget("{}:FB_Limit_LOLO".format(pv))
+    hihi_lim = config[pv]["FB_Limit_HIHI"]
+    hi_lim = config[pv]["FB_Limit_HI"]
+    lo_lim = config[pv]["FB_Limit_LO"]
+    lolo_lim = config[pv]["FB_Limit_LOLO"]
     delay = 1
     logger.warning("HIHI limit: {}\n".format(hihi_lim))
     logger.warning("HI limit: {}\n".format(hi_lim))
@@ -232,8 +281,7 @@ def test_transmitter_alarms(com, pv):
 
 
 # @pytest.mark.skip(reason="just wanna test transmitters now")
-@pytest.mark.parametrize("pv", get_valves())
-def test_pv_valve_alarms(com, pv):
+def test_pv_valve_alarms(com, config, pv):
     """Verify solenoid valve alarms.
 
     Verify that opening timeout, closing timeout and IO error is working
@@ -242,6 +290,7 @@ def test_pv_valve_alarms(com, pv):
 
     Args:
         com (tuple(OPCClient, opcua.common.node.Node)): OPCUA client, plc node
+        config (dict(str, DeviceConfig)): Configuration per device
         pv (str): PV name of valve to be tested
     """
     client = com[0]
@@ -255,8 +304,8 @@ def test_pv_valve_alarms(com, pv):
 
     close_pv = "{}:Cmd_ForceClose".format(pv)
     open_pv = "{}:Cmd_ForceOpen".format(pv)
-    opening_time = caget("{}:ClosingTime".format(pv)) / 1000 + 2  # ms to s + offset
-    closing_time = caget("{}:ClosingTime".format(pv)) / 1000 + 2  # ms to s + offset
+    opening_time = config[pv]["ClosingTime"] / 1000 + 2  # ms to s + offset
+    closing_time = config[pv]["ClosingTime"] / 1000 + 2  # ms to s + offset
     opening_timeout_pv = "{}:Opening_TimeOut".format(pv)
     closing_timeout_pv = "{}:Closing_TimeOut".format(pv)
 
@@ -0,0 +1,199 @@
+import asyncio
+import inspect
+
+import pytest
+
+from pete.async_opc_client import AsyncOPCClient
+from pete.opc_client import OPCClient, create_client
+from pete.virtual_plc import NAMESPACES, VirtualPLC
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+def publicMethods(cls):
+    """Return signature per public method defined by a client class."""
+    return {
+        name: list(inspect.signature(method).parameters)
+        for name, method in vars(cls).items()
+        if callable(method) and (not name.startswith("_") or name == "__init__")
+    }
+
+
+def test_clients_expose_same_methods():
+    """Both clients have the same methods, taking the same arguments."""
+    assert publicMethods(AsyncOPCClient) == publicMethods(OPCClient)
+
+
+@pytest.fixture(scope="module")
+def plc():
+    """Virtual PLC with two of each device, i.e. six inputs of each kind."""
+    plc = VirtualPLC()
+    plc.addDevices(6)
+    plc.start()
+    yield plc
+    plc.stop()
+
+
+def run(test, **kwargs):
+    """Run test(client, ns) on a new event loop, with a connected client.
+
+    The asyncio client belongs to the event loop it connected on, so each
+    test connects its own.
+    """
+
+    async def session():
+        client = create_client("localhost", asynchronous=True, **kwargs)
+        await client.connect()
+        try:
+            ns = await client.get_namespace_index(NAMESPACES[1])
+            await test(client, ns)
+        finally:
+            await client.disconnect()
+
+    asyncio.run(session())
+
+
+def inputPath(ns, name):
+    """Return browse path of an input of the virtual PLC."""
+    return [
+        "0:Objects",
+        "{}:PLC_1".format(ns),
+        "{}:Inputs".format(ns),
+        "{}:{}".format(ns, name),
+    ]
+
+
+async def inputs(client, ns, *names):
+    """Return input nodes of the virtual PLC."""
+    return await client.resolvePaths([inputPath(ns, name) for name in names])
+
+
+def test_set_and_get_value(plc):
+    """A value set to a node is read back, with the node's variant type."""
+
+    async def test(client, ns):
+        tt, ysv = await inputs(client, ns, "hwi_TT-001", "hwi_YSV-002_opened")
+        await client.setValue(tt, 12)
+        await client.setValue(ysv, True)
+        assert await client.getValue(tt) == 12
+        assert await client.getValue(ysv) is True
+        assert await client.getName(tt) == "{}:hwi_TT-001".format(ns)
+
+    run(test, path_cache_dir=None)
+
+
+def test_read_and_write_many_across_chunks(plc):
+    """Batches larger than the operation limits are split, in order."""
+    names = [
+        "hwi_TT-001",
+        "hwi_TT-004",
+        "hwi_CV-003",
+        "hwi_CV-006",
+        "hwi_YSV-002_opened",
+    ]
+
+    async def test(client, ns):
+        client.operation_limits = {"read": 2, "write": 2, "translate": 2}
+        nodes = await inputs(client, ns, *names)
+        assert all(node is not None for node in nodes)
+
+        values = dict(zip(nodes, [101, 104, 3.5, 6.5, True]))
+        statuses = await client.write_many(values)
+        assert all(statuses[node].is_good() for node in nodes)
+
+        requests = []
+        read = client.uaclient.read
+
+        async def counting(params):
+            requests.append(len(params.NodesToRead))
+            return await read(params)
+
+        client.uaclient.read = counting
+        results = await client.read_many(nodes)
+        assert [dv.Value.Value for dv in results] == [101, 104, 3.5, 6.5, True]
+        assert requests == [2, 2, 1]
+
+    run(test, path_cache_dir=None)
+
+
+def test_resolve_paths_through_index(plc, tmp_path):
+    """Paths are resolved once, then from the path index."""
+    cache_dir = str(tmp_path)
+
+    async def test(client, ns):
+        paths = [inputPath(ns, "hwi_TT-001"), inputPath(ns, "hwi_TT-999")]
+        first, unknown = await client.resolvePaths(paths)
+        assert unknown is None
+        assert await client.getName(first) == "{}:hwi_TT-001".format(ns)
+        assert (await client.resolvePath(paths[0])).nodeid == first.nodeid
+
+        index = await client.getPathIndex()
+        assert index.revision == "1" and len(index.paths) == 1
+
+    run(test, path_cache_dir=cache_dir)
+
+    async def warm(client, ns):
+        translated = []
+        translate = client.uaclient.translate_browsepaths_to_nodeids
+
+        async def counting(bpaths):
+            translated.extend(bpaths)
+            return await translate(bpaths)
+
+        client.uaclient.translate_browsepaths_to_nodeids = counting
+        (node,) = await client.resolvePaths([inputPath(ns, "hwi_TT-001")])
+        assert node is not None and not translated
+
+    run(warm, path_cache_dir=cache_dir)
+
+
+def test_unsubscribe_keeps_other_consumers(plc):
+    """A consumer unsubscribing leaves the node monitored for the others."""
+
+    async def test(client, ns):
+        (node,) = await inputs(client, ns, "hwi_TT-004")
+        changed = asyncio.Event()
+
+        def callback(nodeid, value):
+            if value == 7:
+                changed.set()
+
+        await client.subscribe([node], callback)
+        await client.subscribe([node], consumer="gui")
+        await client.unsubscribe([node], consumer="gui")
+        assert node.nodeid in client.monitored
+
+        await client.setValue(node, 7)
+        await asyncio.wait_for(changed.wait(), 2.0)
+
+        await client.unsubscribe([node], consumer=callback)
+        assert node.nodeid not in client.monitored
+        assert client.subscription_handler.get(node.nodeid) is None
+
+    run(test, path_cache_dir=None)
+
+
+def test_wait_for_value_and_timeout(plc):
+    """A wait returns once the value matches, or False on timeout."""
+
+    async def test(client, ns):
+        (node,) = await inputs(client, ns, "hwi_CV-006")
+        await client.setValue(node, 0.0)
+        assert await client.wait_for(node, 0.0)
+
+        async def later():
+            await asyncio.sleep(0.2)
+            await client.setValue(node, 50.0)
+
+        task = asyncio.ensure_future(later())
+        assert await client.wait_for(node, lambda v: v > 40, timeout=2.0)
+        await task
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        assert not await client.wait_for(node, 99.0, timeout=0.3)
+        assert 0.3 <= loop.time() - start < 2.0
+
+    run(test, path_cache_dir=None)
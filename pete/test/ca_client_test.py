@@ -0,0 +1,216 @@
+import threading
+import time
+import types
+
+import pytest
+
+from pete import ca_client
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class FakePV(object):
+    """Stand-in for `epics.PV`, needing no IOC.
+
+    A PV connects when waited for with a timeout, and its value is its
+    name, so reads can be checked without a network, until a new value is
+    posted as a monitor update would be. A PV named 'Dead-*' never
+    connects, taking the whole timeout of each wait for it.
+    """
+
+    def __init__(self, pvname, auto_monitor=False, **kwargs):
+        self.pvname = pvname
+        self.auto_monitor = auto_monitor
+        self.chid = self
+        self.type = "string"
+        self.connected = False
+        self.disconnected = False
+        self.callbacks = {}
+        self.value = pvname
+
+    def wait_for_connection(self, timeout=None):
+        if self.pvname.startswith("Dead-"):
+            time.sleep(timeout or 0)
+        elif timeout and not self.disconnected:
+            self.connected = True
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+        self.disconnected = True
+
+    def get(self, as_string=False, timeout=None, use_monitor=True):
+        return self.value if self.connected else None
+
+    def put(self, value, wait=False, timeout=None):
+        return 1 if self.connected else None
+
+    def add_callback(self, callback):
+        index = max(self.callbacks, default=0) + 1
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+
+    def post(self, value):
+        """Set value, calling the monitor callbacks as pyepics does."""
+        self.value = value
+        for callback in list(self.callbacks.values()):
+            callback(pvname=self.pvname, value=value)
+
+
+def _complete(chid, timeout=None, **kwargs):
+    """Stand-in for `epics.ca.get_complete`."""
+    return chid.get()
+
+
+FAKE_EPICS = types.SimpleNamespace(
+    PV=FakePV,
+    ca=types.SimpleNamespace(get=lambda chid, wait=True: None, get_complete=_complete),
+)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """PV manager of fake PVs."""
+    monkeypatch.setattr(ca_client, "epics", FAKE_EPICS)
+    return ca_client.PVManager(maxsize=10)
+
+
+def test_get_waits_for_connecting_pv(manager):
+    """A PV created without waiting is waited for by a read or write."""
+    manager.connect(["Dev-001:A", "Dev-001:B"], timeout=0)
+    assert not manager.pvs["Dev-001:A"].connected
+    assert manager.get("Dev-001:A") == "Dev-001:A"
+    assert manager.put("Dev-001:B", 1) == 1
+
+
+def test_get_config_of_more_pvs_than_cached(manager):
+    """A configuration batch larger than the cache reads every PV."""
+    devices = ["Dev-{:03d}".format(i) for i in range(5)]
+    fields = ["ScaleLOW", "ScaleHIGH", "FB_Limit_HI"]
+    assert len(devices) * len(fields) > manager.maxsize
+
+    configs = manager.get_config(devices, fields)
+    for device in devices:
+        for field in fields:
+            assert configs[device][field] == "{}:{}".format(device, field)
+    assert len(manager.pvs) <= manager.maxsize
+
+
+def test_get_many_waits_once_for_unreachable_pvs(manager):
+    """PVs that do not connect cost one timeout per batch, not one each."""
+    pvnames = ["Dev-001:A"] + ["Dead-{:03d}:A".format(i) for i in range(5)]
+    for keep in (False, True):
+        start = time.monotonic()
+        values = manager.get_many(pvnames, timeout=0.2, keep=keep)
+        assert time.monotonic() - start < 0.5
+        assert values == ["Dev-001:A"] + [None] * 5
+
+
+def test_get_many_of_more_pvs_than_cached(manager):
+    """A kept batch larger than the cache reads every PV."""
+    pvnames = ["Dev-{:03d}:A".format(i) for i in range(2 * manager.maxsize)]
+    assert manager.get_many(pvnames) == pvnames
+    assert len(manager.pvs) <= manager.maxsize
+
+
+def test_unmonitor_keeps_shared_pv(manager):
+    """Removing one monitor leaves the PV connected for its other users."""
+    first = manager.monitor("Dev-001:A", print, timeout=1)
+    second = manager.monitor("Dev-001:A", print)
+    pv = manager.pvs["Dev-001:A"]
+
+    manager.unmonitor("Dev-001:A", first)
+    assert pv.connected
+    assert list(pv.callbacks) == [second]
+    assert manager.get("Dev-001:A") == "Dev-001:A"
+
+    manager.unmonitor("Dev-001:A", second)
+    assert pv.connected
+    assert not pv.callbacks
+
+
+def test_monitored_pvs_are_not_evicted(manager):
+    """PVs with monitor callbacks are kept when the cache is full."""
+    indexes = {}
+    for i in range(manager.maxsize):
+        name = "Dev-{:03d}:A".format(i)
+        indexes[name] = manager.monitor(name, print, timeout=1)
+    manager.release(list(indexes))
+    manager.connect(["Dev-999:{}".format(i) for i in range(5)])
+    for name in indexes:
+        assert manager.pvs[name].connected
+
+    for name, index in indexes.items():
+        manager.unmonitor(name, index)
+    assert len(manager.pvs) == manager.maxsize
+
+
+def pvsAt(manager, **values):
+    """Return connected, monitored PVs, per name, holding initial values."""
+    pvs = manager.connect(list(values), monitor=True, timeout=1)
+    for pv in pvs:
+        pv.value = values[pv.pvname]
+    return {pv.pvname: pv for pv in pvs}
+
+
+def postLater(delay, pv, value):
+    """Post value to PV from another thread, after delay seconds."""
+    timer = threading.Timer(delay, pv.post, (value,))
+    timer.start()
+    return timer
+
+
+def test_wait_within_tolerance(manager, monkeypatch):
+    """A numeric value within tolerance of the expected value matches."""
+    monkeypatch.setattr(ca_client, "manager", manager)
+    pv = pvsAt(manager, TT=20.0)["TT"]
+    postLater(0.1, pv, 24.6)
+
+    result = ca_client.wait("TT", 25.0, timeout=2.0, tolerance=0.5)
+    assert result
+    assert 0.1 <= result.elapsed < 1.0
+    assert result.values == {"TT": 24.6}
+    assert not ca_client.wait("TT", 25.0, timeout=0.1, tolerance=0.1)
+    assert ca_client.wait("TT", lambda v: v > 24, timeout=0.1)
+    assert not pv.callbacks  # Monitors of the waits are removed
+
+
+def test_wait_any_returns_on_first_match(manager, monkeypatch):
+    """A wait for any PV ends as soon as one of them matches."""
+    monkeypatch.setattr(ca_client, "manager", manager)
+    pvs = pvsAt(manager, A=0, B=0)
+    postLater(0.1, pvs["B"], 1)
+
+    result = ca_client.wait_any({"A": 1, "B": 1}, timeout=2.0)
+    assert result and result.elapsed < 1.0
+    assert result.values == {"A": 0, "B": 1}
+
+
+def test_wait_all_blocks_until_every_match(manager, monkeypatch):
+    """A wait for all PVs ends once the last of them matches."""
+    monkeypatch.setattr(ca_client, "manager", manager)
+    pvs = pvsAt(manager, A=0, B=0)
+    postLater(0.1, pvs["A"], 1)
+    postLater(0.4, pvs["B"], 1)
+
+    result = ca_client.wait_all({"A": 1, "B": 1}, timeout=2.0)
+    assert result
+    assert 0.4 <= result.elapsed < 1.5
+    assert result.values == {"A": 1, "B": 1}
+
+
+def test_wait_timeout_reports_last_values(manager):
+    """A wait that times out returns the values last seen."""
+    pvs = pvsAt(manager, A=0, B=0)
+    postLater(0.05, pvs["A"], 1)
+    postLater(0.1, pvs["B"], 2)
+
+    result = manager.wait({"A": 1, "B": 1}, timeout=0.4, mode="all")
+    assert not result.ok
+    assert 0.4 <= result.elapsed < 1.0
+    assert result.values == {"A": 1, "B": 2}
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from pete.clock import VirtualClock
+from pete.sim.engine import Engine
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class FakeClient(object):
+    """Stand-in for `OPCClient`, recording the batched writes."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.writes = []  # (time, values) per batch
+
+    def write_many(self, values):
+        self.writes.append((self.clock.now(), dict(values)))
+
+
+class Valve(object):
+    """Valve model, travelling for move_time once commanded to open."""
+
+    def __init__(self, move_time=0.7):
+        self.move_time = move_time
+
+    def command(self, engine):
+        engine.write("opening", True)
+        engine.call_later(self.move_time, engine.write, "opened", True)
+
+
+@pytest.fixture
+def engine():
+    """Running engine on a virtual clock."""
+    clock = VirtualClock()
+    engine = Engine(FakeClient(clock), clock=clock)
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+def test_advance_runs_handoff_before_moving_time(engine):
+    """Work handed over from another thread runs at the time it was due."""
+    clock, valve = engine.clock, Valve()
+    engine.call_every(0.1, lambda: None)  # Engine waits with a deadline
+    clock.advance(0.05)
+
+    for _ in range(20):
+        # Handed over as a data change notification would be, right before
+        # the test moves time on
+        thread = threading.Thread(
+            target=engine.call_later, args=(0, valve.command, engine)
+        )
+        thread.start()
+        thread.join()
+        clock.advance(1.0)
+
+    opening = [t for t, values in engine.client.writes if "opening" in values]
+    opened = [t for t, values in engine.client.writes if "opened" in values]
+    assert opening == pytest.approx([0.05 + i for i in range(20)])
+    assert opened == pytest.approx([0.75 + i for i in range(20)])
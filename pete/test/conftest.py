@@ -1,14 +1,29 @@
+import html
 import os
 
-from epics import caget
 import git
-from petenv.opc_client import OPCClient
+import pytest
+from pete import instrument
+from pete.ca_client import caget
 
 __author__ = "Johannes Kazantzidis"
 __email__ = "johannes.kazantzidis@ess.eu"
 __status__ = "Production"
 
 
+def pytest_addoption(parser):
+    """Add option to record call latencies of OPCUA, CA and sleep calls."""
+    parser.addoption(
+        "--instrument",
+        metavar="path",
+        default=None,
+        help="record call counts and latencies, and dump them as json to path",
+    )
+    parser.addoption(
+        "--plc-ip", default=None, help="PLC ip address of the 'plc' fixture"
+    )
+
+
 def pytest_configure(config):
     """Configuration for reports.
 
@@ -30,6 +45,10 @@ def pytest_configure(config):
     # "\=ESS\INFR [Infrastructure]\ICS_MASTER_LIBRARY\TIA Portal"
     ############################################################################
 
+    # Enable instrumentation before test scripts import pyepics functions
+    if config.getoption("--instrument"):
+        instrument.enable()
+
     if "petenv" in config._metadata:
         # petenv
         verify_repo(config, "Path to petenv repo: ", " petenv", PETENV_REPO)
@@ -45,12 +64,11 @@ def pytest_configure(config):
             IP = input("PLC IP: ")
 
         if IP:
+            from pete.opc_client import pool
+
             config._metadata[" PLC IP"] = IP
-            client = OPCClient(IP)
-            client.connect()
-            objects = client.get_root_node().get_child("0:Objects")
-            children = objects.get_children()
-            cpu = children[-1]
+            client = pool.acquire(IP)  # Kept alive for the tests to reuse
+            cpu = client.getPLC()
 
             config._metadata[" PLC softwareRevision"] = cpu.get_child(
                 "2:SoftwareRevision"
@@ -72,7 +90,7 @@ def pytest_configure(config):
                 "2:HardwareRevision"
             ).get_value()
 
-            client.disconnect()
+            pool.release(client)
         else:
             config._metadata[" PLC attributes"] = "Ignored"
 
@@ -131,6 +149,55 @@ def pytest_configure(config):
             config._metadata[" EPICS/IOC attributes"] = "Ignored"
 
 
+@pytest.fixture(scope="session")
+def plc(request):
+    """Setup OPCUA client.
+
+    Check out the process wide, kept alive, OPCUA session to the PLC given
+    by '--plc-ip'. The session is shared by all tests of the process and
+    reconnected automatically if it drops.
+    """
+    ip = request.config.getoption("--plc-ip")
+    if ip is None:
+        pytest.skip("No PLC ip address given, see '--plc-ip'")
+
+    from pete.opc_client import pool
+
+    with pool.session(ip) as client:
+        yield client
+
+
+def pytest_sessionfinish(session, exitstatus):
+    """Dump recorded call latencies, if instrumentation is enabled."""
+    path = session.config.getoption("--instrument")
+    if path:
+        instrument.recorder.dump(path)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_html_results_summary(prefix, summary, postfix):
+    """Add table of recorded call latencies to the pytest-html report."""
+    if not instrument.recorder.operations:
+        return
+
+    # pytest-html 4 takes the summary as html strings
+    columns = ["count", "total_s", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"]
+    rows = [_htmlRow("th", ["operation"] + columns)]
+    for operation, stats in instrument.recorder.summary().items():
+        rows.append(_htmlRow("td", [operation] + [stats.get(c, "") for c in columns]))
+
+    postfix.extend(
+        ["<h2>Call latencies</h2>", "<table>{}</table>".format("".join(rows))]
+    )
+
+
+def _htmlRow(tag, cells):
+    """Return html table row of cells, each in a tag, e.g. 'td'."""
+    return "<tr>{}</tr>".format(
+        "".join("<{0}>{1}</{0}>".format(tag, html.escape(str(c))) for c in cells)
+    )
+
+
 def verify_repo(config, instruction, description, repo_path):
     repo_ok = False
     while not repo_ok:
@@ -0,0 +1,184 @@
+import csv
+import datetime
+import io
+import json
+
+import numpy as np
+import pytest
+
+from pete import ca_client, dump
+from pete.opc_client import OPCClient
+from pete.virtual_plc import NAMESPACES, VirtualPLC
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+RECORDS = [
+    {"source": "ioc", "name": "Dev-001:A", "type": "double", "value": 1.5},
+    {"source": "ioc", "name": "Dev-001:B", "value": np.arange(3)},
+    {"source": "ioc", "name": "Dev-001:C", "status": "Disconnected"},
+]
+
+
+class FakeManager(object):
+    """Stand-in for `PVManager`, recording the batches read."""
+
+    def __init__(self):
+        self.batches = []
+
+    def get_many(self, pvnames, timeout=5.0, keep=True, metadata=False):
+        self.batches.append((list(pvnames), timeout, keep))
+        values = []
+        for pvname in pvnames:
+            if pvname.startswith("Dead-"):
+                values.append(None)
+            else:
+                values.append(
+                    {"value": 1.0, "type": "double", "severity": 1, "timestamp": 0.0}
+                )
+        return values
+
+
+def test_jsonl_writes_one_object_per_line():
+    """Each record is one JSON object, arrays written as lists."""
+    f = io.StringIO()
+    assert dump.dump(RECORDS, f, "jsonl") == len(RECORDS)
+
+    lines = f.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        RECORDS[0],
+        dict(RECORDS[1], value=[0, 1, 2]),
+        RECORDS[2],
+    ]
+
+
+def test_csv_writes_header_and_json_arrays():
+    """A csv dump has a `FIELDS` header, with arrays written as JSON cells."""
+    f = io.StringIO()
+    assert dump.dump([dict(r) for r in RECORDS], f, "csv") == len(RECORDS)
+
+    rows = list(csv.DictReader(io.StringIO(f.getvalue())))
+    assert list(rows[0]) == dump.FIELDS
+    assert rows[0]["value"] == "1.5"
+    assert json.loads(rows[1]["value"]) == [0, 1, 2]
+    assert rows[2]["status"] == "Disconnected"
+    assert rows[2]["value"] == ""
+
+
+def test_pv_records_read_in_batches(monkeypatch):
+    """PVs are read a batch at a time, without keeping them connected."""
+    manager = FakeManager()
+    monkeypatch.setattr(ca_client, "manager", manager)
+    lines = ["Dev-{:03d}:A\n".format(i) for i in range(5)] + ["\n", "Dead-001:A\n"]
+
+    records = list(dump.pvRecords(lines, batch_size=2, timeout=0.5))
+    assert [r["name"] for r in records] == [
+        line.strip() for line in lines if line.strip()
+    ]
+    assert [len(names) for names, _, _ in manager.batches] == [2, 2, 2]
+    assert all(timeout == 0.5 and not keep for _, timeout, keep in manager.batches)
+
+    assert records[0]["status"] == "MINOR"
+    assert records[0]["timestamp"] == "1970-01-01T00:00:00+00:00"
+    assert records[-1] == {
+        "source": "ioc",
+        "name": "Dead-001:A",
+        "status": "Disconnected",
+    }
+
+
+def test_isoformat_of_opcua_and_ca_timestamps():
+    """Naive OPCUA datetimes and posix CA timestamps are both in UTC."""
+    naive = datetime.datetime(2020, 1, 1, 12)
+    assert dump._isoformat(naive) == "2020-01-01T12:00:00+00:00"
+    assert dump._isoformat(naive.replace(tzinfo=datetime.timezone.utc).timestamp()) == (
+        "2020-01-01T12:00:00+00:00"
+    )
+    assert dump._isoformat(None) is None
+
+
+def test_gui_dump_stops_after_cancelled_batch(tmp_path):
+    """A dump cancelled while reading a batch writes no further batches."""
+    from pete.gui.dump import DumpThread
+
+    rows = [("Dev-{:03d}:A".format(i), i) for i in range(10)]
+    path = tmp_path / "tree.txt"
+
+    def read_many(keys):
+        thread.cancel()  # As the dump button does while a batch is read
+        return [", {}".format(key) for key in keys]
+
+    thread = DumpThread(str(path), iter(rows), read_many, len(rows), batch_size=3)
+    thread.run()
+
+    assert path.read_text().splitlines() == [
+        "Dev-000:A, 0",
+        "Dev-001:A, 1",
+        "Dev-002:A, 2",
+    ]
+
+
+@pytest.fixture(scope="module")
+def plc():
+    """Client connected to a virtual PLC with three devices, and its PLC node."""
+    plc = VirtualPLC(4841)
+    plc.addDevices(3)
+    plc.start()
+    client = OPCClient("localhost", port=4841, path_cache_dir=None)
+    client.connect()
+    ns = client.get_namespace_index(NAMESPACES[1])
+    yield client, client.get_objects_node().get_child("{}:PLC_1".format(ns))
+    client.disconnect()
+    plc.stop()
+
+
+def test_plc_records(plc):
+    """Nodes are dumped with their class, and variables with their value."""
+    client, start = plc
+    records = {r["name"]: r for r in dump.plcRecords(client, start)}
+    assert len(records) == 30
+
+    revision = records["3:PLC_1/2:SoftwareRevision"]
+    assert revision["node_class"] == "Variable"
+    assert (revision["type"], revision["value"]) == ("String", "1")
+    assert revision["status"] == "Good"
+
+    inputs = records["3:PLC_1/3:Inputs"]
+    assert inputs["node_class"] == "Object" and "value" not in inputs
+    assert inputs["nodeid"] == "ns=3;s=PLC_1.Inputs"
+
+    closed = records["3:PLC_1/3:Inputs/3:hwi_YSV-002_closed"]
+    assert (closed["type"], closed["value"]) == ("Boolean", True)
+    tt = records["3:PLC_1/3:Inputs/3:hwi_TT-001"]
+    assert (tt["type"], tt["value"]) == ("Int16", 0)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 1000])
+def test_plc_records_in_browse_order(plc, batch_size):
+    """Records of a batch are the children of its nodes, in browse order."""
+    client, start = plc
+    names = [r["name"] for r in dump.plcRecords(client, start, batch_size)]
+    assert names[:11] == [
+        "3:PLC_1/2:SoftwareRevision",
+        "3:PLC_1/3:Inputs",
+        "3:PLC_1/3:Outputs",
+        "3:PLC_1/3:DataBlocksInstance",
+        "3:PLC_1/3:DataBlocksGlobal",
+        "3:PLC_1/3:Inputs/3:hwi_TT-001",
+        "3:PLC_1/3:Inputs/3:hwi_YSV-002_opened",
+        "3:PLC_1/3:Inputs/3:hwi_YSV-002_closed",
+        "3:PLC_1/3:Inputs/3:hwi_CV-003",
+        "3:PLC_1/3:Outputs/3:hwo_YSV-002_open",
+        "3:PLC_1/3:Outputs/3:hwo_CV-003",
+    ]
+    tt = "3:PLC_1/3:DataBlocksInstance/3:DEV_TT-001_iDB/3:Inputs/"
+    signals = [n[len(tt) :] for n in names if n.startswith(tt)]
+    assert signals == [
+        "3:Measurement",
+        "3:HIHI",
+        "3:HI",
+        "3:LO",
+        "3:LOLO",
+        "3:IO_Error",
+    ]
@@ -0,0 +1,27 @@
+import argparse
+
+import pytest
+
+from pete.gui.petenv_gui import positiveRate
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+def test_positive_rate():
+    """Update rates are positive numbers per second."""
+    assert positiveRate("10") == 10.0
+    assert positiveRate("0.5") == 0.5
+    for text in ["0", "-1", "inf", "nan", "fast"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            positiveRate(text)
+
+
+def test_live_updater_rejects_zero_rate():
+    """An updater is not created with a rate it cannot tick at."""
+    from pete.gui.live import LiveUpdater
+
+    for rate in [0, -10]:
+        with pytest.raises(ValueError):
+            LiveUpdater(None, None, None, None, rate)
@@ -0,0 +1,167 @@
+import threading
+
+import pytest
+
+from pete.opc_client import OPCClient, SessionPool
+from pete.virtual_plc import NAMESPACES, VirtualPLC
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class FakeClient(object):
+    """Stand-in for `OPCClient`, counting connects and disconnects."""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.connected = False
+        self.connects = 0
+
+    def connect(self):
+        self.connected = True
+        self.connects += 1
+
+    def disconnect(self):
+        self.connected = False
+
+    def get_node(self, nodeid):
+        return self
+
+    def get_value(self):
+        if not self.connected:
+            raise ConnectionError("Not connected")
+        return 0
+
+
+@pytest.fixture
+def pool():
+    """Session pool of fake clients, disconnecting idle sessions at once."""
+    pool = SessionPool(factory=FakeClient, idle_timeout=0)
+    yield pool
+    pool.close()
+
+
+def test_session_kept_while_checked_out(pool):
+    """A session is shared by its users and closed after the last one."""
+    first = pool.acquire("plc")
+    second = pool.acquire("plc")
+    assert first is second
+    assert first.connects == 1
+
+    pool.release(first)
+    assert second.connected
+    pool.release(second)
+    assert not second.connected
+    assert "plc" not in pool.sessions
+
+
+def test_idle_session_reused_within_timeout(pool):
+    """A session checked out again before it expires is not reconnected."""
+    pool.idle_timeout = 60.0
+    client = pool.acquire("plc")
+    pool.release(client)
+    assert client.connected
+
+    assert pool.acquire("plc") is client
+    assert client.connects == 1
+    pool.release(client)
+    pool.close()
+    assert not client.connected
+
+
+@pytest.fixture(scope="module")
+def client():
+    """Client connected to a virtual PLC with one transmitter."""
+    plc = VirtualPLC()
+    plc.addDevices(1)
+    plc.start()
+    client = OPCClient("localhost")
+    client.connect()
+    yield client
+    client.disconnect()
+    plc.stop()
+
+
+def transmitter(client):
+    """Return input node of the transmitter of the virtual PLC."""
+    ns = client.get_namespace_index(NAMESPACES[1])
+    path = ["0:Objects", "{}:PLC_1".format(ns), "{}:Inputs".format(ns)]
+    return client.get_root_node().get_child(path + ["{}:hwi_TT-001".format(ns)])
+
+
+def test_wait_after_resubscribe_ignores_old_value(client):
+    """A node monitored again is not waited for on its value from before."""
+    node = transmitter(client)
+
+    client.subscribe([node])
+    assert client.wait_for(node, 0)
+    client.unsubscribe([node])
+
+    client.setValue(node, 5)
+    assert not client.wait_for(node, 0, timeout=0.5)
+    assert client.wait_for(node, 5)
+
+
+def test_unsubscribe_keeps_other_consumers(client):
+    """A consumer unsubscribing leaves the node monitored for the others."""
+    node = transmitter(client)
+    client.unsubscribe([node])  # By the waits of other tests
+    changed = threading.Event()
+
+    def callback(nodeid, value):
+        if value == 7:
+            changed.set()
+
+    client.subscribe([node], callback)
+    client.subscribe([node], consumer="gui")
+    client.unsubscribe([node], consumer="gui")
+    assert node.nodeid in client.monitored
+
+    client.setValue(node, 7)
+    assert changed.wait(2.0)
+    assert client.subscription_handler.get(node.nodeid) is not None
+
+    client.unsubscribe([node], consumer=callback)
+    assert node.nodeid not in client.monitored
+    assert client.subscription_handler.get(node.nodeid) is None
+
+
+@pytest.mark.parametrize(
+    "ip, port", [("localhost", 4841), ("opc.tcp://localhost:4841", 4840)]
+)
+def test_connect_to_other_port(ip, port):
+    """A virtual PLC served on another port is reached by port or url."""
+    plc = VirtualPLC(4841)
+    plc.addDevices(1)
+    plc.start()
+    try:
+        client = OPCClient(ip, port=port, path_cache_dir=None)
+        client.connect()
+        try:
+            assert transmitter(client).get_value() is not None
+        finally:
+            client.disconnect()
+    finally:
+        plc.stop()
+
+
+def test_paths_not_persisted_without_revision(tmp_path):
+    """Paths of a PLC not exposing its program revision are not saved."""
+    plc = VirtualPLC(4841, revision="")
+    plc.addDevices(1)
+    plc.start()
+    try:
+        client = OPCClient("localhost", port=4841, path_cache_dir=str(tmp_path))
+        client.connect()
+        try:
+            ns = client.get_namespace_index(NAMESPACES[1])
+            path = ["0:Objects", "{}:PLC_1".format(ns), "{}:Inputs".format(ns)]
+            assert client.resolvePath(path) is not None
+            index = client.getPathIndex()
+            assert index.path is None and len(index.paths) == 1
+        finally:
+            client.disconnect()
+    finally:
+        plc.stop()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,191 @@
+from opcua import ua
+from opcua.common.node import Node
+
+from pete import opc_common
+from pete.opc_common import (
+    DEFAULT_CHUNK_SIZE,
+    MISSING,
+    OPERATION_LIMITS,
+    NodeCache,
+    ShadowCache,
+    Subscribers,
+    chunks,
+    collectReferences,
+    conditionPredicates,
+    indexedPaths,
+    operationLimitItems,
+    parseOperationLimits,
+    satisfied,
+    serverUrl,
+    toPython,
+)
+from pete.path_index import PathIndex
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+def test_node_kept_until_last_consumer_removed():
+    """A node has consumers until each of them is removed."""
+    subscribers = Subscribers()
+    subscribers.add("ns=3;s=A", None)
+    subscribers.add("ns=3;s=A", "gui")
+    subscribers.add("ns=3;s=A", print, print)
+
+    assert subscribers.remove("ns=3;s=A", "gui") == (None, False)
+    assert subscribers.remove("ns=3;s=A", print) == (print, False)
+    assert "ns=3;s=A" in subscribers
+    assert subscribers.remove("ns=3;s=A", None) == (None, True)
+    assert "ns=3;s=A" not in subscribers
+
+
+def test_consumer_counted_once_per_node():
+    """A consumer subscribing twice is removed by one unsubscribe."""
+    subscribers = Subscribers()
+    subscribers.add("ns=3;s=A", None)
+    subscribers.add("ns=3;s=A", None)
+    assert subscribers.remove("ns=3;s=A", None) == (None, True)
+    assert subscribers.remove("ns=3;s=A", None) == (None, True)
+
+
+def test_server_url():
+    """A PLC is addressed by ip and port, or by its full url."""
+    assert serverUrl("10.0.0.1") == "opc.tcp://10.0.0.1:4840"
+    assert serverUrl("localhost", 4841) == "opc.tcp://localhost:4841"
+    assert serverUrl("opc.tcp://plc:4842/", 4841) == "opc.tcp://plc:4842/"
+
+
+def test_chunks_bounded_by_size():
+    """Items are split into chunks of at most size items, in order."""
+    items = list(range(7))
+    assert list(chunks(items, 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunks(items, 7)) == [items]
+    assert list(chunks([], 3)) == []
+
+
+def test_operation_limits_default_when_not_imposed():
+    """Limits of 0, or not exposed by the server, fall back to the default."""
+    items = operationLimitItems(ua)
+    assert len(items) == len(OPERATION_LIMITS)
+    assert all(attribute == ua.AttributeIds.Value for _, attribute in items)
+
+    unknown = ua.DataValue(status=ua.StatusCode(ua.StatusCodes.BadNodeIdUnknown))
+    results = [
+        ua.DataValue(ua.Variant(500, ua.VariantType.UInt32)),
+        ua.DataValue(ua.Variant(0, ua.VariantType.UInt32)),
+        unknown,
+        ua.DataValue(ua.Variant(100, ua.VariantType.UInt32)),
+    ]
+    assert parseOperationLimits(results) == {
+        "read": 500,
+        "write": DEFAULT_CHUNK_SIZE,
+        "browse": DEFAULT_CHUNK_SIZE,
+        "translate": 100,
+    }
+
+
+def test_node_cache_evicts_least_recently_used():
+    """A full cache evicts the entry not used for the longest time."""
+    cache = NodeCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # 'b' is now the least recently used
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+    assert cache.get("b") is None
+
+
+def test_node_cache_invalidate():
+    """Entries are forgotten by key, or all at once."""
+    cache = NodeCache()
+    for key in "abc":
+        cache.put(key, key.upper())
+    cache.invalidate(["a", "unknown"])
+    assert "a" not in cache and len(cache) == 2
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_shadow_cache_deadband():
+    """Numbers within the deadband are unchanged, other values must equal."""
+    shadow = ShadowCache(deadband=0.5)
+    shadow.put("tt", 20.0)
+    assert shadow.unchanged("tt", 20.4)
+    assert not shadow.unchanged("tt", 20.6)
+    shadow.put("ysv", True)
+    assert shadow.unchanged("ysv", True)
+    assert not shadow.unchanged("ysv", 1)  # A bool is not a number
+    assert not shadow.unchanged("unknown", 0)
+
+
+def test_shadow_cache_max_age(monkeypatch):
+    """Values of nodes that are not monitored age, those monitored do not."""
+    now = [100.0]
+    monkeypatch.setattr(opc_common.time, "monotonic", lambda: now[0])
+    shadow = ShadowCache(max_age=1.0)
+    shadow.put("tt", 20.0)
+    now[0] += 0.5
+    assert shadow.get("tt") == 20.0
+    now[0] += 1.0
+    assert shadow.get("tt") is MISSING
+    assert not shadow.unchanged("tt", 20.0)
+    assert shadow.get("tt", monitored=True) == 20.0
+    shadow.invalidate(["tt"])
+    assert shadow.get("tt", monitored=True) is MISSING
+
+
+def test_to_python_casts_user_input():
+    """Text is cast to the Python type of a variant type."""
+    assert toPython(ua.VariantType.Boolean, "True") is True
+    assert toPython(ua.VariantType.Boolean, "0") is False
+    assert toPython(ua.VariantType.Int16, "-12") == -12
+    assert toPython(ua.VariantType.Float, "1.5") == 1.5
+    assert toPython(ua.VariantType.ByteString, "abc") == "abc"
+    assert toPython(None, 3) == "3"
+
+
+def test_conditions_satisfied_by_latest_values():
+    """Conditions hold expected values or predicates, per node or node id."""
+    tt, ysv = ua.NodeId.from_string("ns=3;s=TT"), ua.NodeId.from_string("ns=3;s=YSV")
+    predicates = conditionPredicates({Node(None, tt): lambda v: v > 20, ysv: True})
+    assert set(predicates) == {tt, ysv}
+
+    latest = {tt: ua.DataValue(ua.Variant(25))}
+    assert not satisfied(latest, predicates)  # No value of YSV yet
+    latest[ysv] = ua.DataValue(ua.Variant(True))
+    assert satisfied(latest, predicates)
+    latest[tt] = ua.DataValue(ua.Variant(15))
+    assert not satisfied(latest, predicates)
+
+
+def test_indexed_paths(tmp_path):
+    """Paths are looked up in the index, listing those not indexed."""
+    index = PathIndex("opc.tcp://plc:4840", 1, str(tmp_path))
+    index.put(PathIndex.key("i=85", ["3:PLC_1"]), "ns=3;s=PLC_1")
+    paths = ["3:PLC_1", ["3:PLC_1", "3:Inputs"]]
+    assert indexedPaths(index, "i=85", paths) == (
+        ["ns=3;s=PLC_1", None],
+        [(1, ["3:PLC_1", "3:Inputs"])],
+    )
+    assert indexedPaths(None, "i=85", paths) == (
+        [None, None],
+        [(0, ["3:PLC_1"]), (1, ["3:PLC_1", "3:Inputs"])],
+    )
+
+
+def test_collect_references_with_continuation():
+    """References are added per position, and continuations returned."""
+    done, more, bad = ua.BrowseResult(), ua.BrowseResult(), ua.BrowseResult()
+    done.References = ["a"]
+    more.References = ["b", "c"]
+    more.ContinuationPoint = b"next"
+    bad.StatusCode = ua.StatusCode(ua.StatusCodes.BadNodeIdUnknown)
+    references = [[], [], []]
+    pending = collectReferences(
+        references, [(0, None), (1, None), (2, None)], [done, more, bad]
+    )
+    assert references == [["a"], ["b", "c"], []]
+    assert pending == [(1, b"next")]
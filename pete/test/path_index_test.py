@@ -0,0 +1,55 @@
+from opcua import ua
+
+from pete.path_index import PathIndex
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+URI = "opc.tcp://plc:4840"
+
+
+def test_key_of_names_and_qualified_names():
+    """Browse names and qualified names of a path give the same key."""
+    path = ["0:Objects", ua.QualifiedName("PLC_1", 3), "3:Inputs"]
+    assert PathIndex.key("i=84", path) == "i=84/0:Objects/3:PLC_1/3:Inputs"
+    assert PathIndex.key("i=84", path) == PathIndex.key(
+        "i=84", ["0:Objects", "3:PLC_1", "3:Inputs"]
+    )
+    assert PathIndex.key("i=85", path) != PathIndex.key("i=84", path)
+
+
+def test_index_kept_per_server_and_revision(tmp_path):
+    """Saved paths are loaded for the same server and PLC program revision."""
+    index = PathIndex(URI, 1, str(tmp_path))
+    key = PathIndex.key("i=84", ["0:Objects", "3:PLC_1"])
+    index.put(key, "ns=3;s=PLC_1")
+    index.save()
+
+    assert PathIndex(URI, "1", str(tmp_path)).get(key) == "ns=3;s=PLC_1"
+    assert PathIndex(URI, 2, str(tmp_path)).get(key) is None
+    assert PathIndex("opc.tcp://other:4840", 1, str(tmp_path)).get(key) is None
+
+
+def test_save_only_when_changed(tmp_path):
+    """An index is written when a path is added or moved, and cleared."""
+    index = PathIndex(URI, 1, str(tmp_path))
+    index.put("i=84/0:Objects", "i=85")
+    index.save()
+    index.put("i=84/0:Objects", "i=85")
+    assert not index.dirty
+    index.put("i=84/0:Objects", "i=86")
+    assert index.dirty
+
+    index.clear()
+    assert PathIndex(URI, 1, str(tmp_path)).get("i=84/0:Objects") is None
+
+
+def test_index_in_memory_only(tmp_path):
+    """An index without a cache directory is never written to disk."""
+    index = PathIndex(URI, "", None)
+    index.put("i=84/0:Objects", "i=85")
+    index.save()
+    assert index.get("i=84/0:Objects") == "i=85"
+    index.clear()
+    assert index.path is None and index.paths == {}
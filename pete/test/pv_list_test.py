@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from pete.pv_list import PVTrie
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+PVS = [
+    "Tgt-HeC1010:Proc-TT-001:HIHI",
+    "Tgt-HeC1010:Proc-TT-001:LOLO",
+    "Tgt-HeC1010:Proc-TT-002:HIHI",
+    "Tgt-HeC1010:Proc-YSV-001:Opened",
+    "Tgt-HeC1020:Proc-CV-001:Openness",
+]
+
+
+@pytest.fixture
+def trie():
+    return PVTrie.fromLines(PVS)
+
+
+def search(trie, pattern, within=None):
+    """Return PV names matching a pattern."""
+    return [trie.names()[i] for i in trie.search(pattern, within)]
+
+
+def test_search_substring_ignoring_case(trie):
+    """A substring matches PV names holding it, in any case."""
+    assert search(trie, "proc-tt-00") == PVS[:3]
+    assert search(trie, "OPEN") == PVS[3:]
+    assert search(trie, "") == PVS
+    assert search(trie, "nothing") == []
+
+
+def test_search_glob(trie):
+    """A glob pattern matches full PV names."""
+    assert search(trie, "*:HIHI") == [PVS[0], PVS[2]]
+    assert search(trie, "tgt-hec1020:*") == [PVS[4]]
+    assert search(trie, "*:Proc-TT-00?:*") == PVS[:3]
+    assert search(trie, "*-00[2-9]:*") == [PVS[2]]
+    assert search(trie, "Tgt-HeC1010:Proc-TT-001:HIHI") == [PVS[0]]
+
+
+def test_search_within_previous_matches(trie):
+    """A longer substring narrows down the matches of a shorter one."""
+    matches = trie.search("tt")
+    assert search(trie, "tt-002", matches) == [PVS[2]]
+
+
+def test_search_after_add(trie):
+    """Names added after a search are found by the next search."""
+    assert search(trie, "TT-003") == []
+    trie.add("Tgt-HeC1010:Proc-TT-003:HIHI")
+    assert search(trie, "TT-003") == ["Tgt-HeC1010:Proc-TT-003:HIHI"]
+
+
+def test_filter_latency_of_large_list():
+    """Filtering half a million PV names keeps up with typing."""
+    trie = PVTrie.fromLines(
+        "Tgt-HeC{:04d}:Proc-TT-{:03d}:Field{:02d}".format(i // 5000, i % 997, i % 50)
+        for i in range(500000)
+    )
+    trie.names()  # Built once, when the list is loaded
+
+    start = time.perf_counter()
+    matches = None
+    for pattern in ["t", "tt", "tt-", "tt-0", "tt-01", "tt-012"]:
+        matches = trie.search(pattern, matches)
+    trie.search("*:proc-tt-01?:field4?")
+    elapsed = time.perf_counter() - start
+
+    names = trie.names()
+    assert matches and all("TT-012" in names[i] for i in matches)
+    assert elapsed < 2.0
+
+
+def test_trie_shares_prefixes(trie):
+    """PVs sharing a prefix share its nodes, and are listed sorted."""
+    assert len(trie) == len(PVS)
+    system = trie.find("Tgt-HeC1010")
+    assert [c.name for c in system.sortedChildren()] == [
+        "Proc-TT-001",
+        "Proc-TT-002",
+        "Proc-YSV-001",
+    ]
+    device = trie.find("Tgt-HeC1010:Proc-TT-001")
+    assert not device.is_pv and device.hasChildren()
+    assert [c.row for c in device.sortedChildren()] == [0, 1]
+    assert trie.find(PVS[0]).is_pv
+    assert trie.find(PVS[0]).path() == PVS[0]
+    assert trie.find("Tgt-HeC1010:Proc-TT-009") is None
+
+
+def test_trie_from_lines(tmp_path):
+    """PV names are read one per line, skipping blanks and duplicates."""
+    path = tmp_path / "pvs.txt"
+    path.write_text("\n".join(reversed(PVS)) + "\n\n" + PVS[0] + "\n")
+    trie = PVTrie.fromFile(str(path))
+    assert len(trie) == len(PVS)
+    assert list(trie) == sorted(PVS)
@@ -0,0 +1,345 @@
+import types
+
+import numpy as np
+import pytest
+
+from pete.clock import VirtualClock
+from pete.sim import ysv
+from pete.sim.cv import CV
+from pete.sim.engine import Engine
+from pete.sim.signals import MAX_COUNTS, SignalBank
+from pete.sim.ysv import YSV
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+class FakeNode(object):
+    """Stand-in for an OPCUA node, named like a PLC tag."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_display_name(self):
+        return types.SimpleNamespace(Text=self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+class FakeClient(object):
+    """Stand-in for `OPCClient`, holding the values written by the engine."""
+
+    def __init__(self):
+        self.values = {}  # Latest value per node
+        self.callbacks = {}  # Data change callback per node
+        self.batches = []  # Values per batched write
+
+    def getValue(self, node):
+        return self.values.get(node)
+
+    def write_many(self, values):
+        self.batches.append(dict(values))
+        self.values.update(values)
+
+    def subscribe(self, nodes, callback=None, consumer=None):
+        for node in nodes:
+            assert node not in self.callbacks, "Subscribed twice"
+            self.callbacks[node] = (consumer, callback)
+
+    def unsubscribe(self, nodes=None, consumer=None):
+        for node in nodes:
+            if self.callbacks[node][0] is consumer:
+                del self.callbacks[node]
+
+    def notify(self, node, value):
+        """Notify data change of node, as the subscription would."""
+        self.values[node] = value
+        self.callbacks[node][1](node, value)
+
+
+@pytest.fixture
+def engine():
+    """Running engine on a virtual clock."""
+    engine = Engine(FakeClient(), clock=VirtualClock())
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+class Counter(object):
+    """Device writing the number of times it has been stepped."""
+
+    def __init__(self, node):
+        self.node = node
+        self.steps = 0
+
+    def step(self, engine):
+        self.steps += 1
+        engine.write(self.node, self.steps)
+
+
+def test_engine_batches_devices_of_a_period(engine):
+    """Devices of the same period are stepped in the same ticks."""
+    first, second = Counter("a"), Counter("b")
+    engine.call_later(0, engine.add, first, 0.1)
+    engine.call_later(0, engine.add, second, 0.1)
+    engine.clock.advance(1.0)
+    assert first.steps == second.steps == 10
+    assert engine.client.batches == [{"a": i, "b": i} for i in range(1, 11)]
+    assert engine.n_writes == 20
+
+
+def test_engine_slots_timers(engine):
+    """Timers due within one slot fire in one tick, in the order scheduled."""
+    calls = []
+    engine.call_later(0.109, calls.append, "first")
+    engine.call_later(0.101, calls.append, "second")
+    engine.call_later(0.105, engine.write, "x", 1)
+    engine.call_later(0.108, engine.write, "x", 2)
+    engine.call_later(0.111, calls.append, "third")
+    cancelled = engine.call_later(0.105, calls.append, "cancelled")
+    cancelled.cancel()
+
+    engine.clock.advance(0.11)
+    assert calls == ["first", "second"]
+    assert engine.n_ticks == 1
+    assert engine.client.batches == [{"x": 2}]  # Last value of the tick
+    engine.clock.advance(0.01)
+    assert calls == ["first", "second", "third"]
+
+
+def test_engine_subscribes_once_and_releases_nodes():
+    """Devices share one subscription per node, released on stop."""
+    engine = Engine(FakeClient(), clock=VirtualClock())
+    engine.start()
+    calls = []
+
+    def first(nodeid, value):
+        calls.append(("first", nodeid, value))
+
+    def second(nodeid, value):
+        calls.append(("second", nodeid, value))
+
+    try:
+        engine.call_later(0, engine.subscribe, ["cmd"], first)
+        engine.clock.advance(0.01)
+        engine.client.notify("cmd", 1)
+        engine.clock.advance(0.01)
+        engine.call_later(0, engine.subscribe, ["cmd", "x"], second)
+        engine.clock.advance(0.02)
+        assert calls == [("first", "cmd", 1), ("second", "cmd", 1)]
+
+        engine.client.notify("cmd", 2)
+        engine.clock.advance(0.01)
+        assert calls[2:] == [("first", "cmd", 2), ("second", "cmd", 2)]
+        assert engine.client.callbacks["cmd"][0] is engine
+    finally:
+        engine.stop()
+    assert engine.client.callbacks == {}
+
+
+@pytest.fixture
+def valve(engine):
+    """Closed valve, energized to open, taking 1 s to travel."""
+    valve = YSV(
+        engine.client,
+        FakeNode("hwo_YSV-001_open"),
+        FakeNode("hwi_YSV-001_opened"),
+        FakeNode("hwi_YSV-001_closed"),
+        move_time=1.0,
+    )
+    engine.client.values[valve.opened_node] = False
+    engine.call_later(0, engine.add, valve)
+    engine.clock.advance(0.1)
+    return valve
+
+
+def signals(valve):
+    """Return the 'opened' and 'closed' signals shown by a valve."""
+    values = valve.client.values
+    return values[valve.opened_node], values[valve.closed_node]
+
+
+def test_ysv_opens_and_closes(engine, valve):
+    """A command moves the valve through opening to open, and back."""
+    assert valve.state == ysv.CLOSED
+    assert signals(valve) == (False, True)
+
+    engine.client.notify(valve.energized_node, True)
+    engine.clock.advance(0.5)
+    assert valve.state == ysv.OPENING
+    assert signals(valve) == (False, False)
+    engine.clock.advance(0.6)
+    assert valve.state == ysv.OPEN
+    assert signals(valve) == (True, False)
+
+    engine.client.notify(valve.energized_node, False)
+    engine.clock.advance(1.1)
+    assert valve.state == ysv.CLOSED
+    assert signals(valve) == (False, True)
+
+
+def test_ysv_reverses_mid_travel(engine, valve):
+    """A valve closed while opening travels back from where it is."""
+    engine.client.notify(valve.energized_node, True)
+    engine.clock.advance(0.3)
+    engine.client.notify(valve.energized_node, False)
+    engine.clock.advance(0.2)
+    assert valve.state == ysv.CLOSING
+    engine.clock.advance(0.2)
+    assert valve.state == ysv.CLOSED
+
+
+def test_ysv_injected_fault_and_reset(engine, valve):
+    """A faulted valve shows an IO error, ignores commands until reset."""
+    valve.injectFault(1.0, duration=2.0)
+    engine.clock.advance(1.1)
+    assert valve.state == ysv.FAULT
+    assert signals(valve) == (True, True)
+
+    engine.client.notify(valve.energized_node, True)
+    engine.clock.advance(1.0)
+    assert valve.state == ysv.FAULT
+
+    engine.clock.advance(1.0)  # Reset, following the open command
+    assert valve.state == ysv.OPENING
+    engine.clock.advance(1.1)
+    assert valve.state == ysv.OPEN
+    assert signals(valve) == (True, False)
+
+
+def test_ysv_stuck_fault_freezes_valve(engine, valve):
+    """A stuck valve keeps its signals, and travels on once reset."""
+    engine.client.notify(valve.energized_node, True)
+    engine.clock.advance(0.5)
+    valve.injectFault(0.0, stuck=True)
+    engine.clock.advance(2.0)
+    assert valve.state == ysv.FAULT
+    assert signals(valve) == (False, False)
+
+    engine.call_later(0, valve.reset)
+    engine.clock.advance(0.1)
+    assert valve.state == ysv.OPENING
+    engine.clock.advance(0.6)
+    assert valve.state == ysv.OPEN
+
+
+class OfflineNode(FakeNode):
+    """Node that must not be looked up, as its name is known already."""
+
+    def get_display_name(self):
+        raise AssertionError("Display name of {} read from the PLC".format(self))
+
+
+def test_valves_start_from_known_names_and_states(engine, monkeypatch):
+    """Valves given their names and states do not read them from the PLC."""
+
+    def getValue(node):
+        raise AssertionError("{} read from the PLC".format(node))
+
+    monkeypatch.setattr(engine.client, "getValue", getValue)
+    valve = YSV(
+        engine.client,
+        OfflineNode("hwo_YSV-002_close"),
+        OfflineNode("hwi_YSV-002_opened"),
+        OfflineNode("hwi_YSV-002_closed"),
+        name="hwo_YSV-002_close",
+        opened=True,
+    )
+    cv = CV(engine.client, "cmd", "fb", name="hwi_CV-003", openness=40.0)
+    engine.call_later(0, engine.add, valve)
+    engine.call_later(0, engine.add, cv)
+    engine.clock.advance(0.1)
+
+    assert valve.state == ysv.OPEN and not valve.energize_to_open
+    assert signals(valve) == (True, False)
+    assert valve.get_name() == "YSV-002"
+    assert cv.fb == 40.0 and cv.get_name() == "CV-003"
+
+
+def control_valve(engine, **kwargs):
+    """Return control valve at 0 %, moving 10 % per second."""
+    cv = CV(engine.client, "cmd", "fb", slew_rate=10.0, rate=10.0, **kwargs)
+    engine.call_later(0, engine.add, cv)
+    engine.clock.advance(0.1)
+    return cv
+
+
+def test_cv_slews_to_command(engine):
+    """Feedback follows the command at the slew rate, and rests there."""
+    cv = control_valve(engine)
+    engine.client.notify("cmd", 5.5)
+    engine.clock.advance(0.31)
+    assert engine.client.values["fb"] == pytest.approx(3.0)
+    engine.clock.advance(0.3)
+    assert engine.client.values["fb"] == 5.5
+    assert cv.moving is None
+
+    engine.client.notify("cmd", 2)  # Integer command, integer feedback
+    engine.clock.advance(0.21)
+    assert engine.client.values["fb"] == 4
+    engine.clock.advance(0.3)
+    assert engine.client.values["fb"] == 2
+
+
+def test_cv_stops_within_deadband(engine):
+    """A valve stops as soon as the command is within the deadband."""
+    cv = control_valve(engine, deadband=2.0)
+    engine.client.notify("cmd", 10.0)
+    engine.clock.advance(2.0)
+    assert engine.client.values["fb"] == pytest.approx(8.0)
+    assert cv.moving is None
+
+    engine.client.notify("cmd", 9.0)  # Within deadband, not moving
+    engine.clock.advance(1.0)
+    assert engine.client.values["fb"] == pytest.approx(8.0)
+
+
+def test_cv_stiction(engine):
+    """A valve at rest moves for commands beyond stiction, all the way."""
+    cv = control_valve(engine, stiction=5.0)
+    engine.client.notify("cmd", 4.0)
+    engine.clock.advance(1.0)
+    assert "fb" not in engine.client.values
+    assert cv.moving is None
+
+    engine.client.notify("cmd", 6.0)
+    engine.clock.advance(1.0)
+    assert engine.client.values["fb"] == 6.0
+
+
+def test_signals_clipped_to_counts_range():
+    """Samples stay within the raw counts range, as integers."""
+    bank = SignalBank(
+        range(3), setpoint=[0.0, 13500.0, MAX_COUNTS], noise=5000.0, seed=1
+    )
+    samples = np.array([bank.sample(0.1) for _ in range(200)])
+    assert samples.dtype == np.int64
+    assert samples.min() == 0 and samples.max() == MAX_COUNTS
+    assert (samples[:, 1] > 0).any() and (samples[:, 1] < MAX_COUNTS).any()
+
+
+def test_signals_ramp_bounces_off_range():
+    """A ramping setpoint turns back at the ends of the range."""
+    bank = SignalBank(
+        range(2), setpoint=[MAX_COUNTS - 10, 10], noise=0.0, ramp=[100.0, -100.0]
+    )
+    bank.sample(1.0)
+    assert bank.setpoint.tolist() == [MAX_COUNTS - 90, 90]
+    assert bank.ramp.tolist() == [-100.0, 100.0]
+    for _ in range(10):
+        assert 0 <= bank.setpoint.min() and bank.setpoint.max() <= MAX_COUNTS
+        bank.sample(1.0)
+
+
+def test_signals_steps_clipped():
+    """Random setpoint steps do not leave the range."""
+    bank = SignalBank(
+        range(50), setpoint=100.0, noise=0.0, step=1000.0, step_rate=10.0, seed=2
+    )
+    for _ in range(20):
+        values = bank.sample(0.1)
+        assert 0 <= values.min() and values.max() <= MAX_COUNTS
+    assert (bank.setpoint == 0).any()
@@ -0,0 +1,104 @@
+import pytest
+
+from pete.opc_client import OPCClient
+from pete.snapshot import Snapshot, _Rows
+from pete.virtual_plc import NAMESPACES, VirtualPLC
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+def test_rows_round_trip(tmp_path):
+    """Nodes written as a snapshot file are read back as they were added."""
+    rows = _Rows()
+    rows.add(-1, "i=85", "0:Objects", "", 1, None)
+    rows.first_child[0], rows.child_count[0] = 1, 1
+    rows.add(0, "ns=3;s=PLC", "3:PLC", "", 1, None)
+    rows.first_child[1], rows.child_count[1] = 2, 2
+    rows.add(1, 'ns=3;s="TT-001"', "3:TT-001", "Température", 2, "i=4")
+    rows.add(1, 'ns=3;s="CV-001"', "3:CV-001", "", 2, "i=10")
+    path = str(tmp_path / "snapshot")
+    rows.write(
+        path,
+        {"server": "opc.tcp://plc:4840", "revision": "7", "start_path": ["0:Objects"]},
+    )
+
+    snapshot = Snapshot(path)
+    try:
+        assert len(snapshot) == 4
+        assert snapshot.revision == "7"
+        assert snapshot.plc() == 1
+        tt = snapshot.find(["0:Objects", "3:PLC", "3:TT-001"])
+        assert snapshot.nodeid(tt) == 'ns=3;s="TT-001"'
+        assert snapshot.display_name(tt) == "Température"
+        assert snapshot.data_type(tt) == "i=4"
+        assert snapshot.path(tt) == ["0:Objects", "3:PLC", "3:TT-001"]
+        cv = snapshot.index('ns=3;s="CV-001"')
+        assert snapshot.display_name(cv) == "CV-001"
+        assert snapshot.data_type(0) is None
+        assert snapshot.find(["0:Objects", "3:PLC", "3:YSV-001"]) is None
+    finally:
+        snapshot.close()
+
+
+def test_open_rejects_other_files(tmp_path):
+    """A file that is not a snapshot is not opened."""
+    path = tmp_path / "snapshot"
+    path.write_bytes(b"NOTASNAPSHOT" * 4)
+    with pytest.raises(ValueError):
+        Snapshot(str(path))
+
+
+@pytest.fixture(scope="module")
+def client():
+    """Client connected to a virtual PLC with three devices."""
+    plc = VirtualPLC()
+    plc.addDevices(3)
+    plc.start()
+    client = OPCClient("localhost", path_cache_dir=None)
+    client.connect()
+    yield client
+    client.disconnect()
+    plc.stop()
+
+
+def snapshotNodes(snapshot):
+    """Return (path, node id, data type) of every node of a snapshot."""
+    return sorted(
+        (tuple(snapshot.path(i)), snapshot.nodeid(i), snapshot.data_type(i) or "")
+        for i in range(len(snapshot))
+    )
+
+
+def test_rebuild_copies_standard_nodes(client, tmp_path):
+    """A rebuild browses the PLC nodes only, and finds the same nodes."""
+    first = str(tmp_path / "first")
+    Snapshot.build(client, first)
+    snapshot = Snapshot(first)
+
+    browsed = []
+    browse_many = client.browse_many
+
+    def counting(nodes):
+        browsed.extend(nodes)
+        return browse_many(nodes)
+
+    client.browse_many = counting
+    second = str(tmp_path / "second")
+    try:
+        Snapshot.build(client, second, standard=snapshot)
+    finally:
+        del client.browse_many
+
+    rebuilt = Snapshot(second)
+    try:
+        assert snapshotNodes(rebuilt) == snapshotNodes(snapshot)
+        ns = client.get_namespace_index(NAMESPACES[1])
+        plc = rebuilt.find(["0:Objects", "{}:PLC_1".format(ns)])
+        assert plc is not None
+        assert all(n.nodeid.NamespaceIndex != 0 for n in browsed[1:])
+        assert len(browsed) < len(snapshot)
+    finally:
+        rebuilt.close()
+        snapshot.close()
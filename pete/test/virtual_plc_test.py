@@ -0,0 +1,102 @@
+import sys
+
+import pytest
+
+from pete import virtual_plc
+from pete.opc_client import OPCClient
+from pete.snapshot import Snapshot
+from pete.virtual_plc import NAMESPACES, VirtualPLC
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+
+@pytest.fixture
+def serve():
+    """Return function serving a virtual PLC, stopped after the test."""
+    plcs = []
+
+    def serve(plc):
+        plc.start()
+        plcs.append(plc)
+        return plc
+
+    yield serve
+    for plc in plcs:
+        plc.stop()
+
+
+def connect(port):
+    """Return client connected to the virtual PLC on a port."""
+    client = OPCClient("localhost", port=port, path_cache_dir=None)
+    client.connect()
+    return client
+
+
+def plcNodes(snapshot):
+    """Return (path, node id, data type) of every PLC node of a snapshot."""
+    return sorted(
+        (tuple(snapshot.path(i)), snapshot.nodeid(i), snapshot.data_type(i))
+        for i in range(len(snapshot))
+        if not snapshot.nodeid(i).startswith("i=")
+    )
+
+
+def test_snapshot_round_trip(serve, tmp_path, monkeypatch):
+    """A PLC recorded and served again has the same nodes and revision."""
+    plc = VirtualPLC(4841, revision="7")
+    plc.addDevices(3)
+    serve(plc)
+    recorded = str(tmp_path / "recorded")
+    argv = ["pete-plc", "record", "opc.tcp://localhost:4841", recorded]
+    monkeypatch.setattr(sys, "argv", argv)
+    virtual_plc.run()
+
+    snapshot = Snapshot(recorded)
+    mirror = VirtualPLC(4842)
+    mirror.fromSnapshot(snapshot)
+    serve(mirror)
+    client = connect(4842)
+    try:
+        assert client.getSoftwareRevision() == "7"
+        mirrored = str(tmp_path / "mirrored")
+        Snapshot.build(client, mirrored)
+    finally:
+        client.disconnect()
+
+    again = Snapshot(mirrored)
+    try:
+        assert again.revision == "7"
+        assert plcNodes(again) == plcNodes(snapshot)
+        assert len(plcNodes(again)) > plc.n_nodes
+        ns = snapshot.name(snapshot.plc()).split(":")[0]
+        path = ["0:Objects", "{}:PLC_1".format(ns), "{}:Inputs".format(ns)]
+        tt = again.find(path + ["{}:hwi_TT-001".format(ns)])
+        assert again.data_type(tt) == "i=4"  # Int16
+    finally:
+        again.close()
+        snapshot.close()
+
+
+def test_echo_copies_outputs_to_inputs(serve):
+    """A write to an output is echoed to its input."""
+    plc = VirtualPLC(4841)
+    plc.addDevices(3)
+    serve(plc)
+    plc.enableEcho(period=20)
+
+    client = connect(4841)
+    try:
+        ns = client.get_namespace_index(NAMESPACES[1])
+        path = ["0:Objects", "{}:PLC_1".format(ns)]
+        cmd, fb = client.resolvePaths(
+            [
+                path + ["{}:Outputs".format(ns), "{}:hwo_CV-003".format(ns)],
+                path + ["{}:Inputs".format(ns), "{}:hwi_CV-003".format(ns)],
+            ]
+        )
+        client.setValue(cmd, 42.0)
+        assert client.wait_for(fb, 42.0, timeout=2.0)
+    finally:
+        client.disconnect()
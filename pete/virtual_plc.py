@@ -0,0 +1,317 @@
+import argparse
+import datetime
+import time
+
+from pete.lazy import LazyModule
+from pete.snapshot import Snapshot
+
+__author__ = "Johannes Kazantzidis"
+__email__ = "johannes.kazantzidis@ess.eu"
+__status__ = "Production"
+
+# opcua is imported on first use, so that e.g. '--help' does not wait for it
+ua = LazyModule("opcua.ua")
+
+# Namespaces of a Siemens S7-1500 OPCUA server. Registering them in order
+# gives PLC nodes the same namespace indices as on a real PLC (2 and 3).
+NAMESPACES = [
+    "http://opcfoundation.org/UA/DI/",
+    "http://www.siemens.com/simatic-s7-opcua",
+]
+
+# Initial value per variant type name of variables in the virtual PLC
+DEFAULT_VALUES = {
+    "Boolean": False,
+    "SByte": 0,
+    "Byte": 0,
+    "Int16": 0,
+    "UInt16": 0,
+    "Int32": 0,
+    "UInt32": 0,
+    "Int64": 0,
+    "UInt64": 0,
+    "Float": 0.0,
+    "Double": 0.0,
+    "String": "",
+    "DateTime": datetime.datetime(1970, 1, 1),
+}
+
+
+class EchoHandler(object):
+    def __init__(self, pairs):
+        """Initialize handler copying PLC outputs to PLC inputs.
+
+        Args:
+            pairs (dict(ua.NodeId, Node)): Input node per output node id.
+        """
+        self.pairs = pairs
+
+    def datachange_notification(self, node, val, data):
+        """Copy new output value to its input."""
+        target = self.pairs.get(node.nodeid)
+        if target is not None:
+            target.set_value(data.monitored_item.Value)
+
+
+class VirtualPLC(object):
+    def __init__(self, port=4840, name="PLC_1", revision="1"):
+        """Initialize a local OPCUA server standing in for a Siemens PLC.
+
+        The server mirrors the layout of a PLC's address space, i.e.
+        'Objects/<PLC>/Inputs', 'Outputs', 'DataBlocksInstance' and
+        'DataBlocksGlobal', either recorded from a real PLC (see
+        `fromSnapshot`) or generated (see `addDevices`). This allows
+        `OPCClient`, the simulators and the GUI to be tested offline.
+
+        Args:
+            port (int): TCP port to serve on.
+            name (str): Name of the PLC node, unless taken from a snapshot.
+            revision (str): PLC program revision (SoftwareRevision).
+        """
+        from opcua import Server
+
+        self.server = Server()
+        self.server.set_endpoint("opc.tcp://0.0.0.0:{}/".format(port))
+        self.server.set_server_name("pete virtual PLC")
+        self.ns = [self.server.register_namespace(uri) for uri in NAMESPACES]
+        self.name = name
+        self.revision = revision
+        self.plc = None
+        self.n_nodes = 0
+        self.echo = None
+
+    def fromSnapshot(self, snapshot):
+        """Mirror the PLC nodes of a snapshot, including their data types.
+
+        Standard (namespace 0) nodes, such as the 'Server' object, are
+        provided by the server itself and are not mirrored.
+
+        Args:
+            snapshot (Snapshot): Snapshot taken of a real PLC.
+        """
+        self.revision = snapshot.revision
+        objects = self.server.get_objects_node()
+        level = [(c, objects) for c in snapshot.children(0)]
+        while level:
+            next_level = []
+            for i, parent in level:
+                nodeid = ua.NodeId.from_string(snapshot.nodeid(i))
+                if nodeid.NamespaceIndex == 0:
+                    continue
+
+                node = self._addNode(snapshot, i, nodeid, parent)
+                if node is not None:
+                    next_level.extend((c, node) for c in snapshot.children(i))
+            level = next_level
+
+        self.plc = self.server.get_node(
+            ua.NodeId.from_string(snapshot.nodeid(snapshot.plc()))
+        )
+        try:
+            revision = self.plc.get_child("{}:SoftwareRevision".format(self.ns[0]))
+            revision.set_value(self.revision)
+        except ua.UaStatusCodeError:
+            pass  # Snapshot is not of a Siemens PLC
+
+    def addDevices(self, n):
+        """Generate a PLC with n devices, following ESS naming conventions.
+
+        Devices are, in turn, transmitters (TT), on-off valves (YSV) and
+        control valves (CV), each with its hardware signals in 'Inputs'
+        and 'Outputs' and an instance data block in 'DataBlocksInstance'.
+
+        Args:
+            n (int): Number of devices.
+        """
+        ns = self.ns[1]
+        objects = self.server.get_objects_node()
+        self.plc = objects.add_object(
+            self._id(self.name), "{}:{}".format(ns, self.name)
+        )
+        self.plc.add_property(
+            self._id(self.name, "SoftwareRevision"),
+            "{}:SoftwareRevision".format(self.ns[0]),
+            self.revision,
+        )
+        inputs = self._folder(self.plc, "Inputs")
+        outputs = self._folder(self.plc, "Outputs")
+        instances = self._folder(self.plc, "DataBlocksInstance")
+        self._folder(self.plc, "DataBlocksGlobal")
+
+        def var(parent, name, value, vtype):
+            path = parent.nodeid.Identifier
+            node = parent.add_variable(
+                self._id(path, name), "{}:{}".format(ns, name), value, vtype
+            )
+            node.set_writable()
+            self.n_nodes += 1
+            return node
+
+        for k in range(n):
+            kind = ["TT", "YSV", "CV"][k % 3]
+            tag = "{}-{:03d}".format(kind, k + 1)
+            if kind == "TT":
+                var(inputs, "hwi_" + tag, 0, ua.VariantType.Int16)
+                signals = ["Measurement", "HIHI", "HI", "LO", "LOLO", "IO_Error"]
+            elif kind == "YSV":
+                var(outputs, "hwo_{}_open".format(tag), False, ua.VariantType.Boolean)
+                var(inputs, "hwi_{}_opened".format(tag), False, ua.VariantType.Boolean)
+                var(inputs, "hwi_{}_closed".format(tag), True, ua.VariantType.Boolean)
+                signals = ["Opened", "Closed", "Opening_TimeOut", "IO_Error"]
+            else:
+                var(outputs, "hwo_" + tag, 0.0, ua.VariantType.Float)
+                var(inputs, "hwi_" + tag, 0.0, ua.VariantType.Float)
+                signals = ["Openness", "Setpoint", "IO_Error"]
+
+            db = instances.add_object(
+                self._id("DataBlocksInstance", tag),
+                "{}:DEV_{}_iDB".format(ns, tag),
+            )
+            db_inputs = self._folder(db, "Inputs")
+            for signal in signals:
+                var(db_inputs, signal, False, ua.VariantType.Boolean)
+
+    def enableEcho(self, period=50):
+        """Copy every output 'hwo_<tag>' to its input 'hwi_<tag>'.
+
+        This closes the loop of e.g. control valves, whose openness
+        feedback then follows the command, without running simulators.
+
+        Args:
+            period (int): Publishing interval in ms of the echo.
+        """
+        inputs = self.plc.get_child("{}:Inputs".format(self.ns[1]))
+        by_name = {}
+        for node in inputs.get_children():
+            by_name[node.get_browse_name().Name] = node
+
+        pairs = {}
+        outputs = self.plc.get_child("{}:Outputs".format(self.ns[1]))
+        for node in outputs.get_children():
+            name = node.get_browse_name().Name
+            target = by_name.get("hwi_" + name[len("hwo_") :])
+            if name.startswith("hwo_") and target is not None:
+                pairs[node.nodeid] = target
+
+        handler = EchoHandler(pairs)
+        self.echo = self.server.create_subscription(period, handler)
+        if pairs:
+            self.echo.subscribe_data_change(
+                [self.server.get_node(nodeid) for nodeid in pairs]
+            )
+
+    def start(self):
+        """Start serving."""
+        self.server.start()
+
+    def stop(self):
+        """Stop serving."""
+        if self.echo is not None:
+            self.echo.delete()
+        self.server.stop()
+
+    def _addNode(self, snapshot, i, nodeid, parent):
+        """Add snapshot node i under parent, returning None if skipped."""
+        name = ua.QualifiedName.from_string(snapshot.name(i))
+        node_class = snapshot.node_class(i)
+        if node_class == ua.NodeClass.Variable:
+            vtype, datatype = _variantType(snapshot.data_type(i))
+            node = parent.add_variable(
+                nodeid, name, DEFAULT_VALUES.get(vtype.name), vtype, datatype
+            )
+            node.set_writable()
+        elif node_class == ua.NodeClass.Object:
+            node = parent.add_object(nodeid, name)
+        else:
+            return None  # Methods and types are not mirrored
+
+        display_name = snapshot.display_name(i)
+        if display_name != name.Name:
+            node.set_attribute(
+                ua.AttributeIds.DisplayName,
+                ua.DataValue(ua.Variant(ua.LocalizedText(display_name))),
+            )
+        self.n_nodes += 1
+
+        return node
+
+    def _folder(self, parent, name):
+        """Add folder below parent, with a Siemens style string node id."""
+        path = parent.nodeid.Identifier
+        return parent.add_folder(self._id(path, name), "{}:{}".format(self.ns[1], name))
+
+    def _id(self, *path):
+        """Return string node id of a path of names."""
+        return ua.NodeId(".".join(path), self.ns[1])
+
+
+def _variantType(data_type):
+    """Return variant type and data type node id of a snapshot data type.
+
+    Data types that are not built in (e.g. PLC structs) are served as
+    BaseDataType with a null value.
+    """
+    if data_type is not None:
+        dtype = ua.NodeId.from_string(data_type)
+        vtype = ua.VariantType._value2member_map_.get(dtype.Identifier)
+        name = vtype.name if vtype is not None else None
+        if dtype.NamespaceIndex == 0 and name in DEFAULT_VALUES:
+            return vtype, dtype
+
+    return ua.VariantType.Null, ua.NodeId(ua.ObjectIds.BaseDataType)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="pete virtual PLC")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    record = subparsers.add_parser("record", help="record a PLC to a snapshot")
+    record.add_argument(
+        "ip", type=str, help="plc ip address, or url e.g. opc.tcp://localhost:4841"
+    )
+    record.add_argument("snapshot", type=str, help="snapshot file to write")
+
+    serve = subparsers.add_parser("serve", help="serve a virtual PLC")
+    source = serve.add_mutually_exclusive_group(required=True)
+    source.add_argument("-s", "--snapshot", type=str, help="snapshot file to mirror")
+    source.add_argument("-n", "--devices", type=int, help="number of devices")
+    serve.add_argument("-p", "--port", type=int, default=4840, help="tcp port")
+    serve.add_argument(
+        "-e", "--echo", action="store_true", help="copy outputs to inputs"
+    )
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from pete.opc_client import OPCClient
+
+        client = OPCClient(args.ip)
+        client.connect()
+        try:
+            Snapshot.build(client, args.snapshot)
+        finally:
+            client.disconnect()
+        return
+
+    plc = VirtualPLC(args.port)
+    if args.snapshot:
+        plc.fromSnapshot(Snapshot(args.snapshot))
+    else:
+        plc.addDevices(args.devices)
+
+    plc.start()
+    if args.echo:
+        plc.enableEcho()
+    print("Serving {} nodes at opc.tcp://localhost:{}".format(plc.n_nodes, args.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        plc.stop()
+
+
+if __name__ == "__main__":
+    run()
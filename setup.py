@@ -9,14 +9,22 @@ setup(
     author="Johannes Kazantzidis",
     author_email="johannes.kazantzidis@esss.se",
     license="MIT",
-    entry_points={"console_scripts": ["pete-gui=pete.gui.pete_gui:run"]},
+    entry_points={
+        "console_scripts": [
+            "pete-gui=pete.gui.petenv_gui:run",
+            "pete-dump=pete.dump:run",
+            "pete-plc=pete.virtual_plc:run",
+        ]
+    },
     packages=find_packages(),
     install_requires=[
         "opcua",
+        "asyncua",
         "pyepics",
         "cryptography",
         "pyqt5",
         "PyQt5-sip",
+        "numpy",
         "pytest-metadata",
         "pytest",
         "pytest-parallel",